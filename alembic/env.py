@@ -1,4 +1,5 @@
 from __future__ import with_statement
+import os
 from alembic import context
 from sqlalchemy import engine_from_config, pool
 from logging.config import fileConfig
@@ -18,6 +19,10 @@ fileConfig(config.config_file_name)
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
 
+# Same variable as the bot uses, so migrations run against its database. Falls back to alembic.ini.
+if 'DATABASE_URL' in os.environ:
+    config.set_main_option('sqlalchemy.url', os.environ['DATABASE_URL'])
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -38,7 +43,8 @@ def run_migrations_offline():
     """
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        render_as_batch=url.startswith('sqlite'))
 
     with context.begin_transaction():
         context.run_migrations()
@@ -59,7 +65,9 @@ def run_migrations_online():
     with connectable.connect() as connection:
         context.configure(
             connection=connection,
-            target_metadata=target_metadata
+            target_metadata=target_metadata,
+            # SQLite can't alter columns and constraints, autogenerated migrations have to recreate the table
+            render_as_batch=connection.dialect.name == 'sqlite'
         )
 
         with context.begin_transaction():
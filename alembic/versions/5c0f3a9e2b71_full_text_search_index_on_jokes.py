@@ -0,0 +1,29 @@
+"""full text search index on jokes
+
+Revision ID: 5c0f3a9e2b71
+Revises: bc12e3b6a579
+Create Date: 2026-10-19 10:12:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c0f3a9e2b71'
+down_revision = 'bc12e3b6a579'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Only PostgreSQL searches in the database, other databases use an in-process index (app/JokeSearch.py)
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute("CREATE INDEX ix_jokes_body_tsv ON jokes USING gin (to_tsvector('english', body))")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.drop_index('ix_jokes_body_tsv', table_name='jokes')
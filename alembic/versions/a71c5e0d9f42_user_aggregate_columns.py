@@ -0,0 +1,64 @@
+"""user aggregate columns
+
+Revision ID: a71c5e0d9f42
+Revises: 8e4d2c7f1a63
+Create Date: 2026-10-19 12:20:03.118455
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a71c5e0d9f42'
+down_revision = '8e4d2c7f1a63'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def backfill(connection):
+    """
+    Compute aggregates for users in batches of BATCH_SIZE ids, so no statement touches the whole table
+    """
+    last_id = None
+    while True:
+        query = 'SELECT id FROM users {} ORDER BY id LIMIT :limit'.format('' if last_id is None else 'WHERE id > :last_id')
+        user_ids = [row[0] for row in connection.execute(sa.text(query), last_id=last_id, limit=BATCH_SIZE)]
+        if len(user_ids) == 0:
+            return
+        last_id = user_ids[-1]
+
+        aggregates = {user_id: {'user_id': user_id, 'jokes': 0, 'votes': 0, 'positive': 0} for user_id in user_ids}
+        queries = {
+            'jokes': 'SELECT user_id, count(*) FROM jokes WHERE user_id IN :ids GROUP BY user_id',
+            'votes': 'SELECT users_id, count(DISTINCT jokes_id) FROM association WHERE users_id IN :ids GROUP BY users_id',
+            # Positive vote adds two rows to association table, negative one
+            'positive': 'SELECT author, count(*) FROM ('
+                        '  SELECT jokes.user_id AS author FROM association JOIN jokes ON jokes.id = association.jokes_id'
+                        '  WHERE jokes.user_id IN :ids'
+                        '  GROUP BY jokes.user_id, association.users_id, association.jokes_id HAVING count(*) > 1'
+                        ') AS positive_votes GROUP BY author',
+        }
+        for key, query in queries.items():
+            statement = sa.text(query).bindparams(sa.bindparam('ids', expanding=True))
+            for user_id, count in connection.execute(statement, ids=user_ids):
+                aggregates[user_id][key] = count
+
+        connection.execute(sa.text('UPDATE users SET jokes_submitted_count = :jokes, votes_cast_count = :votes, '
+                                   'positive_votes_received = :positive WHERE id = :user_id'),
+                           list(aggregates.values()))
+
+
+def upgrade():
+    op.add_column('users', sa.Column('jokes_submitted_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('users', sa.Column('votes_cast_count', sa.Integer(), server_default='0', nullable=True))
+    op.add_column('users', sa.Column('positive_votes_received', sa.Integer(), server_default='0', nullable=True))
+    backfill(op.get_bind())
+
+
+def downgrade():
+    op.drop_column('users', 'positive_votes_received')
+    op.drop_column('users', 'votes_cast_count')
+    op.drop_column('users', 'jokes_submitted_count')
@@ -18,13 +18,16 @@ depends_on = None
 
 def upgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.add_column('jokes', sa.Column('user_id', sa.Integer(), nullable=True))
-    op.create_foreign_key(None, 'jokes', 'users', ['user_id'], ['id'])
+    # Batch mode, so the constraint can be added on SQLite, which can't alter constraints. Name is PostgreSQL's default.
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('jokes_user_id_fkey', 'users', ['user_id'], ['id'])
     # ### end Alembic commands ###
 
 
 def downgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_constraint(None, 'jokes', type_='foreignkey')
-    op.drop_column('jokes', 'user_id')
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.drop_constraint('jokes_user_id_fkey', type_='foreignkey')
+        batch_op.drop_column('user_id')
     # ### end Alembic commands ###
@@ -18,13 +18,19 @@ depends_on = None
 
 def upgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.create_unique_constraint(None, 'jokes', ['id'])
-    op.create_unique_constraint(None, 'users', ['id'])
+    # Batch mode, so the constraints can be added on SQLite, which can't alter constraints. Names are PostgreSQL's
+    # defaults.
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.create_unique_constraint('jokes_id_key', ['id'])
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.create_unique_constraint('users_id_key', ['id'])
     # ### end Alembic commands ###
 
 
 def downgrade():
     # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_constraint(None, 'users', type_='unique')
-    op.drop_constraint(None, 'jokes', type_='unique')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.drop_constraint('users_id_key', type_='unique')
+    with op.batch_alter_table('jokes') as batch_op:
+        batch_op.drop_constraint('jokes_id_key', type_='unique')
     # ### end Alembic commands ###
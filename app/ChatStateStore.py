@@ -0,0 +1,304 @@
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from app.models import ChatState
+
+logger = logging.getLogger(__name__)
+
+
+def get_size(value):
+    """
+    Returns:
+        int: approximate number of bytes held by value, including items of dicts, lists, tuples and sets in it
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(get_size(key) + get_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(get_size(item) for item in value)
+    return size
+
+
+class PersistentUserData(dict):
+    """
+    Replacement for `Dispatcher.user_data`, which rehydrates user's data from ChatStateStore on first access.
+    """
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def __missing__(self, user_id):
+        if user_id is not None:
+            self.store.rehydrate(user_id)
+        return self.setdefault(user_id, {})
+
+
+class PersistentConversations(dict):
+    """
+    Replacement for `ConversationHandler.conversations`, which rehydrates states from ChatStateStore on first access.
+
+    Keys are (chat id, user id) tuples.
+    """
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    def get(self, key, default=None):
+        self.store.rehydrate(key[1])
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        self.store.rehydrate(key[1])
+        return super().__contains__(key)
+
+
+class ChatStateStore:
+    """
+    Class to persist `user_data` and conversation states in `chat_states` table, so they survive a restart.
+
+    State holds only ids and small cursors, caches which can be recomputed (`TRANSIENT_KEYS`) aren't stored.
+    Nothing is loaded at startup, state of a user is loaded the first time his `user_data` or conversation state
+    is accessed.
+
+    Writes are done behind: `save` only serializes the state, a background thread writes the changed states in
+    batches every `flush_interval` seconds.
+
+    In-memory state is evicted by `evict`: users idle for longer than `idle_timeout` have their conversations
+    ended and their state freed, and least recently active users are freed while more than `memory_max` bytes
+    are held. Freed state stays stored and is loaded again on the next access.
+    """
+    TRANSIENT_KEYS = {'favorite_joke_ids'}
+    # Keys of `user_data` which are used only inside a conversation, dropped when the conversation times out
+    CONVERSATION_KEYS = {'joke_to_remove_id', 'unapproved_joke_id', 'my_jokes_index',
+                         'search_results', 'search_results_index', 'favorites', 'favorites_index'}
+
+    def __init__(self, session, Session, flush_interval, idle_timeout, memory_max, metrics):
+        """
+        Arguments:
+            session: sqlalchemy Session used by the dispatcher thread to load states
+            Session: sessionmaker, used to create session for the background thread
+            flush_interval: float, seconds between writes
+            idle_timeout: float, seconds after the last update of a user his conversations end
+            memory_max: int, bytes of in-memory state kept at most
+            metrics: Metrics, counts of evictions and memory held are reported to it
+        """
+        self.session = session
+        self.Session = Session
+        self.flush_interval = flush_interval
+        self.idle_timeout = idle_timeout
+        self.memory_max = memory_max
+        self.metrics = metrics
+
+        self.user_data = None
+        self.conversation_handlers = {}  # name -> ConversationHandler
+        self.rehydrated = set()  # ids of users whose state was loaded
+        self.active = OrderedDict()  # user id -> (time of last save, bytes held, chat ids), least recent first
+                                     # chat ids are ordered too, the most recent last
+        self.bytes_held = 0
+        self.pending = {}  # user id -> serialized state, None to delete
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def attach(self, dispatcher, conversation_handlers):
+        """
+        Replace in-memory state of dispatcher and conversation handlers with persistent one
+
+        Arguments:
+            dispatcher: telegram.ext.Dispatcher
+            conversation_handlers: dict, name -> ConversationHandler. Names are used as keys in stored state.
+        """
+        self.user_data = PersistentUserData(self)
+        dispatcher.user_data = self.user_data
+        self.conversation_handlers = conversation_handlers
+        for handler in conversation_handlers.values():
+            handler.conversations = PersistentConversations(self)
+
+    def dehydrate(self, user_id, chat_id):
+        """
+        Serialize state of user
+
+        Returns:
+            string, or None if there is nothing to be stored
+        """
+        user_data = {key: value for key, value in dict.get(self.user_data, user_id, {}).items()
+                     if key not in self.TRANSIENT_KEYS}
+
+        conversations = []
+        for name, handler in self.conversation_handlers.items():
+            state = dict.get(handler.conversations, (chat_id, user_id))
+            if isinstance(state, int):  # states of `run_async` handlers are skipped
+                conversations.append([name, chat_id, state])
+
+        if len(user_data) == 0 and len(conversations) == 0:
+            return None
+        return json.dumps({'u': user_data, 'c': conversations}, separators=(',', ':'))
+
+    def rehydrate(self, user_id):
+        """
+        Load state of user, if it wasn't loaded yet
+        """
+        if user_id in self.rehydrated:
+            return
+        self.rehydrated.add(user_id)
+
+        # State of an evicted user may not be written yet
+        with self.lock:
+            queued = user_id in self.pending
+            data = self.pending.get(user_id)
+        if not queued:
+            data = self.session.query(ChatState.data).filter(ChatState.user_id == user_id).scalar()
+        if data is None:
+            return
+
+        state = json.loads(data)
+        dict.__setitem__(self.user_data, user_id, state['u'])
+
+        for name, chat_id, conversation_state in state['c']:
+            handler = self.conversation_handlers.get(name)
+            if handler is not None:
+                dict.__setitem__(handler.conversations, (chat_id, user_id), conversation_state)
+
+    def save(self, user_id, chat_id):
+        """
+        Queue state of user in chat to be written
+        """
+        if user_id is None or chat_id is None:
+            return
+        # Otherwise state which wasn't loaded yet would be overwritten with an empty one
+        self.rehydrate(user_id)
+        data = self.dehydrate(user_id, chat_id)
+        with self.lock:
+            self.pending[user_id] = data
+
+        size = get_size(dict.get(self.user_data, user_id, {}))
+        for handler in self.conversation_handlers.values():
+            key = (chat_id, user_id)
+            if dict.__contains__(handler.conversations, key):
+                size += get_size(key) + get_size(dict.get(handler.conversations, key))
+        _, previous_size, chat_ids = self.active.pop(user_id, (None, 0, []))
+        if chat_id in chat_ids:
+            chat_ids.remove(chat_id)
+        chat_ids.append(chat_id)
+        self.active[user_id] = (time.time(), size, chat_ids)
+        self.bytes_held += size - previous_size
+
+    def forget(self, user_id):
+        """
+        Free in-memory state of user, it's loaded again on the next access
+        """
+        _, size, chat_ids = self.active.pop(user_id)
+        self.bytes_held -= size
+        self.rehydrated.discard(user_id)
+        dict.pop(self.user_data, user_id, None)
+        for handler in self.conversation_handlers.values():
+            for chat_id in chat_ids:
+                dict.pop(handler.conversations, (chat_id, user_id), None)
+
+    def delete(self, user_id):
+        """
+        Drop in-memory state of user and queue his stored state to be deleted, e.g. when the user is purged
+        """
+        if user_id in self.active:
+            self.forget(user_id)
+        else:
+            self.rehydrated.discard(user_id)
+            dict.pop(self.user_data, user_id, None)
+        with self.lock:
+            self.pending[user_id] = None
+
+    def end_conversations(self, user_id, chat_ids):
+        """
+        End all conversations of user and drop their keys from `user_data`, the change is queued to be written
+
+        Returns:
+            int: number of conversations ended
+        """
+        ended = 0
+        for handler in self.conversation_handlers.values():
+            for chat_id in chat_ids:
+                if dict.pop(handler.conversations, (chat_id, user_id), None) is not None:
+                    ended += 1
+
+        user_data = dict.get(self.user_data, user_id, {})
+        conversation_keys = self.CONVERSATION_KEYS & set(user_data)
+        for key in conversation_keys:
+            del user_data[key]
+
+        if ended > 0 or len(conversation_keys) > 0:
+            data = self.dehydrate(user_id, chat_ids[-1])
+            with self.lock:
+                self.pending[user_id] = data
+        return ended
+
+    def evict(self, now=None):
+        """
+        End conversations of idle users and free their state, then free state of the least recently active users
+        until at most `memory_max` bytes are held.
+
+        Must be called from the dispatcher thread before an update is handled, so no handler holds the state of an
+        evicted user. A user coming back after `idle_timeout` thus finds his conversation ended.
+        """
+        now = now if now is not None else time.time()
+        while len(self.active) > 0:
+            user_id, (last_active, _, chat_ids) = next(iter(self.active.items()))
+            if now - last_active > self.idle_timeout:
+                self.metrics.increment('conversations.timed_out', self.end_conversations(user_id, chat_ids))
+                self.metrics.increment('chat_state.evicted_idle')
+            elif self.bytes_held > self.memory_max:
+                self.metrics.increment('chat_state.evicted_memory')
+            else:
+                break
+            self.forget(user_id)
+
+        self.metrics.set('chat_state.chats', len(self.active))
+        self.metrics.set('chat_state.bytes', self.bytes_held)
+        self.metrics.set('chat_state.bytes_per_chat',
+                         self.bytes_held // len(self.active) if len(self.active) > 0 else None)
+
+    def flush(self):
+        """
+        Write all queued states in one transaction
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if len(pending) == 0:
+            return
+
+        session = self.Session()
+        try:
+            session.query(ChatState).filter(ChatState.user_id.in_(list(pending))).delete(synchronize_session=False)
+            session.bulk_insert_mappings(ChatState, [{'user_id': user_id, 'data': data}
+                                                     for user_id, data in pending.items() if data is not None])
+            session.commit()
+        except Exception as e:
+            logger.error('Writing chat states failed: {}'.format(e))
+            session.rollback()
+            with self.lock:
+                # Keep newer states queued in the meantime
+                pending.update(self.pending)
+                self.pending = pending
+        finally:
+            session.close()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='chat_state_store', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop background thread and write remaining states
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
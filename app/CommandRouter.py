@@ -0,0 +1,147 @@
+import re
+
+from telegram import Update
+from telegram.ext import Handler, CommandHandler, ConversationHandler, RegexHandler
+
+# Patterns like '^(/next|/cancel)$', which match only the listed commands
+LITERAL_COMMANDS_PATTERN = re.compile(r'^\^\((/\w+(?:\|/\w+)*)\)\$$')
+
+GENERIC = 'generic'  # handler has to be checked for every update
+ANY_COMMAND = 'any_command'  # handler has to be checked for every command
+
+
+def get_route_keys(handler):
+    """
+    Returns:
+        set of commands (lowercase, with leading '/') the handler can match, or GENERIC or ANY_COMMAND
+    """
+    if isinstance(handler, CommandHandler):
+        return {'/' + command for command in handler.command}
+    if isinstance(handler, RegexHandler):
+        pattern = handler.pattern.pattern
+        literal = LITERAL_COMMANDS_PATTERN.match(pattern)
+        if literal is not None:
+            return {command.lower() for command in literal.group(1).split('|')}
+        # RegexHandler uses `re.match`, so the text has to start with '/'
+        if pattern.startswith('/') or pattern.startswith('^/'):
+            return ANY_COMMAND
+    return GENERIC
+
+
+class Routes:
+    """
+    Handlers indexed by the command they can match. Handlers keep the order they were added in.
+    """
+    def __init__(self):
+        self.commands = {}  # command -> list of handler indexes
+        self.any_command = []
+        self.generic = []
+
+    def add(self, handler, index):
+        route_keys = get_route_keys(handler)
+        if route_keys is GENERIC:
+            self.generic.append(index)
+        elif route_keys is ANY_COMMAND:
+            self.any_command.append(index)
+        else:
+            for command in route_keys:
+                self.commands.setdefault(command, []).append(index)
+
+    def get(self, command):
+        """
+        Returns:
+            list of indexes of handlers which can match the command, or have to be checked for every update
+        """
+        if command is None:
+            return self.generic
+        return self.commands.get(command, []) + self.any_command + self.generic
+
+
+class CommandRouter(Handler):
+    """
+    Single handler replacing the list of handlers in the default group of the dispatcher.
+
+    The dispatcher checks handlers one after another, which for every update means parsing the command in every
+    CommandHandler, running regexes and looking up conversation states of all ConversationHandlers. CommandRouter
+    parses the command once and looks up the handlers which can match it in dicts keyed by command and by
+    conversation state. Only those candidates are checked with their own `check_update`, in the order the
+    handlers were given, so the first matching handler is the same one the dispatcher would have picked.
+    Regexes are run only for handlers which can match any text, e.g. in states waiting for free text.
+    """
+    def __init__(self, handlers, tracer=None):
+        """
+        Arguments:
+            handlers: list of Handler, in the order they would be added to the dispatcher
+            tracer: UpdateTracer, time from the matching handler on is counted in its `handler` phase. Optional.
+        """
+        super().__init__(callback=None)
+        self.handlers = handlers
+        self.tracer = tracer
+        self.routes = Routes()  # top level handlers, and conversations by their entry points
+        self.conversations = []  # (handler index, ConversationHandler, dict: state -> Routes)
+        self.current_handler = None
+
+        for index, handler in enumerate(handlers):
+            if not isinstance(handler, ConversationHandler):
+                self.routes.add(handler, index)
+                continue
+
+            for entry_point in handler.entry_points:
+                self.routes.add(entry_point, index)
+            state_routes = {}
+            for state, state_handlers in handler.states.items():
+                routes = Routes()
+                for state_handler in state_handlers + handler.fallbacks:
+                    routes.add(state_handler, index)
+                if handler.allow_reentry:
+                    for entry_point in handler.entry_points:
+                        routes.add(entry_point, index)
+                state_routes[state] = routes
+            self.conversations.append((index, handler, state_routes))
+
+    @staticmethod
+    def get_command(update):
+        """
+        Returns:
+            string: lowercase command without bot's username, e.g. '/next', None if the message isn't a command
+        """
+        message = update.effective_message
+        if message is None or not message.text or not message.text.startswith('/'):
+            return None
+        return message.text.split(None, 1)[0].split('@', 1)[0].lower()
+
+    def get_candidates(self, update):
+        """
+        Returns:
+            list of handlers which can match the update, in the order they were given
+        """
+        command = self.get_command(update)
+        indexes = set(self.routes.get(command))
+
+        # Like ConversationHandler, conversations are looked up only for messages from a user in a chat
+        if update.effective_chat is not None and update.effective_user is not None and not update.channel_post:
+            for index, handler, state_routes in self.conversations:
+                state = handler.conversations.get(handler._get_key(update))
+                if state is None:
+                    continue
+                routes = state_routes.get(state)
+                if routes is None:  # states of `run_async` handlers are resolved by the handler
+                    indexes.add(index)
+                else:
+                    indexes.update(routes.get(command))
+
+        return [self.handlers[index] for index in sorted(indexes)]
+
+    def check_update(self, update):
+        if not isinstance(update, Update):
+            return False
+        for handler in self.get_candidates(update):
+            if handler.check_update(update):
+                self.current_handler = handler
+                return True
+        return False
+
+    def handle_update(self, update, dispatcher):
+        if self.tracer is not None:
+            self.tracer.switch('handler')
+        return self.current_handler.handle_update(update, dispatcher)
@@ -0,0 +1,87 @@
+import time
+from collections import OrderedDict
+
+from app.TokenBucket import TokenBucket
+
+
+class FloodControl:
+    """
+    Class to limit how many updates a chat can send, before anything is done for them.
+
+    Every chat has a token bucket refilled with `rate` tokens per second up to `capacity`, every update takes the
+    cost of its command from it. An update is rejected if there aren't enough tokens.
+
+    Buckets are kept least recently used first. Buckets idle long enough to be full again are the same as new ones
+    and are dropped, so only chats active in the last `capacity / rate` seconds are held. If there are still more
+    than `chats_max` of them, the least recently used buckets are dropped too.
+
+    Used by the dispatcher thread only.
+    """
+    def __init__(self, rate, capacity, costs, default_cost, chats_max, warning_interval, metrics):
+        """
+        Arguments:
+            rate: float, tokens added to bucket of a chat per second
+            capacity: float, tokens a chat can spend at once
+            costs: dict, command (lowercase, with leading '/') -> tokens it takes
+            default_cost: float, tokens taken by other commands and updates
+            chats_max: int, buckets kept at most
+            warning_interval: float, seconds between replies telling a throttled chat to slow down
+            metrics: Metrics, throttled updates are counted in it
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.costs = costs
+        self.default_cost = default_cost
+        self.chats_max = chats_max
+        self.warning_interval = warning_interval
+        self.metrics = metrics
+
+        self.refill_seconds = capacity / rate  # an idle bucket is full after this
+        self.buckets = OrderedDict()  # chat id -> [TokenBucket, time of the last warning], least recent first
+
+    def get_cost(self, command):
+        return self.costs.get(command, self.default_cost)
+
+    def drop_idle(self, now):
+        while len(self.buckets) > 0:
+            bucket, _ = next(iter(self.buckets.values()))
+            if len(self.buckets) <= self.chats_max and now - bucket.updated < self.refill_seconds:
+                break
+            self.buckets.popitem(last=False)
+
+    def check(self, chat_id, command, now=None, cost=None):
+        """
+        Take cost of command from bucket of chat
+
+        Arguments:
+            chat_id: int, or any other hashable key of the bucket
+            command: string, None if the update isn't a command
+            cost: float, tokens taken instead of the cost of command
+
+        Returns:
+            tuple: bool: True if the update can be processed
+                   bool: True if the chat should be told to slow down, call `note_warning` once it was told. At
+                       most once per `warning_interval`.
+        """
+        now = now if now is not None else time.monotonic()
+        entry = self.buckets.pop(chat_id, None)
+        if entry is None:
+            entry = [TokenBucket(self.rate, self.capacity, now), None]
+        self.buckets[chat_id] = entry
+        self.drop_idle(now)
+        self.metrics.set('flood.chats', len(self.buckets))
+
+        bucket, warned = entry
+        if bucket.take(cost if cost is not None else self.get_cost(command), now) == 0:
+            return True, False
+
+        self.metrics.increment('flood.throttled')
+        return False, warned is None or now - warned >= self.warning_interval
+
+    def note_warning(self, chat_id, now=None):
+        """
+        Remember that chat was told to slow down, it isn't told again for `warning_interval` seconds
+        """
+        entry = self.buckets.get(chat_id)
+        if entry is not None:
+            entry[1] = now if now is not None else time.monotonic()
@@ -1,17 +1,38 @@
-from telegram.ext import Updater, Filters, CommandHandler, ConversationHandler, RegexHandler, MessageHandler
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.ext import Updater, Filters, CommandHandler, ConversationHandler, RegexHandler, MessageHandler, TypeHandler, \
+    CallbackQueryHandler, InlineQueryHandler, DispatcherHandlerStop
+from telegram import Bot, Update, KeyboardButton, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineQueryResultArticle, \
+    InputTextMessageContent
 
+import io
 import logging
-from random import choice, shuffle
+import signal
+import threading
+import time
+from datetime import datetime, timedelta, time as time_of_day
+from queue import Empty
+from random import choice
 from string import ascii_letters, digits
 
 from app.TelegramBotHelper import HahOrNahBotHelper
 from app.TelegramBotResponses import TelegramBotResponses
+from app.JokeSearch import JokeSearch
+from app.JokeRanking import JokeRanking
+from app.InlineJokes import InlineJokes
+from app.JokeIndexSync import JokeIndexSync
+from app.JokePrefetcher import JokePrefetcher
+from app.ChatStateStore import ChatStateStore
+from app.CommandRouter import CommandRouter
+from app.FloodControl import FloodControl
+from app.UpdateDeduplicator import UpdateDeduplicator
+from app.SamplingProfiler import SamplingProfiler
+from app.UpdateTracer import UpdateTracer, TracedRequest, TracedQueue
+from app.StartupProfile import StartupProfile
+from app.VoteLog import VoteLog
+from app.StatsRollups import StatsRollups
+from app.JokeOfTheDay import JokeOfTheDay, VOTE_CALLBACK_PATTERN
 from app.models import Joke, User
 from app.exceptions import *
 
-from sqlalchemy.exc import SQLAlchemyError
-
 logger = logging.getLogger(__name__)
 
 USERNAME_RECEIVED = 0
@@ -19,9 +40,25 @@ JOKE_RECEIVED, CANCEL = 0, 1
 MJ_CHOOSING, MJ_NEXT, MJ_CANCEL = range(3)
 RJ_RECEIVED, RJ_CONFIRM, RJ_REMOVE = range(3)
 AJ_VOTED, AJ_NEXT = range(2)
+SJ_CHOOSING = 0
+FJ_CHOOSING = 0
 
 class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
-    def __init__(self, token, database_url):
+    def __init__(self, token, database_url, base_url=None, startup_profile=None, replica_url=None,
+                 vote_log_directory=None, shared_deduplication=False, trace_sample_rate=0):
+        """
+        Arguments:
+            token: string
+            database_url: string
+            replica_url: string, url of a read replica used by read-only handlers. Optional.
+            vote_log_directory: string, directory votes are logged to, defaults to `vote_log`
+            shared_deduplication: bool, record ids of received updates in database, so an update delivered to
+                several processes is processed once
+            trace_sample_rate: float, share of updates whose phases are traced to files in `traces`, 0 disables
+                tracing
+            base_url: string, Bot API url, defaults to api.telegram.org
+            startup_profile: StartupProfile, phases of initialization are recorded in it
+        """
         # Configuration variables
         BOT_RESPONSES_FILENAME = 'bot_responses/bot_responses.json'
         JOKE_LENGTH_MIN = 10
@@ -29,29 +66,130 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         USERNAME_LENGTH_MIN = 5
         USERNAME_LENGTH_MAX = 20
         USERNAME_ALLOWED_CHARACTERS = set(ascii_letters + digits + '-_')
+        RANKING_EXPLORATION_SHARE = 0.2  # probability of displaying a joke with few votes
+        RANKING_NEW_JOKE_VOTES = 5  # jokes with less votes are treated as new
+        self.RANDOM_JOKE_ATTEMPTS = 10  # ranked jokes tried before falling back to database query
+        JOKE_SYNC_INTERVAL = 10  # seconds between reads of jokes approved or deleted by other shards
+        PREFETCH_RESULTS_MAX = 10000  # users whose next joke is kept at most
+        PREFETCH_MAX_AGE = 10 * 60  # seconds, next joke chosen earlier is chosen again
+        CHAT_STATE_FLUSH_INTERVAL = 2  # seconds between writes of conversation states to database
+        CHAT_STATE_IDLE_TIMEOUT = 15 * 60  # seconds, conversations of idle users end and their state is freed
+        CHAT_STATE_MEMORY_MAX = 64 * 1024 * 1024  # bytes, state of least recently active users is freed above it
+        REPLICA_STICKY_SECONDS = 10  # after a write, user's reads go to the primary for this long
+        REPLICA_LAG_MAX = 30  # seconds, replica lagging more than this isn't used
+        REPLICA_LAG_CHECK_INTERVAL = 5  # seconds between measurements of replica lag
+        VOTE_LOG_DIRECTORY = 'vote_log'
+        VOTE_LOG_FLUSH_INTERVAL = 2  # seconds between writes of votes to the log
+        VOTE_LOG_MAX_FILE_SIZE = 64 * 1024 * 1024  # bytes, a new file is started when exceeded
+        STATS_ROLLUPS_FLUSH_INTERVAL = 5  # seconds between writes of hourly and daily counts
+        JOKE_OF_THE_DAY_RATE = 20  # messages per second, Telegram allows about 30 to different chats
+        JOKE_OF_THE_DAY_CHUNK_SIZE = 200  # user ids read at once, progress is saved after every chunk
+        JOKE_OF_THE_DAY_CHAT_INTERVAL = 1  # seconds, a chat the bot has just answered gets the joke after this
+        self.JOKE_OF_THE_DAY_TIME = time_of_day(hour=12)  # server time, UTC on Heroku
+        FLOOD_RATE = 1  # tokens per second a chat gets back
+        FLOOD_CAPACITY = 10  # tokens a chat can spend in a burst
+        # Tokens taken by commands, by how much database work they do. Other updates take FLOOD_DEFAULT_COST.
+        FLOOD_COSTS = {'/random_joke': 2, '/random_favorite_joke': 2, '/search': 3, '/stats': 3, '/profile': 2,
+                       '/my_jokes': 2, '/favorites': 2, '/help': 0.5, '/menu': 0.5, '/start': 0.5, '/cancel': 0.5}
+        FLOOD_DEFAULT_COST = 1
+        # Inline queries come with every keystroke and are answered from memory, they have their own buckets so
+        # typing doesn't use up tokens of the private chat
+        self.FLOOD_INLINE_COST = 0.25
+        FLOOD_CHATS_MAX = 100000  # buckets kept in memory at most
+        FLOOD_WARNING_INTERVAL = 10  # seconds between replies telling a throttled chat to slow down
+        DEDUPLICATION_WINDOW = 10 * 60  # seconds an update id is remembered for, Telegram redelivers sooner
+        DEDUPLICATION_SIZE_MAX = 100000  # update ids remembered at most
+        PROFILER_INTERVAL = 0.005  # seconds between samples of /profiler
+        PROFILER_TOP_FRAMES = 5  # frames listed per handler
+        self.PROFILER_SECONDS = 30  # default duration of /profiler
+        PROFILER_SECONDS_MAX = 5 * 60
+        self.MESSAGE_LENGTH_MAX = 4096  # longer reports are sent as a file
+        TRACE_DIRECTORY = 'traces'
+        TRACE_FLUSH_INTERVAL = 2  # seconds between writes of traces
+        TRACE_MAX_FILE_SIZE = 16 * 1024 * 1024  # bytes, a new file is started when exceeded
+        TRACE_FILES_MAX = 10  # older trace files are deleted
+        UPDATER_CON_POOL_SIZE = 8  # what Updater would use for its 4 workers
+        # seconds updates already accepted are processed for after a stop signal, Heroku kills the process 30 s
+        # after SIGTERM and buffered state has to be written in the rest of it
+        self.DRAIN_TIMEOUT = 20
         self.MY_JOKES_PER_MESSAGE = 5
+        self.SEARCH_RESULTS_MAX = 50
+        self.INLINE_CACHE_TTL = 10  # seconds inline answers are cached for, here and by Telegram
+        INLINE_BUDGET = 0.05  # seconds, slower inline searches are answered with the best jokes
+        INLINE_RESULTS_MAX = 20
+        self.INLINE_TITLE_LENGTH = 60
         self.MODERATORS = [452678368]
 
         joke_limits = {'min':JOKE_LENGTH_MIN, 'max':JOKE_LENGTH_MAX}
         username_limits = {'min':USERNAME_LENGTH_MIN, 'max':USERNAME_LENGTH_MAX}
+        replica_limits = {'sticky': REPLICA_STICKY_SECONDS, 'lag_max': REPLICA_LAG_MAX,
+                          'lag_check_interval': REPLICA_LAG_CHECK_INTERVAL}
 
-        TelegramBotResponses.__init__(self, BOT_RESPONSES_FILENAME)
-        HahOrNahBotHelper.__init__(self, database_url, joke_limits, username_limits, USERNAME_ALLOWED_CHARACTERS)
+        self.startup_profile = startup_profile if startup_profile is not None else StartupProfile()
+
+        with self.startup_profile.phase('load responses'):
+            TelegramBotResponses.__init__(self, BOT_RESPONSES_FILENAME)
+        # Database engine is created on first use or by warm-up in `start_webhook`
+        HahOrNahBotHelper.__init__(self, database_url, joke_limits, username_limits, USERNAME_ALLOWED_CHARACTERS,
+                                   replica_url=replica_url, replica_limits=replica_limits)
 
         self.token = token
-        self.database_url = database_url
-        self.updater = Updater(token=token)
+        self.update_tracer = UpdateTracer(TRACE_DIRECTORY, trace_sample_rate, TRACE_FLUSH_INTERVAL,
+                                          TRACE_MAX_FILE_SIZE, TRACE_FILES_MAX, self.metrics)
+        with self.startup_profile.phase('create updater'):
+            if self.update_tracer.enabled:
+                # Bot API requests and time spent in the update queue are recorded in traces
+                request = TracedRequest(self.update_tracer, con_pool_size=UPDATER_CON_POOL_SIZE)
+                self.updater = Updater(bot=Bot(token, base_url=base_url, request=request))
+                self.updater.update_queue = TracedQueue(self.update_tracer)
+                self.updater.dispatcher.update_queue = self.updater.update_queue
+            else:
+                self.updater = Updater(token=token, base_url=base_url)
         self.dispatcher = self.updater.dispatcher
-
+        self.joke_search = JokeSearch(self.session)
+        self.joke_ranking = JokeRanking(self.session, RANKING_EXPLORATION_SHARE, RANKING_NEW_JOKE_VOTES)
+        self.joke_prefetcher = JokePrefetcher(self, self.Session, self.RANDOM_JOKE_ATTEMPTS, PREFETCH_RESULTS_MAX,
+                                              PREFETCH_MAX_AGE, self.metrics)
+        self.inline_jokes = InlineJokes(self.Session, self.metrics, self.INLINE_CACHE_TTL, INLINE_BUDGET,
+                                        INLINE_RESULTS_MAX)
+        self.joke_index_sync = JokeIndexSync(self.Session, JOKE_SYNC_INTERVAL, self.metrics)
+        self.chat_state_store = ChatStateStore(self.session, self.Session, CHAT_STATE_FLUSH_INTERVAL,
+                                               CHAT_STATE_IDLE_TIMEOUT, CHAT_STATE_MEMORY_MAX, self.metrics)
+        self.stats_rollups = StatsRollups(self.Session, STATS_ROLLUPS_FLUSH_INTERVAL)
+        self.vote_log = VoteLog(vote_log_directory or VOTE_LOG_DIRECTORY, VOTE_LOG_FLUSH_INTERVAL,
+                                VOTE_LOG_MAX_FILE_SIZE)
+        self.update_in_progress = False  # set between `before_update` and `after_update`
+        self.update_deduplicator = UpdateDeduplicator(DEDUPLICATION_WINDOW, DEDUPLICATION_SIZE_MAX, self.metrics,
+                                                      self.init_database if shared_deduplication else None)
+        self.profiler = SamplingProfiler(PROFILER_INTERVAL, PROFILER_TOP_FRAMES, PROFILER_SECONDS_MAX)
+        self.flood_control = FloodControl(FLOOD_RATE, FLOOD_CAPACITY, FLOOD_COSTS, FLOOD_DEFAULT_COST,
+                                          FLOOD_CHATS_MAX, FLOOD_WARNING_INTERVAL, self.metrics)
+        self.joke_of_the_day = JokeOfTheDay(self.updater.bot, self.Session, self.metrics, self.is_busy,
+                                            self.get_random_response('joke_of_the_day'), JOKE_OF_THE_DAY_RATE,
+                                            JOKE_OF_THE_DAY_CHUNK_SIZE, JOKE_OF_THE_DAY_CHAT_INTERVAL)
+
+        with self.startup_profile.phase('register handlers'):
+            self.register_handlers()
+
+    def register_handlers(self):
+        """
+        Create handlers for all commands and conversations and add them to dispatcher
+        """
         menu_handler = CommandHandler('menu', self.menu, pass_user_data=True)
         start_handler = CommandHandler('start', self.menu, pass_user_data=True)
         help_handler = CommandHandler('help', self.help)
-        stats_handler = CommandHandler('stats', self.stats)
+        stats_handler = CommandHandler('stats', self.stats, pass_args=True)
         cancel_handler = CommandHandler('cancel', self.cancel_conversation)
         random_joke_handler = CommandHandler('random_joke', self.display_random_joke, pass_user_data=True)
         random_favorite_joke_handler = CommandHandler('random_favorite_joke', self.display_random_favorite_joke, pass_user_data=True)
         vote_handler = RegexHandler('^(/hah|/nah)$', self.vote_for_joke, pass_user_data=True)
         profile_handler = CommandHandler('profile', self.profile, pass_user_data=True)
+        metrics_handler = CommandHandler('metrics', self.show_metrics)
+        profiler_handler = CommandHandler('profiler', self.start_profiler, pass_args=True)
+        purge_user_handler = CommandHandler('purge_user', self.purge_user_command, pass_args=True)
+        vote_button_handler = CallbackQueryHandler(self.vote_from_button, pattern=VOTE_CALLBACK_PATTERN,
+                                                   pass_groups=True, pass_user_data=True)
+        inline_query_handler = InlineQueryHandler(self.inline_query)
 
         # Whenever the method `self.private_get_user` raises an exception, keyboard with two options is displayed.
         # /whatever string is stored in 'user_new_keyboard_button' in bot_responses.json and /cancel
@@ -99,6 +237,20 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
                 AJ_NEXT: [CommandHandler('next', self.approve_jokes_show, pass_user_data=True)]},
             fallbacks=[cancel_handler])
 
+        search_handler = ConversationHandler(
+            entry_points=[CommandHandler('search', self.search_jokes, pass_args=True, pass_user_data=True)],
+            states={
+                SJ_CHOOSING: [RegexHandler('^(/next|/cancel)$', self.search_jokes_choosing, pass_user_data=True)],
+            },
+            fallbacks=[cancel_handler])
+
+        favorites_handler = ConversationHandler(
+            entry_points=[CommandHandler('favorites', self.favorites, pass_user_data=True)],
+            states={
+                FJ_CHOOSING: [RegexHandler('^(/next|/cancel)$', self.favorites_choosing, pass_user_data=True)],
+            },
+            fallbacks=[cancel_handler])
+
         invalid_command_handler = RegexHandler('/.*', self.invalid_command_handler)
         handlers = [start_handler,
                     menu_handler,
@@ -112,14 +264,41 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
                     random_joke_handler,
                     random_favorite_joke_handler,
                     vote_handler,
+                    vote_button_handler,
+                    inline_query_handler,
 
                     my_jokes_handler,
+                    search_handler,
+                    favorites_handler,
                     profile_handler,
+                    metrics_handler,
+                    profiler_handler,
+                    purge_user_handler,
                     invalid_command_handler,
                     ]
 
-        for handler in handlers:
-            self.dispatcher.add_handler(handler)
+        # Handlers are checked in this order, the router only skips the ones which can't match the update
+        self.command_router = CommandRouter(handlers, self.update_tracer)
+        self.dispatcher.add_handler(self.command_router)
+
+        # Conversation states and `user_data` are persisted, so they survive a restart.
+        # Names are stored in database, don't change them.
+        conversation_handlers = {'new_user': new_user_handler,
+                                 'new_joke': new_joke_handler,
+                                 'remove_joke': remove_joke_handler,
+                                 'approve_jokes': approve_jokes_handler,
+                                 'my_jokes': my_jokes_handler,
+                                 'search': search_handler,
+                                 'favorites': favorites_handler,
+                                 }
+        self.chat_state_store.attach(self.dispatcher, conversation_handlers)
+        # Groups -3 to -1 are processed before the handlers above, groups 1 and 2 after the update was handled by
+        # one of them
+        self.dispatcher.add_handler(TypeHandler(Update, self.drop_duplicate), group=-3)
+        self.dispatcher.add_handler(TypeHandler(Update, self.limit_flood), group=-2)
+        self.dispatcher.add_handler(TypeHandler(Update, self.before_update), group=-1)
+        self.dispatcher.add_handler(TypeHandler(Update, self.save_chat_state), group=1)
+        self.dispatcher.add_handler(TypeHandler(Update, self.after_update), group=2)
 
     def display_new_user_keyboard(self, bot, update):
         """
@@ -129,7 +308,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         """
         keyboard_buttons = [[KeyboardButton(self.get_one_response('user_new_keyboard_button'))],
                             [KeyboardButton('/cancel')]]
-        bot.send_message(chat_id=update.message.chat_id,
+        bot.send_message(chat_id=update.effective_chat.id,
                          text=self.get_random_response('user_not_registered'),
                          reply_markup=ReplyKeyboardMarkup(keyboard_buttons, one_time_keyboard=True))
         return
@@ -256,10 +435,12 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         help_message = '''
         *Commands*
         /help - Display this message
-        /stats - Display bot's stats
+        /stats - Display bot's stats, /stats week for the last 7 days
         /menu - Display commands keyboard
         /random\_joke - Display random joke
         /random\_favorite\_joke - Display random joke from favorites
+        /favorites - Display jokes from favorites
+        /search - Search jokes, e.g. /search cat
         /add\_joke - Proceed to add a joke
         /remove\_joke - Proceed to remove a joke
         /profile - Display user profile
@@ -268,10 +449,22 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message.reply_markdown(help_message)
         return
 
-    def stats(self, bot, update):
+    def stats(self, bot, update, args):
+        """
+        Display number of jokes and users.
+
+        `/stats week` displays activity in the last 7 days, `/stats detail` displays more detailed activity to
+        moderators. Both read only rollup rows (see StatsRollups).
+        """
         message = update.message
-        all_jokes_count = len(self.session.query(Joke).filter_by(approved=True).all())
-        all_users_count = len(self.session.query(User).all())
+        if len(args) > 0 and args[0] == 'week':
+            self.stats_week(bot, update)
+            return
+        if len(args) > 0 and args[0] == 'detail':
+            self.stats_detail(bot, update)
+            return
+
+        all_jokes_count, all_users_count = self.get_stats(self.get_read_session(message.chat.id))
 
         stats_message = "Jokes = {all_jokes_count}\nUsers = {all_users_count}".\
             format(all_jokes_count=all_jokes_count, all_users_count=all_users_count)
@@ -279,6 +472,56 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message.reply_markdown(stats_message)
         return
 
+    def stats_week(self, bot, update):
+        message = update.message
+        today = StatsRollups.get_bucket_start('day', datetime.utcnow())
+        days = [today - timedelta(days=days_ago) for days_ago in range(6, -1, -1)]
+        buckets = self.stats_rollups.get(self.get_read_session(message.chat.id), 'day', days[0])
+
+        columns = [('votes', lambda counts: counts.get('votes', 0)),
+                   ('hah', lambda counts: counts.get('votes_positive', 0)),
+                   ('users', lambda counts: counts.get('users_new', 0)),
+                   ('jokes', lambda counts: counts.get('jokes_submitted', 0))]
+        message.reply_markdown('Last 7 days\n' + self.format_rollups(buckets, days, columns, '%m-%d'))
+
+    def stats_detail(self, bot, update):
+        """
+        Display daily counts of all metrics for the last 7 days and hourly ones for the last 24 hours. Moderators only.
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        now = datetime.utcnow()
+        read_session = self.get_read_session(message.chat.id)
+
+        today = StatsRollups.get_bucket_start('day', now)
+        days = [today - timedelta(days=days_ago) for days_ago in range(6, -1, -1)]
+        day_buckets = self.stats_rollups.get(read_session, 'day', days[0])
+        # Change of the number of jokes waiting for approval
+        backlog = lambda counts: counts.get('jokes_submitted', 0) - counts.get('jokes_approved', 0) - \
+            counts.get('jokes_rejected', 0) - counts.get('jokes_withdrawn', 0)
+        day_columns = [('votes', lambda counts: counts.get('votes', 0)),
+                       ('hah', lambda counts: counts.get('votes_positive', 0)),
+                       ('users', lambda counts: counts.get('users_new', 0)),
+                       ('sub', lambda counts: counts.get('jokes_submitted', 0)),
+                       ('appr', lambda counts: counts.get('jokes_approved', 0)),
+                       ('rej', lambda counts: counts.get('jokes_rejected', 0)),
+                       ('wdr', lambda counts: counts.get('jokes_withdrawn', 0)),
+                       ('queue', backlog)]
+
+        this_hour = StatsRollups.get_bucket_start('hour', now)
+        hours = [this_hour - timedelta(hours=hours_ago) for hours_ago in range(23, -1, -1)]
+        hour_buckets = self.stats_rollups.get(read_session, 'hour', hours[0])
+        hour_columns = [('votes', lambda counts: counts.get('votes', 0)),
+                        ('users', lambda counts: counts.get('users_new', 0)),
+                        ('sub', lambda counts: counts.get('jokes_submitted', 0))]
+
+        message.reply_markdown('Last 7 days (UTC)\n' + self.format_rollups(day_buckets, days, day_columns, '%m-%d'))
+        message.reply_markdown('Last 24 hours (UTC)\n' +
+                               self.format_rollups(hour_buckets, hours, hour_columns, '%H:00'))
+
     def cancel_conversation(self, bot, update):
         self.display_menu_keyboard(bot, update, self.get_random_response('cancel'))
         return ConversationHandler.END
@@ -289,7 +532,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         """
         message = update.message
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -324,7 +567,8 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
 
         try:
             user = self.add_user(user_id, username)
-            user_data['user'] = user
+            self.register_write(user_id)
+            self.stats_rollups.record('users_new')
 
             self.display_menu_keyboard(bot, update, self.get_random_response('user_register_success'))
             return ConversationHandler.END
@@ -366,7 +610,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -374,6 +618,8 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         joke_body = message.text
         try:
             self.add_joke(joke_body, user)
+            self.register_write(user.get_id())
+            self.stats_rollups.record('jokes_submitted')
             self.display_menu_keyboard(bot, update, self.get_random_response('joke_submitted'))
             return ConversationHandler.END
         except TooShort:
@@ -390,7 +636,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -405,7 +651,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -417,18 +663,17 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             message.reply_text(self.get_random_response('remove_joke_received_not_integer'))
             return
 
-        try:
-            joke = self.session.query(Joke).filter(Joke.id==joke_id).one()
-        except SQLAlchemyError:
+        joke = self.get_joke(joke_id)
+        if joke is None:
             message.reply_text(self.get_random_response('remove_joke_invalid_id'))
             return
 
-        user_is_author = joke in user.jokes_submitted
+        user_is_author = joke.user_id == user.get_id()
         if not user_is_author:
             message.reply_text(self.get_random_response('remove_joke_invalid_id'))
             return
 
-        user_data['joke_to_remove'] = joke
+        user_data['joke_to_remove_id'] = joke.get_id()
         reply_message = '{joke}\n{confirm}'.format(joke=joke.get_body(), confirm=self.get_random_response('remove_joke_confirm'))
         message.reply_text(reply_message)
         self.display_confirmation_keyboard(bot, update)
@@ -456,49 +701,109 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         """
         message = update.message
 
-        joke = user_data['joke_to_remove']
-        self.session.delete(joke)
+        joke = self.get_joke(user_data.pop('joke_to_remove_id', None))
+        if joke is None:  # removed in the meantime
+            self.display_menu_keyboard(bot, update, self.get_random_response('remove_joke_invalid_id'))
+            return
+        joke_id = joke.get_id()
+        joke_was_approved = joke.is_approved()
+        self.delete_joke(joke)
         self.session.commit()
+        self.register_write(message.chat.id)
+        if not joke_was_approved:
+            self.stats_rollups.record('jokes_withdrawn')
+        self.forget_jokes([joke_id])
 
         self.display_menu_keyboard(bot, update, self.get_random_response('remove_joke_success'))
 
     def display_random_joke(self, bot, update, user_data):
         """
-        Display random joke
+        Display random joke the user hasn't voted for yet.
+
+        Jokes are chosen by `self.joke_ranking`, so jokes with better score are displayed more often. The next joke
+        is chosen by `self.joke_prefetcher` while the user reads this one, it's displayed if it's still valid.
         """
         message = update.message
 
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
 
-        # Check if database is not empty
-        all_jokes = self.session.query(Joke).filter_by(approved=True).all()
-        try:
-            joke = all_jokes[0]
-        except IndexError:
+        # The joke is chosen on the read session, but loaded from `self.session` - user votes for it
+        with self.update_tracer.phase('select'):
+            start = time.perf_counter()
+            read_session = self.get_read_session(user.get_id())
+            random_joke = None
+            outcome = 'miss'
+            prefetched_joke_id = self.joke_prefetcher.take(user.get_id())
+            if prefetched_joke_id is not None:
+                # Joke could have been removed or voted for since it was chosen
+                outcome = 'stale'
+                if prefetched_joke_id != user_data.get('last_joke_id') and \
+                        self.can_vote(user, prefetched_joke_id, read_session):
+                    random_joke = self.get_ranked_joke(prefetched_joke_id)
+                    if random_joke is not None:
+                        outcome = 'hit'
+            if random_joke is None:
+                random_joke = self.choose_random_joke(user, read_session)
+            self.joke_prefetcher.record(outcome, time.perf_counter() - start)
+
+        if random_joke is None:
             message.reply_text(self.get_random_response('no_new_jokes'))
             return
 
-        shuffle(all_jokes)
-
-        for random_joke in all_jokes:
-            voted_already = random_joke in user.jokes_voted_for
-            user_is_author = random_joke in user.jokes_submitted
-            if not voted_already and not user_is_author:
-                # Remember last joke displayed - used in self.vote_for_joke to vote for right joke
-                user_data['last_joke'] = random_joke
-                # Display joke
-                message.reply_text(random_joke.get_body())
-                self.display_vote_keyboard(bot, update)
-                return
+        # Remember last joke displayed - used in self.vote_for_joke to vote for right joke
+        user_data['last_joke_id'] = random_joke.get_id()
+        # Display joke
+        message.reply_text(random_joke.get_body())
+        self.display_vote_keyboard(bot, update)
 
-        message.reply_text(self.get_random_response('no_new_jokes'))
+        # Candidates are sampled here, JokeRanking is used only by the dispatcher thread
+        candidate_ids = [self.joke_ranking.sample() for _ in range(self.RANDOM_JOKE_ATTEMPTS)]
+        self.joke_prefetcher.request(user.get_id(), [joke_id for joke_id in candidate_ids if joke_id is not None],
+                                     random_joke.get_id())
         return
 
+    def choose_random_joke(self, user, read_session):
+        """
+        Choose approved joke user can vote for, ranked jokes first
+
+        Returns:
+            Joke loaded from `self.session`, None if there is none
+        """
+        for _ in range(self.RANDOM_JOKE_ATTEMPTS):
+            joke_id = self.joke_ranking.sample()
+            if joke_id is None:  # no approved jokes
+                break
+
+            # Checked on the primary first, a joke missing there is dropped from the indexes
+            joke = self.get_ranked_joke(joke_id)
+            if joke is not None and self.can_vote(user, joke_id, read_session):
+                return joke
+
+        # User has voted for most of the highly ranked jokes
+        unvoted_joke = self.get_random_unvoted_joke(user, read_session)
+        if unvoted_joke is None:
+            return None
+        return self.session.query(Joke).get(unvoted_joke.get_id())
+
+    def get_ranked_joke(self, joke_id):
+        """
+        Load joke chosen from the in-memory indexes. A joke deleted in the meantime, e.g. by another shard, is
+        removed from them.
+
+        Returns:
+            Joke loaded from `self.session`, None if it doesn't exist or isn't approved
+        """
+        joke = self.session.query(Joke).get(joke_id)
+        if joke is not None and joke.is_approved():
+            return joke
+        self.forget_jokes([joke_id])
+        return None
+
     def display_random_favorite_joke(self, bot, update, user_data):
         """
         Display random joke from jokes user voted for.
@@ -507,21 +812,25 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         # Check if user is registered
         message = update.message
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
 
-        # Check if there are any jokes marked as favorite
-        all_favorite_jokes = user.get_jokes_voted_positive()
-        try:
-            random_joke = choice(all_favorite_jokes)
-        except IndexError:
-            message.reply_text(self.get_random_response('joke_no_favorite'))
+        # Only ids of favorite jokes are cached, body is loaded just for the chosen one
+        read_session = self.get_read_session(user.get_id())
+        favorite_joke_ids = self.get_favorite_joke_ids(user, user_data, read_session)
+        while len(favorite_joke_ids) > 0:
+            joke_id = choice(favorite_joke_ids)
+            joke_body = read_session.query(Joke.body).filter(Joke.id == joke_id).scalar()
+            if joke_body is None:  # joke was removed in the meantime
+                favorite_joke_ids.remove(joke_id)
+                continue
+
+            message.reply_text(joke_body)
             return
 
-        # Display joke
-        message.reply_text(random_joke.get_body())
+        message.reply_text(self.get_random_response('joke_no_favorite'))
         return
 
     def vote_for_joke(self, bot, update, user_data):
@@ -531,35 +840,73 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
 
-        # Check if is called after displaying a joke
-        try:
-            joke = user_data['last_joke']
-        except KeyError:
+        # Check if is called after displaying a joke, which wasn't removed since
+        joke_id = user_data.pop('last_joke_id', None)
+        joke = self.get_joke(joke_id) if joke_id is not None else None
+        if joke is None:
             self.display_menu_keyboard(bot, update, self.get_random_response('joke_no_current'))
             return
 
+        positive = 'hah' in message.text
         try:
-            if 'hah' in message.text:
-                user.vote_for_joke(joke, positive=True)
-            else:
-                user.vote_for_joke(joke, positive=False)
-
-            self.session.add(user, joke)
-            self.session.commit()
-
+            self.register_vote(user, joke, positive, user_data)
         except InvalidVote as e:
             logger.error(e)
 
         finally:
             self.display_menu_keyboard(bot, update, self.get_random_response('menu'))
-            del user_data['last_joke']
             return
 
+    def vote_from_button(self, bot, update, user_data, groups):
+        """
+        Register vote sent by the hah/nah buttons under the joke of the day, the buttons are removed afterwards.
+        """
+        query = update.callback_query
+        try:
+            user = self.get_user(query.message)
+        except UserDoesNotExist:
+            query.answer()
+            self.display_new_user_keyboard(bot, update)
+            return
+
+        joke_id, vote = groups
+        joke = self.get_joke(int(joke_id))
+        try:
+            if joke is None or not joke.is_approved():
+                raise InvalidVote('Joke ID={} was removed'.format(joke_id))
+            self.register_vote(user, joke, vote == 'hah', user_data)
+            query.answer(text=self.get_random_response('after_vote'))
+        except InvalidVote as e:
+            logger.error(e)
+            query.answer(text=self.get_random_response('vote_button_invalid'))
+        query.edit_message_reply_markup(reply_markup=None)
+
+    def register_vote(self, user, joke, positive, user_data):
+        """
+        Commit user's vote for joke and update everything which depends on vote counts
+
+        Raises:
+            InvalidVote: user has already voted for joke or is its author
+        """
+        user.vote_for_joke(joke, positive=positive)
+
+        self.session.add(user, joke)
+        self.session.commit()
+        self.register_write(user.get_id())
+        self.vote_log.record(user.get_id(), joke.get_id(), positive)
+        self.stats_rollups.record('votes')
+        if positive:
+            self.stats_rollups.record('votes_positive')
+        self.joke_search.update_vote_count(joke.get_id(), joke.get_vote_count())
+        self.inline_jokes.update_vote_count(joke.get_id(), joke.get_vote_count())
+        self.joke_ranking.register_vote(joke.get_id(), positive)
+        if positive and 'favorite_joke_ids' in user_data:
+            user_data['favorite_joke_ids'].append(joke.get_id())
 
     def my_jokes(self, bot, update, user_data):
         """
@@ -572,7 +919,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -583,11 +930,11 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
             first_joke_index = 0
 
         last_joke_index = first_joke_index + self.MY_JOKES_PER_MESSAGE
-        all_jokes = self.session.query(Joke).order_by(Joke.vote_count).all()
-        user_jokes = [joke for joke in all_jokes if user.is_author(joke)]
-        user_data['user_jokes'] = user_jokes
+        # Only the page is loaded, `my_jokes_index` is the cursor
+        page_jokes = self.get_user_jokes(user, self.get_read_session(user.get_id()),
+                                         offset=first_joke_index, limit=self.MY_JOKES_PER_MESSAGE)
 
-        reply_message, all_jokes_shown = self.format_jokes(user_jokes, first_joke_index, last_joke_index)
+        reply_message, all_jokes_shown = self.format_jokes(page_jokes, 0, self.MY_JOKES_PER_MESSAGE)
 
         if len(reply_message) == 0:
             if first_joke_index == 0: # user didn't submit any joke
@@ -616,7 +963,7 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         # Check if user is registered
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
@@ -634,20 +981,115 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         else:
             return ConversationHandler.END
 
+    def search_jokes(self, bot, update, user_data, args):
+        """
+        Search approved jokes, display first page of results.
+
+        Entry point in ConversationHandler, entered with `/search <terms>`.
+        Ids of matching jokes are stored in `search_results` key in `user_data`, so only jokes on the displayed page
+        are loaded from database.
+        """
+        message = update.message
+        terms = ' '.join(args)
+        if len(terms.strip()) == 0:
+            message.reply_text(self.get_random_response('search_no_terms'))
+            return ConversationHandler.END
+
+        user_data['search_results'] = self.joke_search.search(terms, self.SEARCH_RESULTS_MAX)
+        user_data['search_results_index'] = 0
+        if len(user_data['search_results']) == 0:
+            self.display_menu_keyboard(bot, update, self.get_random_response('search_no_results'))
+            return ConversationHandler.END
+
+        return self.display_joke_ids_page(bot, update, user_data, 'search_results', SJ_CHOOSING)
+
+    def search_jokes_choosing(self, bot, update, user_data):
+        return self.joke_ids_page_choosing(bot, update, user_data, 'search_results', SJ_CHOOSING)
+
+    def favorites(self, bot, update, user_data):
+        """
+        Display first page of jokes user voted for positively.
+
+        Entry point in ConversationHandler, entered with `/favorites`.
+        """
+        message = update.message
+        try:
+            user = self.get_user(message)
+        except UserDoesNotExist:
+            self.display_new_user_keyboard(bot, update)
+            return ConversationHandler.END
+
+        favorite_joke_ids = self.get_favorite_joke_ids(user, user_data)
+        if len(favorite_joke_ids) == 0:
+            self.display_menu_keyboard(bot, update, self.get_random_response('joke_no_favorite'))
+            return ConversationHandler.END
+
+        # Copy, so that the pages don't shift when user votes in the meantime
+        user_data['favorites'] = list(favorite_joke_ids)
+        user_data['favorites_index'] = 0
+        return self.display_joke_ids_page(bot, update, user_data, 'favorites', FJ_CHOOSING)
+
+    def favorites_choosing(self, bot, update, user_data):
+        return self.joke_ids_page_choosing(bot, update, user_data, 'favorites', FJ_CHOOSING)
+
+    def display_joke_ids_page(self, bot, update, user_data, key, next_state):
+        """
+        Display next page of jokes whose ids are stored in `user_data[key]`.
+
+        Index of the first joke on the page is stored in `user_data[key + '_index']`.
+        Uses `self.MY_JOKES_PER_MESSAGE` variable to get the number of jokes to be displayed.
+
+        Returns:
+            `next_state` if there are more jokes to be displayed, ConversationHandler.END otherwise
+        """
+        message = update.message
+        first_joke_index = user_data[key + '_index']
+        last_joke_index = first_joke_index + self.MY_JOKES_PER_MESSAGE
+
+        reply_message, all_jokes_shown = self.format_joke_ids(user_data[key], first_joke_index, last_joke_index)
+        if len(reply_message) > 0:
+            message.reply_text(reply_message)
+
+        if all_jokes_shown:
+            self.display_menu_keyboard(bot, update, self.get_random_response('my_jokes_all_jokes_shown'))
+            return ConversationHandler.END
+
+        user_data[key + '_index'] = last_joke_index
+        self.display_confirmation_keyboard(bot, update)
+        return next_state
+
+    def joke_ids_page_choosing(self, bot, update, user_data, key, next_state):
+        """
+        Process the response to confirmation keyboard displayed after `self.display_joke_ids_page`.
+        """
+        message = update.message
+        user_choice = message.text
+        try:
+            proceed = self.process_confirmation_response(update, user_choice)
+        except InvalidChoice:
+            message.reply_text(self.get_random_response('my_jokes_invalid_choice'))
+            return
+
+        if proceed:
+            return self.display_joke_ids_page(bot, update, user_data, key, next_state)
+
+        self.display_menu_keyboard(bot, update, self.get_random_response('menu'))
+        return ConversationHandler.END
+
     def profile(self, bot, update, user_data):
         """
         Display information about user.
         """
         message = update.message
         try:
-            user = self.get_user(message, user_data)
+            user = self.get_user(message)
         except UserDoesNotExist:
             self.display_new_user_keyboard(bot, update)
             return
 
-        all_users = self.session.query(User).order_by(User.score).all()
-        user_rank = all_users.index(user) + 1
-        jokes_submitted_count = len(user.get_jokes_submitted())
+        # Everything is read from the user's row, only the rank needs a count query
+        user_rank = self.get_user_rank(user, self.get_read_session(user.get_id()))
+        jokes_submitted_count = user.get_jokes_submitted_count()
         average_score = user.get_average_score()
 
         width = 10
@@ -670,15 +1112,15 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         user_id = message.from_user.id
         if user_id not in self.MODERATORS:
-            message.reply_text(self.get_random_response('permisson_denied'))
+            message.reply_text(self.get_random_response('permission_denied'))
             return ConversationHandler.END
 
-        unapproved_joke = self.session.query(Joke).filter_by(approved=False).order_by(Joke.id).first()
+        unapproved_joke = self.get_next_unapproved_joke()
         if unapproved_joke is None:
             self.remove_keyboard(bot, update, self.get_random_response('no_new_jokes'))
             return ConversationHandler.END
 
-        user_data['unapproved_joke'] = unapproved_joke
+        user_data['unapproved_joke_id'] = unapproved_joke.get_id()
         message.reply_text('{joke}  ({author})'.format(joke=unapproved_joke.get_body(), author=unapproved_joke.get_author().username))
         self.display_approval_keyboard(bot, update)
         return AJ_VOTED
@@ -692,33 +1134,446 @@ class HahOrNahBot(HahOrNahBotHelper, TelegramBotResponses):
         message = update.message
         assert '/approve' in message.text or '/remove' in message.text
 
-        unapproved_joke = user_data['unapproved_joke']
+        unapproved_joke = self.get_joke(user_data.pop('unapproved_joke_id', None))
+        if unapproved_joke is None:  # removed by another moderator or the author in the meantime
+            self.remove_keyboard(bot, update, self.get_random_response('no_new_jokes'))
+            self.display_confirmation_keyboard(bot, update)
+            return AJ_NEXT
         if '/approve' in message.text:
             unapproved_joke.approve()
             reply_text = self.get_random_response('approve_jokes_approved')
         elif '/remove' in message.text:
-            self.session.delete(unapproved_joke)
+            # Unapproved jokes aren't in the in-memory indexes
+            self.delete_joke(unapproved_joke)
             reply_text = self.get_random_response('approve_jokes_removed')
 
         self.session.commit()
+        self.register_write(message.chat.id)
+        self.stats_rollups.record('jokes_approved' if '/approve' in message.text else 'jokes_rejected')
+        if '/approve' in message.text:
+            self.joke_search.add_joke(unapproved_joke.get_id(), unapproved_joke.get_body(), unapproved_joke.get_vote_count())
+            self.joke_ranking.add_joke(unapproved_joke.get_id())
+            self.inline_jokes.add_joke(unapproved_joke.get_id(), unapproved_joke.get_body(),
+                                       unapproved_joke.get_vote_count())
 
         self.remove_keyboard(bot, update, reply_text)
         self.display_confirmation_keyboard(bot, update)
         return AJ_NEXT
 
+    def inline_query(self, bot, update):
+        """
+        Answer inline query `@HahOrNahBot <terms>` with approved jokes matching the terms, the best jokes if there
+        are no terms. Jokes come from memory, see app/InlineJokes.py.
+        """
+        query = update.inline_query
+        results = []
+        for joke_id, body in self.inline_jokes.search(query.query):
+            title = body if len(body) <= self.INLINE_TITLE_LENGTH else body[:self.INLINE_TITLE_LENGTH - 3] + '...'
+            results.append(InlineQueryResultArticle(id=str(joke_id), title=title,
+                                                    input_message_content=InputTextMessageContent(body)))
+        # Nothing is found while jokes are being loaded, Telegram mustn't cache that
+        query.answer(results, cache_time=self.INLINE_CACHE_TTL if len(results) > 0 else 0)
+
+    def show_metrics(self, bot, update):
+        """
+        Display metrics of this process to moderators
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        report = self.metrics.report()
+        message.reply_text(report if len(report) > 0 else 'No metrics recorded yet')
+
+    def start_profiler(self, bot, update, args):
+        """
+        Profile processing of updates and send the hottest frames per handler to moderator.
+
+        `/profiler` profiles for `self.PROFILER_SECONDS`, `/profiler 10` for 10 seconds, `/profiler 50 updates` the
+        next 50 updates. The report is sent as a message, or as a file if it's too long or `file` is added.
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+
+        count = int(args[0]) if len(args) > 0 and args[0].isdigit() else None
+        updates = count if 'updates' in args else None
+        seconds = None if updates is not None else count or self.PROFILER_SECONDS
+        as_file = 'file' in args
+        chat_id = message.chat_id
+
+        def send_report(report):
+            if as_file or len(report) > self.MESSAGE_LENGTH_MAX:
+                bot.send_document(chat_id=chat_id, document=io.BytesIO(report.encode('utf-8')),
+                                  filename='profile.txt')
+            else:
+                bot.send_message(chat_id=chat_id, text=report)
+
+        # Handlers run in the dispatcher thread, the one to profile
+        if not self.profiler.start(threading.get_ident(), send_report, seconds=seconds, updates=updates):
+            message.reply_text('Profiler is already running')
+        elif updates is not None:
+            message.reply_text('Profiling the next {} updates'.format(updates))
+        else:
+            message.reply_text('Profiling for {} seconds'.format(seconds))
+
+    def purge_user_command(self, bot, update, args):
+        """
+        Delete user with his jokes and votes, for moderators.
+
+        `/purge_user 123` shows what would be deleted, `/purge_user 123 confirm` deletes it.
+        """
+        message = update.message
+        if message.from_user.id not in self.MODERATORS:
+            message.reply_text(self.get_random_response('permission_denied'))
+            return
+        if len(args) == 0 or not args[0].isdigit():
+            message.reply_text('Usage: /purge_user <user id> [confirm]')
+            return
+
+        user_id = int(args[0])
+        user = self.session.query(User).get(user_id)
+        if user is None:
+            message.reply_text('There is no user {}'.format(user_id))
+            return
+        if 'confirm' not in args[1:]:
+            message.reply_text('User {} ({}) has {} jokes and {} votes. Send /purge_user {} confirm to delete '
+                               'them.'.format(user_id, user.get_username(), user.get_jokes_submitted_count(),
+                                              user.get_votes_cast_count(), user_id))
+            return
+
+        start = time.perf_counter()
+        deleted_joke_ids, voted_jokes = self.purge_user(user_id)
+        self.session.commit()
+        self.register_write(user_id)
+        self.chat_state_store.delete(user_id)
+        self.forget_jokes(deleted_joke_ids)
+        for joke_id, vote_count, positive in voted_jokes:
+            self.joke_search.update_vote_count(joke_id, vote_count)
+            self.inline_jokes.update_vote_count(joke_id, vote_count)
+            self.joke_ranking.unregister_vote(joke_id, positive)
+        logger.info('Purged user {} with {} jokes and {} votes in {:.3f} s'.format(
+            user_id, len(deleted_joke_ids), len(voted_jokes), time.perf_counter() - start))
+        message.reply_text('Deleted user {} with {} jokes and {} votes'.format(user_id, len(deleted_joke_ids),
+                                                                               len(voted_jokes)))
+
+    def forget_jokes(self, joke_ids):
+        """
+        Remove deleted jokes from in-memory indexes
+        """
+        for joke_id in joke_ids:
+            self.joke_search.remove_joke(joke_id)
+            self.joke_ranking.remove_joke(joke_id)
+            self.inline_jokes.remove_joke(joke_id)
+
+    def add_synced_joke(self, joke_id, body, vote_count, positive, total):
+        """
+        Add joke approved by another shard to in-memory indexes, see app/JokeIndexSync.py
+        """
+        self.joke_search.add_joke(joke_id, body, vote_count)
+        self.joke_ranking.add_joke(joke_id, positive, total)
+        self.inline_jokes.add_joke(joke_id, body, vote_count)
+
     def invalid_command_handler(self, bot, update):
         message = update.message
         self.display_menu_keyboard(bot, update, self.get_random_response('invalid_command'))
         return
 
-    def start_webhook(self, url, port):
-        self.updater.start_webhook(listen="0.0.0.0",
-                                   port=port,
-                                   url_path=self.token)
-        self.updater.bot.set_webhook(url + self.token)
-        self.updater.idle()
+    def drop_duplicate(self, bot, update):
+        """
+        Drop update Telegram delivered again, start tracing the others if they are sampled
+        """
+        if self.update_deduplicator is not None and self.update_deduplicator.is_duplicate(update.update_id):
+            raise DispatcherHandlerStop()
+        self.update_tracer.begin(update)
+
+    def limit_flood(self, bot, update):
+        """
+        Drop update of a chat which sends too many, before any handler touches the database
+        """
+        if update.inline_query is not None:
+            key = ('inline', update.inline_query.from_user.id)
+            allowed, _ = self.flood_control.check(key, None, cost=self.FLOOD_INLINE_COST)
+            if not allowed:
+                # Telegram shows a spinner until the query is answered
+                update.inline_query.answer([], cache_time=0)
+                self.update_tracer.discard()
+                raise DispatcherHandlerStop()
+            return
+
+        chat = update.effective_chat or update.effective_user
+        if chat is None:
+            return
+        command = CommandRouter.get_command(update)
+        allowed, warn = self.flood_control.check(chat.id, command)
+        if allowed:
+            return
+
+        # Further updates are dropped without a reply until the warning interval passes, replying costs requests too
+        if warn and update.message is not None:
+            update.message.reply_text(self.get_random_response('flood'))
+            self.flood_control.note_warning(chat.id)
+        elif warn and update.callback_query is not None:
+            update.callback_query.answer(text=self.get_random_response('flood'))
+            self.flood_control.note_warning(chat.id)
+        self.update_tracer.discard()
+        raise DispatcherHandlerStop()
+
+    def before_update(self, bot, update):
+        """
+        Make sure database engine exists before any handler uses it, end abandoned conversations and free state of
+        idle chats
+        """
+        self.update_in_progress = True
+        if self.engine is None:
+            self.startup_profile.mark('first update received')
+            with self.startup_profile.phase('create database engine (first update)'):
+                self.init_database()
+        self.chat_state_store.evict()
+        self.joke_index_sync.apply(self.add_synced_joke, self.forget_jokes)
+
+    def after_update(self, bot, update):
+        """
+        Release resources held while the update was processed
+        """
+        self.close_read_session()
+        if self.profiler.running:
+            self.profiler.count_update()
+        if update.effective_chat is not None:
+            self.joke_of_the_day.note_activity(update.effective_chat.id)
+        self.update_tracer.end()
+        self.update_in_progress = False
+
+    def get_user(self, message):
+        """
+        Same as `HahOrNahBotHelper.get_user`, timed in traces
+        """
+        with self.update_tracer.phase('get_user'):
+            return HahOrNahBotHelper.get_user(self, message)
+
+    def is_busy(self):
+        """
+        Returns:
+            bool: True while an update is processed or waiting, background sending yields to it
+        """
+        return self.update_in_progress or not self.updater.update_queue.empty()
+
+    def schedule_joke_of_the_day(self):
+        """
+        Send the joke of the day every day at `self.JOKE_OF_THE_DAY_TIME` and continue a broadcast interrupted by
+        a restart right away. Must be called in one process only.
+        """
+        self.updater.job_queue.run_daily(self.send_joke_of_the_day, self.JOKE_OF_THE_DAY_TIME,
+                                         name='joke_of_the_day')
+        self.updater.job_queue.run_once(self.resume_joke_of_the_day, 0, name='resume_joke_of_the_day')
+
+    def send_joke_of_the_day(self, bot, job):
+        self.init_database()
+        self.joke_of_the_day.start()
+
+    def resume_joke_of_the_day(self, bot, job):
+        self.init_database()
+        self.joke_of_the_day.resume()
+
+    def warm_up(self):
+        """
+        Initialize database in the background after the webhook is listening
+        """
+        with self.startup_profile.phase('database warm-up (background)'):
+            try:
+                self.warm_up_database()
+                self.inline_jokes.start_loading()
+            except Exception as e:
+                # The first update will try again
+                logger.error('Database warm-up failed: {}'.format(e))
+
+    def save_chat_state(self, bot, update):
+        """
+        Queue state of the chat the update came from to be persisted
+        """
+        self.update_tracer.switch('after')
+        user = update.effective_user
+        chat = update.effective_chat
+        if user is None or chat is None:
+            return
+        self.chat_state_store.save(user.id, chat.id)
+
+    def start_webhook(self, url, port, warm_up=True, print_startup_profile=False):
+        """
+        Arguments:
+            url: string, public url of the webhook without the token
+            port: int
+            warm_up: bool, initialize database in the background once the webhook is listening
+            print_startup_profile: bool, log duration of startup phases
+        """
+        self.chat_state_store.start()
+        self.vote_log.start()
+        self.stats_rollups.start()
+        self.joke_prefetcher.start()
+        self.update_tracer.start()
+        self.schedule_joke_of_the_day()
+        with self.startup_profile.phase('bind webhook'):
+            self.updater.start_webhook(listen="0.0.0.0",
+                                       port=port,
+                                       url_path=self.token)
+        self.startup_profile.mark('webhook listening')
+
+        warm_up_thread = threading.Thread(target=self.warm_up, name='warm_up', daemon=True)
+        if warm_up:
+            warm_up_thread.start()
+
+        with self.startup_profile.phase('set webhook'):
+            self.updater.bot.set_webhook(url + self.token)
+
+        if print_startup_profile:
+            if warm_up:
+                warm_up_thread.join()
+            logger.info('Startup profile:\n' + self.startup_profile.report())
+
+        self.wait_for_stop_signal()
+        self.drain(self.DRAIN_TIMEOUT)
         return
 
+    def start_shard(self, queue, drain_expired=None, joke_of_the_day=False):
+        """
+        Process updates received from the front process (see app/ShardedBot.py) until None is received
+
+        Arguments:
+            queue: multiprocessing.Queue of (update as dict, time.time() it was received, seconds receiving it took)
+            drain_expired: multiprocessing.Event, set by the front process when the time to drain is over.
+                Updates still queued are dropped then.
+            joke_of_the_day: bool, send the joke of the day from this shard
+        """
+        # The front process drops duplicates before routing updates
+        self.update_deduplicator = None
+        # Other shards approve and delete jokes too
+        self.init_database()
+        self.joke_index_sync.start()
+        self.chat_state_store.start()
+        self.vote_log.start()
+        self.stats_rollups.start()
+        self.joke_prefetcher.start()
+        self.update_tracer.start()
+        # Without this, jokes are loaded only when the first inline query comes
+        self.inline_jokes.start_loading()
+        if joke_of_the_day:
+            self.schedule_joke_of_the_day()
+            self.updater.job_queue.start()
+        dropped = 0
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if drain_expired is not None and drain_expired.is_set():
+                dropped += 1
+                continue
+            update_data, received, receive_seconds = item
+            self.update_tracer.note_received(update_data['update_id'], received, receive_seconds)
+            update = Update.de_json(update_data, self.updater.bot)
+            self.dispatcher.process_update(update)
+
+        self.metrics.set('shutdown.dropped_updates', dropped)
+        self.updater.job_queue.stop()
+        self.release()
+        logger.info('Shard stopped, dropped {} updates'.format(dropped))
+
     def start_local(self):
+        self.chat_state_store.start()
+        self.vote_log.start()
+        self.stats_rollups.start()
+        self.joke_prefetcher.start()
+        self.update_tracer.start()
+        self.schedule_joke_of_the_day()
         self.updater.start_polling()
-        self.updater.idle()
\ No newline at end of file
+        self.wait_for_stop_signal()
+        self.drain(self.DRAIN_TIMEOUT)
+
+    def wait_for_stop_signal(self):
+        """
+        Block until SIGINT, SIGTERM or SIGABRT is received. Replaces `Updater.idle`, which stops the updater right
+        in the signal handler without any time limit.
+        """
+        stop_requested = threading.Event()
+
+        def request_stop(signum, frame):
+            logger.info('Received signal {}, stopping'.format(signum))
+            stop_requested.set()
+
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, request_stop)
+        # Signal handlers run in the main thread between waits
+        while not stop_requested.wait(1):
+            pass
+
+    def drain(self, timeout):
+        """
+        Stop receiving updates, process the ones already accepted for at most `timeout` seconds, then write buffered
+        state and close database connections.
+
+        Updates still queued after `timeout` are dropped. The update in progress is never interrupted, if it's still
+        running when `Updater.stop` gives up waiting for it, its session is left alone.
+        Duration and dropped updates are recorded in `shutdown.*` metrics and logged.
+        """
+        start = time.perf_counter()
+        deadline = start + timeout
+
+        # Telegram sends updates which weren't accepted again, to the next process
+        if self.updater.httpd is not None:
+            self.updater.httpd.shutdown()
+            self.updater.httpd = None
+        self.updater.running = False  # polling stops after the current getUpdates
+        self.updater.job_queue.stop()
+
+        update_queue = self.updater.update_queue
+        while time.perf_counter() < deadline and (not update_queue.empty() or self.update_in_progress):
+            time.sleep(0.05)
+
+        dropped = 0
+        while True:
+            try:
+                update_queue.get_nowait()
+                dropped += 1
+            except Empty:
+                break
+
+        # Dispatcher finishes the update it's processing, then notices the stop within a second
+        stopper = threading.Thread(target=self.updater.stop, name='updater_stop', daemon=True)
+        stopper.start()
+        stopper.join(max(deadline - time.perf_counter(), 2))
+        abandoned = 1 if stopper.is_alive() and self.update_in_progress else 0
+
+        self.metrics.set('shutdown.drain_seconds', time.perf_counter() - start)
+        self.metrics.set('shutdown.dropped_updates', dropped)
+        self.metrics.set('shutdown.abandoned_updates', abandoned)
+        self.release(close_session=abandoned == 0)
+        logger.info('Drained in {:.2f} s, dropped {} updates, abandoned {} in progress'.format(
+            self.metrics.get('shutdown.drain_seconds'), dropped, abandoned))
+
+    def release(self, close_session=True):
+        """
+        Stop the joke of the day broadcast, write votes, chat states, stats and traces buffered in memory and close
+        database connections
+
+        Arguments:
+            close_session: bool, False if a handler may still be using `self.session`
+        """
+        # Progress of the broadcast is saved, the next start continues it
+        self.joke_of_the_day.stop()
+        self.joke_index_sync.stop()
+        self.joke_prefetcher.stop()
+        self.chat_state_store.stop()
+        self.vote_log.stop()
+        self.stats_rollups.stop()
+        self.update_tracer.stop()
+        if self.engine is None:
+            return
+
+        if close_session:
+            # Discards changes of an update which didn't commit
+            self.session.close()
+            self.close_read_session()
+        self.engine.dispose()
+        if self.replica_engine is not None:
+            self.replica_engine.dispose()
\ No newline at end of file
@@ -0,0 +1,242 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from app.JokeSearch import TOKEN_PATTERN
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+
+class InlineJokes:
+    """
+    Class to answer inline queries (`@HahOrNahBot cat`) from memory, without touching the database.
+
+    Bodies of approved jokes are kept in memory together with an inverted index and a sorted list of its tokens.
+    All terms of a query have to match, the last one as a prefix, because the user is still typing it. Matches
+    are ordered by vote count.
+
+    Answers are cached per query for `cache_ttl` seconds. A search taking longer than `budget` seconds is
+    abandoned and the best jokes are returned instead, they are recomputed at most every `cache_ttl` seconds.
+
+    Jokes are loaded by a background thread with its own session, `start_loading` is called by the warm-up or
+    by the first query; queries are answered with nothing until it's done. `add_joke`, `remove_joke` and
+    `update_vote_count` keep the index up to date, changes made while loading are applied once it's loaded.
+    Everything else runs in the dispatcher thread.
+    """
+    CACHE_SIZE = 1000  # queries cached at most, least recently used are dropped
+    CHECK_EVERY = 256  # jokes or tokens processed between checks of the budget
+
+    def __init__(self, Session, metrics, cache_ttl, budget, results_max):
+        """
+        Arguments:
+            Session: sessionmaker, used to create session for the loading thread
+            metrics: Metrics, hits, misses and fallbacks are counted in it
+            cache_ttl: float, seconds answers and the best jokes are cached for
+            budget: float, seconds a search may take before the best jokes are returned instead
+            results_max: int, jokes returned at most
+        """
+        self.Session = Session
+        self.metrics = metrics
+        self.cache_ttl = cache_ttl
+        self.budget = budget
+        self.results_max = results_max
+
+        self.loaded = False
+        self.loading = False
+        self.changes = []  # (method name, arguments) made while loading
+        self.lock = threading.Lock()
+
+        self.index = {}  # token -> set of joke ids
+        self.tokens = []  # sorted tokens of self.index, for prefix lookup
+        self.joke_tokens = {}  # joke id -> set of tokens
+        self.bodies = {}  # joke id -> body
+        self.vote_counts = {}  # joke id -> vote count
+
+        self.cache = OrderedDict()  # normalized query -> (expiry, list of joke ids), least recently used first
+        self.top_joke_ids = []
+        self.top_expires = 0
+
+    def tokenize(self, text):
+        """
+        Returns:
+            list of lowercase words, in the order they appear in text
+        """
+        return TOKEN_PATTERN.findall(text.lower())
+
+    def start_loading(self):
+        """
+        Load approved jokes in a background thread, if they weren't loaded yet
+        """
+        with self.lock:
+            if self.loaded or self.loading:
+                return
+            self.loading = True
+        threading.Thread(target=self.load, name='inline_jokes_load', daemon=True).start()
+
+    def load(self):
+        start = time.perf_counter()
+        session = self.Session()
+        try:
+            rows = session.query(Joke.id, Joke.body, Joke.vote_count).filter(Joke.approved == True).all()
+        except Exception as e:
+            logger.error('Loading jokes for inline queries failed: {}'.format(e))
+            with self.lock:
+                self.loading = False
+                self.changes = []
+            return
+        finally:
+            session.close()
+
+        with self.lock:
+            for joke_id, body, vote_count in rows:
+                self.index_joke(joke_id, body, vote_count, keep_sorted=False)
+            self.tokens = sorted(self.index)
+            for method, arguments in self.changes:
+                getattr(self, method)(*arguments)
+            self.changes = []
+            self.loading = False
+            self.loaded = True
+        self.metrics.set('inline.jokes', len(self.bodies))
+        logger.info('Inline jokes loaded, {} jokes in {:.2f} s'.format(len(self.bodies), time.perf_counter() - start))
+
+    def index_joke(self, joke_id, body, vote_count, keep_sorted=True):
+        """
+        Arguments:
+            keep_sorted: bool, False while loading, `self.tokens` is sorted once afterwards
+        """
+        self.unindex_joke(joke_id)
+        tokens = set(self.tokenize(body))
+        self.joke_tokens[joke_id] = tokens
+        self.bodies[joke_id] = body
+        self.vote_counts[joke_id] = vote_count or 0
+        for token in tokens:
+            if token not in self.index:
+                self.index[token] = set()
+                if keep_sorted:
+                    insort(self.tokens, token)
+            self.index[token].add(joke_id)
+
+    def unindex_joke(self, joke_id):
+        self.bodies.pop(joke_id, None)
+        self.vote_counts.pop(joke_id, None)
+        for token in self.joke_tokens.pop(joke_id, ()):
+            joke_ids = self.index[token]
+            joke_ids.discard(joke_id)
+            if len(joke_ids) == 0:
+                del self.index[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+
+    def change(self, method, *arguments):
+        """
+        Call `method` now if jokes are loaded, after loading if they are being loaded
+        """
+        with self.lock:
+            if self.loading:
+                self.changes.append((method, arguments))
+            elif self.loaded:
+                getattr(self, method)(*arguments)
+
+    def add_joke(self, joke_id, body, vote_count):
+        """
+        Make approved joke searchable
+        """
+        self.change('index_joke', joke_id, body, vote_count)
+        self.cache.clear()
+
+    def remove_joke(self, joke_id):
+        """
+        Remove joke from index, if it's there
+        """
+        self.change('unindex_joke', joke_id)
+        # Cached answers mustn't display it anymore
+        self.cache.clear()
+
+    def update_vote_count(self, joke_id, vote_count):
+        """
+        Keep vote count used for ordering up to date, cached answers keep their order until they expire
+        """
+        self.change('set_vote_count', joke_id, vote_count)
+
+    def set_vote_count(self, joke_id, vote_count):
+        if joke_id in self.vote_counts:
+            self.vote_counts[joke_id] = vote_count
+
+    def get_top_joke_ids(self, now):
+        if now >= self.top_expires:
+            self.top_joke_ids = heapq.nlargest(self.results_max, self.vote_counts, key=self.vote_counts.get)
+            self.top_expires = now + self.cache_ttl
+        return self.top_joke_ids
+
+    def get_matches(self, terms, deadline):
+        """
+        Returns:
+            set of ids of jokes matching all terms, the last one as a prefix, None if deadline passed
+        """
+        candidates = []
+        for term in terms[:-1]:
+            candidates.append(self.index.get(term, set()))
+        prefix = terms[-1]
+        prefixed = set()
+        position = bisect_left(self.tokens, prefix)
+        checked = 0
+        while position < len(self.tokens) and self.tokens[position].startswith(prefix):
+            prefixed.update(self.index[self.tokens[position]])
+            position += 1
+            checked += 1
+            if checked % self.CHECK_EVERY == 0 and time.perf_counter() > deadline:
+                return None
+        candidates.append(prefixed)
+
+        candidates.sort(key=len)
+        matches = set(candidates[0])
+        for joke_ids in candidates[1:]:
+            matches &= joke_ids
+            if len(matches) == 0:
+                break
+        return matches
+
+    def search(self, query):
+        """
+        Find approved jokes for inline query
+
+        Returns:
+            list of (joke id, body) tuples, best first
+        """
+        start = time.perf_counter()
+        deadline = start + self.budget
+        self.metrics.increment('inline.queries')
+        if not self.loaded:
+            self.start_loading()
+            self.metrics.increment('inline.not_loaded')
+            return []
+
+        terms = self.tokenize(query)
+        key = ' '.join(terms)
+        cached = self.cache.get(key)
+        if cached is not None and cached[0] > start:
+            self.cache.move_to_end(key)
+            self.metrics.increment('inline.cache_hits')
+            return self.get_results(cached[1])
+
+        if len(terms) == 0:
+            joke_ids = self.get_top_joke_ids(start)
+        else:
+            matches = self.get_matches(terms, deadline)
+            if matches is None or time.perf_counter() > deadline:
+                # Not cached, the query may be answered in time when it's sent again
+                self.metrics.increment('inline.fallbacks')
+                return self.get_results(self.get_top_joke_ids(start))
+            joke_ids = heapq.nlargest(self.results_max, matches, key=self.vote_counts.get)
+
+        self.cache[key] = (start + self.cache_ttl, joke_ids)
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return self.get_results(joke_ids)
+
+    def get_results(self, joke_ids):
+        return [(joke_id, self.bodies[joke_id]) for joke_id in joke_ids if joke_id in self.bodies]
@@ -0,0 +1,129 @@
+import logging
+import threading
+
+from sqlalchemy import func, distinct
+
+from app.models import Joke, association_table
+
+logger = logging.getLogger(__name__)
+
+
+class JokeIndexSync:
+    """
+    Class to show approvals and deletions made by other processes in the in-memory indexes of this one.
+
+    Every shard keeps its own JokeRanking, JokeSearch and InlineJokes, which are updated only by events handled in
+    the same process. A background thread reads ids of approved jokes every `interval` seconds and compares them to
+    the previous read: jokes which appeared are read with their votes, ids which disappeared are dropped. The
+    indexes aren't thread-safe, so the changes are applied by the dispatcher thread with `apply`.
+
+    Changes made by this process are read too, applying them again changes nothing.
+    """
+    DETAILS_CHUNK_SIZE = 500  # ids of jokes which appeared read at once
+
+    def __init__(self, Session, interval, metrics):
+        """
+        Arguments:
+            Session: sessionmaker, used to create session for the background thread
+            interval: float, seconds between reads
+            metrics: Metrics, applied changes are counted in it
+        """
+        self.Session = Session
+        self.interval = interval
+        self.metrics = metrics
+
+        self.approved_ids = None  # ids of approved jokes at the previous read, None before the first one
+        self.added = {}  # joke id -> (body, vote count, positive votes, all votes) not applied yet
+        self.removed = set()  # ids of jokes not applied yet
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def read_details(self, session, joke_ids):
+        """
+        Returns:
+            dict: joke id -> (body, vote count, positive votes, all votes)
+        """
+        # Positive vote adds two rows to association table, negative one
+        rows_count = func.count(association_table.c.users_id)
+        voters_count = func.count(distinct(association_table.c.users_id))
+        details = {}
+        joke_ids = sorted(joke_ids)
+        for start in range(0, len(joke_ids), self.DETAILS_CHUNK_SIZE):
+            rows = session.query(Joke.id, Joke.body, Joke.vote_count, rows_count, voters_count).\
+                outerjoin(association_table, association_table.c.jokes_id == Joke.id).\
+                filter(Joke.id.in_(joke_ids[start:start + self.DETAILS_CHUNK_SIZE])).\
+                filter(Joke.approved == True).\
+                group_by(Joke.id, Joke.body, Joke.vote_count).all()
+            for joke_id, body, vote_count, rows, voters in rows:
+                details[joke_id] = (body, vote_count, rows - voters, voters)
+        return details
+
+    def read(self):
+        """
+        Read ids of approved jokes and queue the changes since the previous read
+        """
+        session = self.Session()
+        try:
+            approved_ids = set(joke_id for joke_id, in session.query(Joke.id).filter(Joke.approved == True))
+            if self.approved_ids is None:
+                # Indexes are loaded from database after this
+                self.approved_ids = approved_ids
+                return
+            added = self.read_details(session, approved_ids - self.approved_ids)
+        except Exception as e:
+            logger.error('Reading approved jokes failed: {}'.format(e))
+            return
+        finally:
+            session.close()
+
+        removed = self.approved_ids - approved_ids
+        self.approved_ids = approved_ids
+        with self.lock:
+            for joke_id in removed:
+                self.added.pop(joke_id, None)
+                self.removed.add(joke_id)
+            for joke_id, details in added.items():
+                self.removed.discard(joke_id)
+                self.added[joke_id] = details
+
+    def apply(self, on_added, on_removed):
+        """
+        Apply queued changes, called by the dispatcher thread
+
+        Arguments:
+            on_added: function called with joke id, body, vote count, positive votes and all votes of every joke
+                which was approved
+            on_removed: function called with list of ids of jokes which were deleted
+        """
+        if len(self.added) == 0 and len(self.removed) == 0:
+            return
+        with self.lock:
+            added = self.added
+            removed = self.removed
+            self.added = {}
+            self.removed = set()
+
+        for joke_id, (body, vote_count, positive, total) in added.items():
+            on_added(joke_id, body, vote_count, positive, total)
+        if len(removed) > 0:
+            on_removed(list(removed))
+        self.metrics.increment('joke_sync.added', len(added))
+        self.metrics.increment('joke_sync.removed', len(removed))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.read()
+
+    def start(self):
+        """
+        Read the approved jokes the next reads are compared to and start background thread
+        """
+        self.read()
+        self.thread = threading.Thread(target=self.run, name='joke_index_sync', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,385 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+from app.TokenBucket import TokenBucket
+from app.models import Broadcast, Joke, User
+
+logger = logging.getLogger(__name__)
+
+# callback_data of the inline hah/nah buttons, handled by HahOrNahBot.vote_from_button
+VOTE_CALLBACK_FORMAT = 'vote:{joke_id}:{choice}'
+VOTE_CALLBACK_PATTERN = r'^vote:(\d+):(hah|nah)$'
+
+
+class JokeOfTheDay:
+    """
+    Class to send the best recent approved joke to every registered user, with inline hah/nah buttons.
+
+    User ids are read in chunks of `chunk_size` ordered by id (keyset pagination), the users table is never
+    loaded at once. After every chunk the last user id and the counts are written to the `broadcasts` row, so a
+    broadcast interrupted by a crash or a restart resumes right after it. Only the process whose claim
+    (`claimed_until`) is valid sends. It renews the claim every `RENEW_SECONDS`, also while waiting, and writes
+    progress only while `claimed_by` is still its token; once another process took the broadcast over it stops.
+
+    Messages are sent by a background thread. It waits for a global token bucket (`rate` messages per second),
+    for `chat_interval` seconds after the bot last answered the chat, and for `retry_after` of 429 responses.
+    While `is_busy()` is True it doesn't send at all, so interactive updates go first.
+    """
+    RECENT_JOKES = 500  # the joke is the best of this many most recently added approved jokes
+    CLAIM_SECONDS = 60
+    RENEW_SECONDS = 20  # claim is renewed this often while sending, longer waits are split
+    SEND_ATTEMPTS = 3
+    BUSY_PAUSE = 0.05  # seconds to wait while interactive updates are processed
+    PROGRESS_INTERVAL = 30  # seconds between progress log lines
+
+    def __init__(self, bot, Session, metrics, is_busy, header, rate, chunk_size, chat_interval):
+        """
+        Arguments:
+            bot: telegram.Bot
+            Session: sessionmaker, used to create session for the background thread
+            metrics: Metrics, progress is reported to it
+            is_busy: function, returns True while interactive updates are waiting or processed
+            header: string, line displayed above the joke
+            rate: float, messages per second at most
+            chunk_size: int, user ids read from database at once
+            chat_interval: float, seconds between an interactive message to a chat and the broadcast one
+        """
+        self.bot = bot
+        self.Session = Session
+        self.metrics = metrics
+        self.is_busy = is_busy
+        self.header = header
+        self.rate = rate
+        self.chunk_size = chunk_size
+        self.chat_interval = chat_interval
+
+        self.recent_chats = OrderedDict()  # chat id -> time.monotonic() of the last interactive update
+        self.claim_token = None  # claimed_by of the broadcast being sent
+        self.claim_lost = False
+        self.claim_renewed = 0  # time.monotonic() the claim was last renewed
+        self.retry_until = 0  # time.monotonic() until which Telegram asked not to send, after a 429
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def get_name(day=None):
+        """
+        Returns:
+            string: name of the broadcast of `day` (UTC today by default)
+        """
+        day = day if day is not None else datetime.utcnow().date()
+        return 'joke_of_the_day {}'.format(day.isoformat())
+
+    def note_activity(self, chat_id):
+        """
+        Remember that the bot is answering chat now. Called by the dispatcher thread after every update.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.recent_chats.pop(chat_id, None)
+            self.recent_chats[chat_id] = now
+            while len(self.recent_chats) > 0:
+                oldest_chat_id, oldest = next(iter(self.recent_chats.items()))
+                if now - oldest <= self.chat_interval:
+                    break
+                del self.recent_chats[oldest_chat_id]
+
+    def get_chat_wait(self, chat_id, now):
+        with self.lock:
+            last_activity = self.recent_chats.get(chat_id)
+        if last_activity is None:
+            return 0
+        return max(0, last_activity + self.chat_interval - now)
+
+    def pick_joke(self, session):
+        """
+        Returns:
+            int: id of the recent approved joke with the most votes which wasn't broadcast yet, None if there is none
+        """
+        recent = session.query(Joke.id, Joke.vote_count).\
+            filter(Joke.approved == True).\
+            order_by(Joke.id.desc()).\
+            limit(self.RECENT_JOKES).subquery()
+        broadcast_joke_ids = session.query(Broadcast.joke_id).filter(Broadcast.joke_id != None)
+        return session.query(recent.c.id).\
+            filter(~recent.c.id.in_(broadcast_joke_ids)).\
+            order_by(recent.c.vote_count.desc(), recent.c.id.desc()).\
+            limit(1).scalar()
+
+    def claim(self, session, name):
+        """
+        Create broadcast `name` or take over an unfinished one whose claim expired
+
+        Returns:
+            Broadcast, None if it's finished, claimed by another process or there is no joke to send
+        """
+        now = datetime.utcnow()
+        claimed_until = now + timedelta(seconds=self.CLAIM_SECONDS)
+        self.claim_token = uuid.uuid4().hex
+        self.claim_renewed = time.monotonic()
+        self.claim_lost = False
+        broadcast = session.query(Broadcast).get(name)
+        if broadcast is None:
+            joke_id = self.pick_joke(session)
+            if joke_id is None:
+                logger.info('No joke for broadcast {}'.format(name))
+                return None
+            session.add(Broadcast(name=name, joke_id=joke_id, sent=0, failed=0, started_at=now,
+                                  claimed_until=claimed_until, claimed_by=self.claim_token))
+            try:
+                session.commit()
+            except IntegrityError:  # created by another process in the meantime
+                session.rollback()
+                return None
+            return session.query(Broadcast).get(name)
+
+        if broadcast.finished_at is not None:
+            return None
+        claimed = session.query(Broadcast).\
+            filter(Broadcast.name == name).\
+            filter(Broadcast.finished_at == None).\
+            filter(or_(Broadcast.claimed_until == None, Broadcast.claimed_until < now)).\
+            update({'claimed_until': claimed_until, 'claimed_by': self.claim_token}, synchronize_session=False)
+        session.commit()
+        if claimed == 0:
+            return None
+        session.refresh(broadcast)
+        return broadcast
+
+    def update_claimed(self, session, name, values):
+        """
+        Update broadcast row if this process still holds its claim
+
+        Returns:
+            bool: False if another process took the broadcast over
+        """
+        if self.claim_lost:
+            return False
+        updated = session.query(Broadcast).\
+            filter(Broadcast.name == name).\
+            filter(Broadcast.claimed_by == self.claim_token).\
+            update(values, synchronize_session=False)
+        session.commit()
+        self.claim_renewed = time.monotonic()
+        if updated == 0:
+            self.claim_lost = True
+            logger.warning('Broadcast {} was taken over by another process'.format(name))
+            self.metrics.increment('broadcast.claim_lost')
+            return False
+        return True
+
+    def renew(self, session, name):
+        """
+        Extend the claim, if RENEW_SECONDS passed since it was last renewed
+
+        Returns:
+            bool: False if another process took the broadcast over
+        """
+        if time.monotonic() - self.claim_renewed < self.RENEW_SECONDS:
+            return True
+        claimed_until = datetime.utcnow() + timedelta(seconds=self.CLAIM_SECONDS)
+        return self.update_claimed(session, name, {'claimed_until': claimed_until})
+
+    def checkpoint(self, session, name, last_user_id, sent, failed, finished=False, release=False):
+        """
+        Write progress since the last checkpoint and renew the claim
+
+        Returns:
+            bool: False if another process took the broadcast over, nothing is written then
+        """
+        now = datetime.utcnow()
+        values = {'last_user_id': last_user_id,
+                  'sent': Broadcast.sent + sent,
+                  'failed': Broadcast.failed + failed,
+                  'claimed_until': None if finished or release else now + timedelta(seconds=self.CLAIM_SECONDS)}
+        if finished:
+            values['finished_at'] = now
+        return self.update_claimed(session, name, values)
+
+    def wait_for_turn(self, chat_id, keep_claim):
+        """
+        Wait until a message can be sent to chat
+
+        Arguments:
+            keep_claim: function renewing the claim, returns False if it was lost
+
+        Returns:
+            bool: False if the broadcast was stopped or taken over meanwhile
+        """
+        while not self.stopped.is_set():
+            if not keep_claim():
+                return False
+            now = time.monotonic()
+            wait = max(0, self.retry_until - now)
+            if wait == 0:
+                wait = self.get_chat_wait(chat_id, now)
+            if wait == 0 and self.is_busy():
+                wait = self.BUSY_PAUSE
+            if wait == 0:
+                wait = self.bucket.take(now=now)
+            if wait == 0:
+                return True
+            # The claim would expire during a long wait
+            self.stopped.wait(min(wait, self.RENEW_SECONDS))
+        return False
+
+    def send(self, chat_id, text, reply_markup, keep_claim):
+        """
+        Arguments:
+            keep_claim: function renewing the claim, returns False if it was lost
+
+        Returns:
+            bool: True if the message was sent, False if sending failed, None if the broadcast was stopped or taken
+                over
+        """
+        for attempt in range(self.SEND_ATTEMPTS):
+            if not self.wait_for_turn(chat_id, keep_claim):
+                return None
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+                return True
+            except RetryAfter as e:
+                self.metrics.increment('broadcast.retry_after')
+                self.retry_until = time.monotonic() + e.retry_after
+            except (Unauthorized, BadRequest) as e:  # user blocked the bot or deleted his account
+                logger.debug('Broadcast to {} failed: {}'.format(chat_id, e))
+                return False
+            except NetworkError as e:
+                logger.warning('Broadcast to {} failed: {}'.format(chat_id, e))
+        return False
+
+    def report_progress(self, name, started, sent, failed, remaining):
+        elapsed = time.monotonic() - started
+        messages_per_second = (sent + failed) / elapsed if elapsed > 0 else 0
+        eta = remaining / messages_per_second if messages_per_second > 0 else None
+        self.metrics.set('broadcast.messages_per_second', messages_per_second)
+        self.metrics.set('broadcast.remaining', remaining)
+        self.metrics.set('broadcast.eta_seconds', eta)
+        logger.info('Broadcast {}: sent {}, failed {}, {:.1f} messages/s, {} users left, ETA {}'.format(
+            name, sent, failed, messages_per_second, remaining, '-' if eta is None else '{:.0f} s'.format(eta)))
+
+    def send_all(self, session, broadcast):
+        """
+        Send broadcast to users after its `last_user_id`, checkpointing after every chunk
+        """
+        name = broadcast.name
+        joke = session.query(Joke).get(broadcast.joke_id)
+        if joke is None or not joke.is_approved():
+            logger.info('Joke of broadcast {} was removed'.format(name))
+            self.checkpoint(session, name, broadcast.last_user_id, 0, 0, finished=True)
+            return
+
+        text = '{}\n\n{}'.format(self.header, joke.get_body())
+        reply_markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton('hah', callback_data=VOTE_CALLBACK_FORMAT.format(joke_id=joke.get_id(), choice='hah')),
+            InlineKeyboardButton('nah', callback_data=VOTE_CALLBACK_FORMAT.format(joke_id=joke.get_id(), choice='nah')),
+        ]])
+
+        last_user_id = broadcast.last_user_id
+        remaining_query = session.query(func.count(User.id))
+        if last_user_id is not None:
+            remaining_query = remaining_query.filter(User.id > last_user_id)
+        remaining = remaining_query.scalar()
+        session.commit()
+
+        self.bucket = TokenBucket(self.rate, max(1, self.rate / 10))
+        keep_claim = lambda: self.renew(session, name)
+        started = time.monotonic()
+        last_report = started
+        total_sent, total_failed = 0, 0
+        while True:
+            query = session.query(User.id)
+            if last_user_id is not None:
+                query = query.filter(User.id > last_user_id)
+            user_ids = [user_id for user_id, in query.order_by(User.id).limit(self.chunk_size)]
+            session.commit()  # don't keep a transaction open while sending
+            if len(user_ids) == 0:
+                self.checkpoint(session, name, last_user_id, 0, 0, finished=True)
+                self.report_progress(name, started, total_sent, total_failed, 0)
+                logger.info('Broadcast {} finished'.format(name))
+                return
+
+            sent, failed = 0, 0
+            for user_id in user_ids:
+                result = self.send(user_id, text, reply_markup, keep_claim)
+                if result is None:
+                    break
+                if result:
+                    sent += 1
+                else:
+                    failed += 1
+                last_user_id = user_id
+
+            stopped = self.stopped.is_set()
+            if not self.checkpoint(session, name, last_user_id, sent, failed, release=stopped):
+                logger.info('Broadcast {} stopped after user {}, another process continues it'.format(
+                    name, last_user_id))
+                return
+            self.metrics.increment('broadcast.sent', sent)
+            self.metrics.increment('broadcast.failed', failed)
+            total_sent += sent
+            total_failed += failed
+            remaining = max(0, remaining - sent - failed)
+            if stopped:
+                logger.info('Broadcast {} stopped, it continues after user {}'.format(name, last_user_id))
+                return
+            if time.monotonic() - last_report >= self.PROGRESS_INTERVAL:
+                self.report_progress(name, started, total_sent, total_failed, remaining)
+                last_report = time.monotonic()
+
+    def run(self, name):
+        session = self.Session()
+        try:
+            broadcast = self.claim(session, name)
+            if broadcast is not None:
+                logger.info('Broadcast {} of joke {} started after user {}'.format(
+                    name, broadcast.joke_id, broadcast.last_user_id))
+                self.send_all(session, broadcast)
+        except Exception:
+            logger.exception('Broadcast {} failed'.format(name))
+            session.rollback()
+        finally:
+            session.close()
+
+    def start(self, name=None):
+        """
+        Send broadcast `name`, today's by default, in a background thread. Does nothing if one is being sent.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, args=(name or self.get_name(),), name='joke_of_the_day',
+                                       daemon=True)
+        self.thread.start()
+
+    def resume(self):
+        """
+        Continue the most recent unfinished broadcast, e.g. after a restart
+        """
+        session = self.Session()
+        try:
+            name = session.query(Broadcast.name).\
+                filter(Broadcast.finished_at == None).\
+                order_by(Broadcast.started_at.desc()).limit(1).scalar()
+        finally:
+            session.close()
+        if name is not None:
+            self.start(name)
+
+    def stop(self):
+        """
+        Stop sending, progress is written so the broadcast can be resumed
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,174 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from app.models import User
+
+logger = logging.getLogger(__name__)
+
+
+class JokePrefetcher:
+    """
+    Class to choose the next joke for a user in the background, while he reads the current one and votes.
+
+    `request` is called by the dispatcher thread right after a joke is displayed, with candidate ids already sampled
+    from JokeRanking (which isn't thread-safe). The background thread checks the candidates with its own session
+    and falls back to a random unvoted joke, the same way `display_random_joke` does. Only the joke id is kept.
+    `take` hands it to the next /random_joke, which revalidates it before displaying it, because the joke may have
+    been removed or voted for meanwhile.
+
+    Requests of one user replace each other. At most `results_max` chosen ids are kept, chosen ids older than
+    `max_age` seconds are dropped.
+    """
+    SAMPLES = 100  # moving averages of selection time are taken over about this many requests
+    COUNTERS = {'hit': 'prefetch.hits', 'stale': 'prefetch.stale', 'miss': 'prefetch.misses'}
+
+    def __init__(self, helper, Session, attempts, results_max, max_age, metrics):
+        """
+        Arguments:
+            helper: HahOrNahBotHelper, its queries are used with the session of the background thread
+            Session: sessionmaker, used to create session for the background thread
+            attempts: int, candidates checked before falling back to a database query
+            results_max: int, chosen ids kept at most
+            max_age: float, seconds a chosen id is kept for
+            metrics: Metrics, hits, misses and time saved are reported to it
+        """
+        self.helper = helper
+        self.Session = Session
+        self.attempts = attempts
+        self.results_max = results_max
+        self.max_age = max_age
+        self.metrics = metrics
+
+        self.pending = OrderedDict()  # user id -> (candidate ids, excluded joke id), oldest first
+        self.results = OrderedDict()  # user id -> (joke id, time.monotonic() it was chosen), oldest first
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+        self.hits, self.misses, self.stale = 0, 0, 0
+        self.select_seconds = None  # moving averages of serving a joke without and with a prefetched one
+        self.hit_seconds = None
+
+    def request(self, user_id, candidate_ids, exclude_id):
+        """
+        Choose next joke for user in the background
+
+        Arguments:
+            candidate_ids: list of ids sampled from JokeRanking, checked in order
+            exclude_id: int, id of the joke displayed now
+        """
+        with self.lock:
+            self.pending.pop(user_id, None)
+            self.pending[user_id] = (candidate_ids, exclude_id)
+            # Nobody waits for them, dropping the oldest requests keeps memory bounded under load
+            while len(self.pending) > self.results_max:
+                self.pending.popitem(last=False)
+        self.wakeup.set()
+
+    def take(self, user_id):
+        """
+        Returns:
+            int: id of joke chosen for user, None if there is none
+        """
+        with self.lock:
+            result = self.results.pop(user_id, None)
+        if result is None:
+            return None
+        joke_id, chosen_at = result
+        if time.monotonic() - chosen_at > self.max_age:
+            return None
+        return joke_id
+
+    def choose(self, session, user_id, candidate_ids, exclude_id):
+        """
+        Returns:
+            int: id of a joke user can vote for, None if there is none
+        """
+        user = session.query(User).get(user_id)
+        if user is None:
+            return None
+        for joke_id in candidate_ids[:self.attempts]:
+            if joke_id != exclude_id and self.helper.can_vote(user, joke_id, session):
+                return joke_id
+        joke = self.helper.get_random_unvoted_joke(user, session)
+        if joke is None or joke.get_id() == exclude_id:
+            return None
+        return joke.get_id()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.wakeup.wait()
+            self.wakeup.clear()
+            # Created for every batch, the engine is bound to Session only after the database was initialized
+            session = self.Session()
+            try:
+                self.prefetch_pending(session)
+            finally:
+                session.close()
+
+    def prefetch_pending(self, session):
+        """
+        Choose jokes for users queued by `request` until there are none left
+        """
+        while not self.stopped.is_set():
+            with self.lock:
+                if len(self.pending) == 0:
+                    return
+                user_id, (candidate_ids, exclude_id) = self.pending.popitem(last=False)
+            try:
+                joke_id = self.choose(session, user_id, candidate_ids, exclude_id)
+                session.rollback()  # end transaction, the next choice sees fresh votes
+            except Exception as e:
+                logger.error('Prefetching joke for {} failed: {}'.format(user_id, e))
+                session.rollback()
+                continue
+            if joke_id is None:
+                continue
+            with self.lock:
+                self.results.pop(user_id, None)
+                self.results[user_id] = (joke_id, time.monotonic())
+                while len(self.results) > self.results_max:
+                    self.results.popitem(last=False)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='joke_prefetcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    @classmethod
+    def average(cls, average, value):
+        if average is None:
+            return value
+        return average + (value - average) / cls.SAMPLES
+
+    def record(self, outcome, seconds):
+        """
+        Record how a joke was served
+
+        Arguments:
+            outcome: string, 'hit' if the prefetched joke was displayed, 'stale' if it was no longer valid, 'miss'
+                if there was none
+            seconds: float, time it took to choose and load the joke
+        """
+        if outcome == 'hit':
+            self.hits += 1
+            self.hit_seconds = self.average(self.hit_seconds, seconds)
+        else:
+            if outcome == 'stale':
+                self.stale += 1
+            else:
+                self.misses += 1
+            self.select_seconds = self.average(self.select_seconds, seconds)
+
+        self.metrics.increment(self.COUNTERS[outcome])
+        self.metrics.set('prefetch.hit_rate', self.hits / (self.hits + self.misses + self.stale))
+        if self.hit_seconds is not None and self.select_seconds is not None:
+            self.metrics.set('prefetch.saved_ms', (self.select_seconds - self.hit_seconds) * 1000)
@@ -0,0 +1,273 @@
+import logging
+from math import sqrt
+from random import random, choice
+
+from sqlalchemy import func, distinct
+
+from app.models import Joke, association_table
+
+logger = logging.getLogger(__name__)
+
+
+def wilson_lower_bound(positive, total, z=1.96):
+    """
+    Lower bound of Wilson score confidence interval for a Bernoulli parameter.
+
+    Arguments:
+        positive: int, number of positive votes
+        total: int, number of all votes
+        z: float, quantile of the standard normal distribution (1.96 for 95% confidence)
+
+    Returns:
+        float between 0 and 1
+    """
+    if total == 0:
+        return 0
+
+    phat = positive / total
+    z2 = z * z
+    return (phat + z2 / (2 * total) - z * sqrt((phat * (1 - phat) + z2 / (4 * total)) / total)) / (1 + z2 / total)
+
+
+class FenwickTree:
+    """
+    Binary indexed tree over non-negative weights.
+
+    Supports updating a weight and sampling an index proportionally to its weight, both in O(log n).
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.weights = [0.0] * capacity
+        self.tree = [0.0] * (capacity + 1)
+
+    def grow(self, capacity):
+        """
+        Increase capacity, rebuilding the tree in O(n)
+        """
+        self.weights.extend([0.0] * (capacity - self.capacity))
+        self.capacity = capacity
+        self.tree = [0.0] * (capacity + 1)
+        for i, weight in enumerate(self.weights, start=1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent <= capacity:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i <= self.capacity:
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        total = 0.0
+        i = self.capacity
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def sample(self):
+        """
+        Return index chosen with probability proportional to its weight, None if all weights are zero
+        (also if they were set to zero and rounding left a tiny positive total)
+        """
+        total = self.total()
+        if total <= 0:
+            return None
+
+        target = random() * total
+        position = 0
+        step = 1 << self.capacity.bit_length()
+        while step > 0:
+            next_position = position + step
+            if next_position <= self.capacity and self.tree[next_position] <= target:
+                position = next_position
+                target -= self.tree[next_position]
+            step >>= 1
+
+        # Guard against floating point error pointing at a zero weight, past the last non-zero one or before the
+        # first one. Total is positive, so there is one in one of the directions.
+        position = min(position, self.capacity - 1)
+        if self.weights[position] > 0:
+            return position
+        for candidate in range(position - 1, -1, -1):
+            if self.weights[candidate] > 0:
+                return candidate
+        for candidate in range(position + 1, self.capacity):
+            if self.weights[candidate] > 0:
+                return candidate
+        return None
+
+
+class JokeRanking:
+    """
+    Class to choose approved jokes to be displayed, favouring jokes with good score.
+
+    Score of a joke is the Wilson lower bound of its positive votes. Jokes with fewer than `new_joke_votes` votes
+    are considered new and are chosen uniformly with probability `exploration_share`, so they get a chance to
+    collect votes. Established jokes are sampled proportionally to their score using a Fenwick tree.
+
+    Scores are loaded from database on first use and afterwards updated incrementally with `register_vote`,
+    `unregister_vote`, `add_joke` and `remove_joke`.
+    """
+    WEIGHT_MIN = 0.01  # even the worst joke is displayed from time to time
+    INITIAL_CAPACITY = 1024
+
+    def __init__(self, session, exploration_share, new_joke_votes):
+        """
+        Arguments:
+            session: sqlalchemy Session
+            exploration_share: float between 0 and 1, probability of choosing a new joke
+            new_joke_votes: int, jokes with less votes are considered new
+        """
+        self.session = session
+        self.exploration_share = exploration_share
+        self.new_joke_votes = new_joke_votes
+
+        self.loaded = False
+        self.votes = {}  # joke id -> [positive votes, all votes]
+        self.slots = {}  # joke id -> index in self.tree, only established jokes
+        self.slot_jokes = []  # index in self.tree -> joke id
+        self.free_slots = []
+        self.tree = FenwickTree(self.INITIAL_CAPACITY)
+        self.new_jokes = []  # ids of new jokes
+        self.new_jokes_positions = {}  # joke id -> index in self.new_jokes
+
+    def load(self):
+        """
+        Load vote counts of all approved jokes with one aggregate query.
+
+        Every vote adds a row to association table and a positive vote adds one more, so positive votes of a joke
+        are the number of its rows minus the number of distinct users who voted.
+        """
+        rows_count = func.count(association_table.c.users_id)
+        voters_count = func.count(distinct(association_table.c.users_id))
+        rows = self.session.query(Joke.id, rows_count, voters_count).\
+            outerjoin(association_table, association_table.c.jokes_id == Joke.id).\
+            filter(Joke.approved == True).\
+            group_by(Joke.id).all()
+
+        self.loaded = True
+        for joke_id, rows_count, voters_count in rows:
+            self.add_joke(joke_id, positive=rows_count - voters_count, total=voters_count)
+        logger.info('Joke ranking loaded with {} jokes'.format(len(self.votes)))
+
+    def weight(self, joke_id):
+        positive, total = self.votes[joke_id]
+        return max(wilson_lower_bound(positive, total), self.WEIGHT_MIN)
+
+    def add_joke(self, joke_id, positive=0, total=0):
+        """
+        Start ranking approved joke
+        """
+        if not self.loaded or joke_id in self.votes:
+            return
+
+        self.votes[joke_id] = [positive, total]
+        if total < self.new_joke_votes:
+            self.new_jokes_positions[joke_id] = len(self.new_jokes)
+            self.new_jokes.append(joke_id)
+        else:
+            self.add_established(joke_id)
+
+    def add_established(self, joke_id):
+        if len(self.free_slots) > 0:
+            slot = self.free_slots.pop()
+            self.slot_jokes[slot] = joke_id
+        else:
+            slot = len(self.slot_jokes)
+            self.slot_jokes.append(joke_id)
+            if slot >= self.tree.capacity:
+                self.tree.grow(self.tree.capacity * 2)
+        self.slots[joke_id] = slot
+        self.tree.set(slot, self.weight(joke_id))
+
+    def remove_established(self, joke_id):
+        slot = self.slots.pop(joke_id)
+        self.tree.set(slot, 0.0)
+        self.slot_jokes[slot] = None
+        self.free_slots.append(slot)
+
+    def remove_new(self, joke_id):
+        # Swap with the last new joke to remove in O(1)
+        position = self.new_jokes_positions.pop(joke_id)
+        last_joke_id = self.new_jokes.pop()
+        if last_joke_id != joke_id:
+            self.new_jokes[position] = last_joke_id
+            self.new_jokes_positions[last_joke_id] = position
+
+    def remove_joke(self, joke_id):
+        """
+        Stop ranking joke, e.g. after it was deleted
+        """
+        if joke_id not in self.votes:
+            return
+
+        del self.votes[joke_id]
+        if joke_id in self.new_jokes_positions:
+            self.remove_new(joke_id)
+        else:
+            self.remove_established(joke_id)
+
+    def register_vote(self, joke_id, positive):
+        """
+        Update score of joke after a vote
+        """
+        if joke_id not in self.votes:
+            return
+
+        votes = self.votes[joke_id]
+        if positive:
+            votes[0] += 1
+        votes[1] += 1
+
+        if joke_id in self.new_jokes_positions:
+            if votes[1] >= self.new_joke_votes:
+                self.remove_new(joke_id)
+                self.add_established(joke_id)
+        else:
+            self.tree.set(self.slots[joke_id], self.weight(joke_id))
+
+    def unregister_vote(self, joke_id, positive):
+        """
+        Update score of joke after a vote was deleted, e.g. with its user
+        """
+        if joke_id not in self.votes:
+            return
+
+        votes = self.votes[joke_id]
+        if positive:
+            votes[0] -= 1
+        votes[1] -= 1
+
+        if joke_id in self.new_jokes_positions:
+            return
+        if votes[1] < self.new_joke_votes:
+            # Back to the new jokes, like `add_joke` would do with these counts
+            self.remove_established(joke_id)
+            self.new_jokes_positions[joke_id] = len(self.new_jokes)
+            self.new_jokes.append(joke_id)
+        else:
+            self.tree.set(self.slots[joke_id], self.weight(joke_id))
+
+    def sample(self):
+        """
+        Choose id of approved joke.
+
+        Returns:
+            int, or None if there are no approved jokes
+        """
+        if not self.loaded:
+            self.load()
+
+        explore = random() < self.exploration_share
+        if len(self.new_jokes) > 0 and (explore or len(self.slots) == 0):
+            return choice(self.new_jokes)
+
+        slot = self.tree.sample()
+        if slot is None:
+            return None
+        return self.slot_jokes[slot]
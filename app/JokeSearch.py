@@ -0,0 +1,138 @@
+import logging
+import re
+
+from sqlalchemy import func, literal_column, desc
+
+from app.models import Joke
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+class JokeSearch:
+    """
+    Class to provide full-text search over approved jokes.
+
+    On PostgreSQL the search is done by the database, using the GIN index on `to_tsvector('english', body)`.
+    On any other database an in-process inverted index is used. The index is built once, on the first search,
+    and afterwards kept up to date with `add_joke`, `remove_joke` and `update_vote_count`.
+    """
+    TEXT_SEARCH_CONFIG = "'english'"
+
+    def __init__(self, session):
+        """
+        Arguments:
+            session: sqlalchemy Session
+        """
+        self.session = session
+        # Set on first search, database engine might not be created yet
+        self.use_postgresql = None
+
+        # Used only when `self.use_postgresql` is False
+        self.index = None  # token -> set of joke ids
+        self.joke_tokens = {}  # joke id -> set of tokens
+        self.vote_counts = {}  # joke id -> vote count
+
+    def tokenize(self, text):
+        """
+        Split text into lowercase words
+
+        Returns:
+            set
+        """
+        return set(TOKEN_PATTERN.findall(text.lower()))
+
+    def search(self, terms, limit):
+        """
+        Return ids of approved jokes matching the terms, best matches first.
+
+        Jokes are ranked by relevance, ties are broken by vote count.
+
+        Arguments:
+            terms: string
+            limit: int, maximum number of ids returned
+
+        Returns:
+            list of int
+        """
+        if len(self.tokenize(terms)) == 0:
+            return []
+
+        if self.use_postgresql is None:
+            self.use_postgresql = self.session.bind.dialect.name == 'postgresql'
+        if self.use_postgresql:
+            return self.search_postgresql(terms, limit)
+        return self.search_index(terms, limit)
+
+    def search_postgresql(self, terms, limit):
+        # The expression has to be identical to the one in the index, otherwise the planner won't use it
+        document = func.to_tsvector(literal_column(self.TEXT_SEARCH_CONFIG), Joke.body)
+        query = func.plainto_tsquery(literal_column(self.TEXT_SEARCH_CONFIG), terms)
+        rank = func.ts_rank(document, query)
+
+        rows = self.session.query(Joke.id).\
+            filter(Joke.approved == True).\
+            filter(document.op('@@')(query)).\
+            order_by(desc(rank), desc(Joke.vote_count), Joke.id).\
+            limit(limit).all()
+        return [joke_id for joke_id, in rows]
+
+    def search_index(self, terms, limit):
+        if self.index is None:
+            self.build_index()
+
+        matches = {}
+        for token in self.tokenize(terms):
+            for joke_id in self.index.get(token, ()):
+                matches[joke_id] = matches.get(joke_id, 0) + 1
+
+        ranked = sorted(matches, key=lambda joke_id: (-matches[joke_id], -self.vote_counts[joke_id], joke_id))
+        return ranked[:limit]
+
+    def build_index(self):
+        """
+        Build inverted index from all approved jokes.
+        """
+        self.index = {}
+        self.joke_tokens = {}
+        self.vote_counts = {}
+        rows = self.session.query(Joke.id, Joke.body, Joke.vote_count).filter(Joke.approved == True).yield_per(1000)
+        for joke_id, body, vote_count in rows:
+            self.add_joke(joke_id, body, vote_count)
+        logger.info('Search index built from {} jokes'.format(len(self.joke_tokens)))
+
+    def add_joke(self, joke_id, body, vote_count):
+        """
+        Add approved joke to the index
+        """
+        if self.index is None:
+            return
+
+        tokens = self.tokenize(body)
+        self.joke_tokens[joke_id] = tokens
+        self.vote_counts[joke_id] = vote_count or 0
+        for token in tokens:
+            self.index.setdefault(token, set()).add(joke_id)
+
+    def remove_joke(self, joke_id):
+        """
+        Remove joke from the index, if it's there
+        """
+        if self.index is None:
+            return
+
+        tokens = self.joke_tokens.pop(joke_id, ())
+        self.vote_counts.pop(joke_id, None)
+        for token in tokens:
+            joke_ids = self.index[token]
+            joke_ids.discard(joke_id)
+            if len(joke_ids) == 0:
+                del self.index[token]
+
+    def update_vote_count(self, joke_id, vote_count):
+        """
+        Keep vote count used for ranking up to date
+        """
+        if joke_id in self.vote_counts:
+            self.vote_counts[joke_id] = vote_count
@@ -0,0 +1,54 @@
+import threading
+
+
+class Metrics:
+    """
+    Class to collect counters and gauges of a running bot, e.g. how many reads were routed to the replica.
+
+    Metrics are kept in memory of the process, `report` renders them for the /metrics command.
+    Safe to use from multiple threads.
+    """
+    def __init__(self):
+        self.counters = {}  # name -> int
+        self.gauges = {}  # name -> number or None
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        """
+        Set gauge to the last measured value, None if it's unknown
+        """
+        with self.lock:
+            self.gauges[name] = value
+
+    def get(self, name):
+        """
+        Returns:
+            current value of counter or gauge, None if it wasn't recorded yet
+        """
+        with self.lock:
+            if name in self.counters:
+                return self.counters[name]
+            return self.gauges.get(name)
+
+    def report(self):
+        """
+        Returns:
+            string: one `name value` line per metric, sorted by name
+        """
+        with self.lock:
+            values = dict(self.gauges)
+            values.update(self.counters)
+
+        lines = []
+        for name in sorted(values):
+            value = values[name]
+            if value is None:
+                value = 'unknown'
+            elif isinstance(value, float):
+                value = '{:.3f}'.format(value)
+            lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines)
@@ -0,0 +1,153 @@
+import os
+import sys
+import threading
+import time
+
+
+def format_frame(filename, lineno, name):
+    """
+    Returns:
+        string: e.g. `app/TelegramBotHelper.py:315 can_vote`, only the last two parts of the path are kept
+    """
+    return '{}:{} {}'.format('/'.join(filename.replace(os.sep, '/').split('/')[-2:]), lineno, name)
+
+
+class SamplingProfiler:
+    """
+    Class to find where the dispatcher thread spends its time, while the bot is running.
+
+    A background thread takes a snapshot of the dispatcher thread's stack every `interval` seconds with
+    `sys._current_frames()`. A sample is attributed to the handler callback being run, which is the function called
+    by the innermost `handle_update` on the stack, e.g. `display_random_joke` or `before_update`. Samples without
+    one are counted as idle. Per handler the frames samples ended in (self time) and the functions anywhere on the
+    stack (total time) are counted.
+
+    Nothing is hooked into update processing, so there is no overhead while it's not running. Profiling stops after
+    `seconds`, or after `updates` updates if `count_update` is called after every update.
+    """
+    def __init__(self, interval, top_frames, seconds_max):
+        """
+        Arguments:
+            interval: float, seconds between samples
+            top_frames: int, frames listed in the report per handler
+            seconds_max: float, profiling always stops after this long
+        """
+        self.interval = interval
+        self.top_frames = top_frames
+        self.seconds_max = seconds_max
+
+        self.running = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self, thread_id, on_finish, seconds=None, updates=None):
+        """
+        Start sampling thread `thread_id`
+
+        Arguments:
+            thread_id: int, `threading.get_ident()` of the dispatcher thread
+            on_finish: function called with the report once profiling stops, from the profiling or the dispatcher
+                thread
+            seconds: float, seconds to profile for
+            updates: int, updates to profile
+
+        Returns:
+            bool: False if profiling is already running
+        """
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+
+        self.thread_id = thread_id
+        self.on_finish = on_finish
+        self.updates = updates
+        self.updates_seen = 0
+        self.deadline = time.perf_counter() + min(seconds or self.seconds_max, self.seconds_max)
+        self.samples = 0
+        self.idle_samples = 0
+        self.handler_samples = {}  # handler name -> samples
+        self.self_samples = {}  # (handler name, frame) -> samples which ended in frame
+        self.total_samples = {}  # (handler name, function) -> samples with function on the stack
+        self.started = time.perf_counter()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='sampling_profiler', daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if time.perf_counter() >= self.deadline:
+                self.finish()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:  # thread ended
+            self.finish()
+            return
+
+        stack = []  # innermost frame first
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        callback_position = None
+        for position in range(len(stack) - 1, 0, -1):
+            if stack[position].f_code.co_name == 'handle_update':
+                callback_position = position - 1
+        self.samples += 1
+        if callback_position is None:
+            self.idle_samples += 1
+            return
+
+        handler = stack[callback_position].f_code.co_name
+        self.handler_samples[handler] = self.handler_samples.get(handler, 0) + 1
+        leaf = stack[0]
+        key = (handler, format_frame(leaf.f_code.co_filename, leaf.f_lineno, leaf.f_code.co_name))
+        self.self_samples[key] = self.self_samples.get(key, 0) + 1
+        # Functions called by the callback, recursive ones are counted once per sample
+        for code in set(frame.f_code for frame in stack[:callback_position]):
+            key = (handler, format_frame(code.co_filename, code.co_firstlineno, code.co_name))
+            self.total_samples[key] = self.total_samples.get(key, 0) + 1
+
+    def count_update(self):
+        """
+        Called by the dispatcher thread after every update while profiling is running
+        """
+        self.updates_seen += 1
+        if self.updates is not None and self.updates_seen >= self.updates:
+            self.finish()
+
+    def finish(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        self.stopped.set()
+        # Report is made once no sample is being taken
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+        self.on_finish(self.report())
+
+    def get_top(self, counts, handler):
+        frames = [(samples, frame) for (name, frame), samples in counts.items() if name == handler]
+        return sorted(frames, reverse=True)[:self.top_frames]
+
+    def report(self):
+        """
+        Returns:
+            string: samples per handler and their hottest frames, handlers with most samples first
+        """
+        busy = self.samples - self.idle_samples
+        lines = ['Profiled {:.1f} s, {} updates, {} samples every {:.0f} ms, busy {:.0%}'.format(
+            time.perf_counter() - self.started, self.updates_seen, self.samples, self.interval * 1000,
+            busy / self.samples if self.samples > 0 else 0)]
+        for handler, samples in sorted(self.handler_samples.items(), key=lambda item: -item[1]):
+            lines.append('')
+            lines.append('{} {} samples ({:.0%} of busy)'.format(handler, samples, samples / busy))
+            for frame_samples, frame in self.get_top(self.self_samples, handler):
+                lines.append('  self  {:>4.0%} {}'.format(frame_samples / samples, frame))
+            for frame_samples, frame in self.get_top(self.total_samples, handler):
+                lines.append('  total {:>4.0%} {}'.format(frame_samples / samples, frame))
+        return '\n'.join(lines)
@@ -0,0 +1,217 @@
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = 20  # seconds workers process queued updates for after a stop signal, see HahOrNahBot.drain
+DEDUPLICATION_WINDOW = 10 * 60  # seconds an update id is remembered for, see app/UpdateDeduplicator.py
+DEDUPLICATION_SIZE_MAX = 100000
+
+
+def get_chat_id(update_data):
+    """
+    Get id of the chat an update belongs to, without parsing the whole update.
+
+    Arguments:
+        update_data: dict, update as sent by Telegram
+
+    Returns:
+        int
+    """
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in update_data:
+            return update_data[key]['chat']['id']
+
+    callback_query = update_data.get('callback_query')
+    if callback_query is not None:
+        if 'message' in callback_query:
+            return callback_query['message']['chat']['id']
+        return callback_query['from']['id']
+
+    for key in ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query'):
+        if key in update_data:
+            return update_data[key]['from']['id']
+
+    # Update without a chat, any worker can process it
+    return update_data.get('update_id', 0)
+
+
+class ShardRouter:
+    """
+    Class to distribute updates among worker processes.
+
+    Updates of one chat always go to the same worker, so its conversation state is kept in a single process.
+    Every worker has its own queue, updates are sent to it over a pipe.
+    """
+    def __init__(self, worker_count, worker_target, worker_args):
+        """
+        Arguments:
+            worker_count: int
+            worker_target: function called in worker process as
+                `worker_target(shard, queue, drain_expired, *worker_args)`. It should process updates from `queue`
+                until it gets None, and only drop them once `drain_expired` Event is set. Updates are
+                `(update as dict, time.time() it was received, seconds receiving it took)` tuples.
+            worker_args: tuple
+        """
+        self.worker_count = worker_count
+        self.worker_target = worker_target
+        self.worker_args = worker_args
+        self.queues = []
+        self.processes = []
+        self.drain_expired = multiprocessing.Event()
+
+    def start(self):
+        for shard in range(self.worker_count):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=self.worker_target,
+                                              args=(shard, queue, self.drain_expired) + tuple(self.worker_args),
+                                              name='shard-{}'.format(shard))
+            process.start()
+            self.queues.append(queue)
+            self.processes.append(process)
+        logger.info('Started {} workers'.format(self.worker_count))
+
+    def get_shard(self, update_data):
+        return get_chat_id(update_data) % self.worker_count
+
+    def route(self, update_data, received=None):
+        """
+        Send update to the worker responsible for its chat
+
+        Arguments:
+            update_data: dict
+            received: float, time.time() the webhook request started, now by default
+        """
+        now = time.time()
+        received = received if received is not None else now
+        self.queues[self.get_shard(update_data)].put((update_data, received, now - received))
+
+    def stop(self, timeout=None):
+        """
+        Let workers process updates already sent to them and wait until they exit
+
+        Arguments:
+            timeout: float, seconds after which workers drop updates still queued, finish the one in progress and
+                exit. None waits for all updates.
+        """
+        start = time.perf_counter()
+        for queue in self.queues:
+            queue.put(None)
+        for process in self.processes:
+            process.join(None if timeout is None else max(start + timeout - time.perf_counter(), 0))
+        if any(process.is_alive() for process in self.processes):
+            logger.warning('Workers didn\'t drain in {} s, dropping queued updates'.format(timeout))
+            self.drain_expired.set()
+            for process in self.processes:
+                process.join()
+        logger.info('All workers stopped in {:.2f} s'.format(time.perf_counter() - start))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """
+    Accepts updates sent by Telegram to the webhook and passes them to `server.router`
+    """
+    def do_POST(self):
+        received = time.time()
+        if self.path != self.server.url_path:
+            self.send_response(403)
+            self.end_headers()
+            return
+
+        content_length = int(self.headers.get('Content-Length', 0))
+        try:
+            update_data = json.loads(self.rfile.read(content_length).decode('utf-8'))
+            # Telegram delivered it again, it was routed already
+            if not self.server.deduplicator.is_duplicate(update_data['update_id']):
+                self.server.router.route(update_data, received)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error('Invalid update received: {}'.format(e))
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def run_bot_worker(shard, queue, drain_expired, token, database_url, base_url, replica_url, vote_log_directory,
+                   trace_sample_rate):
+    """
+    Worker process: create own bot with own database engine and process updates routed to this shard
+    """
+    # Shutdown is driven by the front process, which sends None once it stopped accepting updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    from app.HahOrNahBot import HahOrNahBot
+    bot = HahOrNahBot(token, database_url, base_url=base_url, replica_url=replica_url,
+                      vote_log_directory=vote_log_directory, trace_sample_rate=trace_sample_rate)
+    logger.info('Shard {} ready'.format(shard))
+    # One process sends the joke of the day, it would be sent once per shard otherwise
+    bot.start_shard(queue, drain_expired, joke_of_the_day=shard == 0)
+
+
+def start_sharded_webhook(token, database_url, url, port, worker_count, base_url=None, replica_url=None,
+                          vote_log_directory=None, shared_deduplication=False, trace_sample_rate=0):
+    """
+    Receive webhook updates in this process and process them in `worker_count` worker processes.
+
+    Arguments:
+        token: string
+        database_url: string
+        url: string, public url of the webhook without the token
+        port: int
+        worker_count: int
+        base_url: string, Bot API url, defaults to api.telegram.org
+        replica_url: string, url of a read replica of the database. Optional.
+        vote_log_directory: string, directory votes are logged to by all workers. Optional.
+        shared_deduplication: bool, record ids of received updates in database, so an update delivered to
+            several processes is processed once
+        trace_sample_rate: float, share of updates traced by workers, see app/UpdateTracer.py
+    """
+    from telegram import Bot
+    from app.Metrics import Metrics
+    from app.UpdateDeduplicator import UpdateDeduplicator
+
+    get_engine = None
+    if shared_deduplication:
+        from app.database import create_database_engine
+        engine = create_database_engine(database_url)
+        get_engine = lambda: engine
+
+    # Bind first, updates received while workers start wait in their queues
+    server = ThreadingHTTPServer(('0.0.0.0', port), WebhookHandler)
+    worker_args = (token, database_url, base_url, replica_url, vote_log_directory, trace_sample_rate)
+    router = ShardRouter(worker_count, run_bot_worker, worker_args)
+    router.start()
+    server.url_path = '/' + token
+    server.router = router
+    metrics = Metrics()
+    server.deduplicator = UpdateDeduplicator(DEDUPLICATION_WINDOW, DEDUPLICATION_SIZE_MAX, metrics, get_engine)
+
+    def stop(signum, frame):
+        logger.info('Received signal {}, stopping'.format(signum))
+        # shutdown() blocks until serve_forever() returns, so it can't be called from the serving thread
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    Bot(token, base_url=base_url).set_webhook(url + token)
+    server.serve_forever()
+    server.server_close()
+    router.stop(DRAIN_TIMEOUT)
+    logger.info('Dropped {} duplicate updates'.format(metrics.get('updates.duplicates') or 0))
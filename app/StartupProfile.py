@@ -0,0 +1,53 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class StartupProfile:
+    """
+    Class to measure how long each phase of startup takes.
+
+    Only the standard library is imported here, so the profile can be created before any heavy import.
+    """
+    def __init__(self, start_time=None):
+        """
+        Arguments:
+            start_time: float, `time.perf_counter()` at process start. Defaults to now.
+        """
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.phases = []  # list of (name, seconds)
+        self.marks = []  # list of (name, seconds since start)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Measure duration of the block, e.g.
+
+            with profile.phase('import telegram'):
+                import telegram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def mark(self, name):
+        """
+        Record time elapsed since start, e.g. when the first update arrived
+        """
+        self.marks.append((name, time.perf_counter() - self.start_time))
+
+    def report(self):
+        """
+        Returns:
+            string: table with duration of every phase and marks
+        """
+        lines = ['{:<40} {:>10}'.format('phase', 'ms')]
+        for name, seconds in self.phases:
+            lines.append('{:<40} {:>10.1f}'.format(name, seconds * 1000))
+        for name, seconds in self.marks:
+            lines.append('{:<40} {:>10.1f}'.format('[since start] ' + name, seconds * 1000))
+        return '\n'.join(lines)
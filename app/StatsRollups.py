@@ -0,0 +1,158 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app.models import StatsRollup
+
+logger = logging.getLogger(__name__)
+
+
+class StatsRollups:
+    """
+    Class to count events (votes, registrations, submissions, approvals) per hour and per day.
+
+    Counts are kept in `stats_rollups` table, one row per period, bucket and metric, so time-based stats are read
+    from a few rows instead of scanning jokes and votes. `record` only adds to in-memory counts, a background thread
+    adds them to the rows every `flush_interval` seconds. Counts not written yet are included in `get`.
+    """
+    PERIODS = ('hour', 'day')
+    # Names are stored in database, don't change them
+    METRICS = ('votes', 'votes_positive', 'users_new', 'jokes_submitted', 'jokes_approved', 'jokes_rejected',
+               'jokes_withdrawn')
+    FLUSH_ATTEMPTS = 3
+
+    def __init__(self, Session, flush_interval):
+        """
+        Arguments:
+            Session: sessionmaker, used to create session for the background thread
+            flush_interval: float, seconds between writes
+        """
+        self.Session = Session
+        self.flush_interval = flush_interval
+
+        self.pending = {}  # (period, bucket start, metric) -> count not written yet
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def get_bucket_start(period, time):
+        """
+        Arguments:
+            period: `hour` or `day`
+            time: datetime, UTC
+
+        Returns:
+            datetime: start of the hour or day `time` is in
+        """
+        if period == 'hour':
+            return time.replace(minute=0, second=0, microsecond=0)
+        return time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    def record(self, metric, value=1, time=None):
+        """
+        Count event in its hour and day
+
+        Arguments:
+            metric: string, one of METRICS
+            value: int
+            time: datetime, UTC. Defaults to now.
+        """
+        assert metric in self.METRICS
+        time = datetime.utcnow() if time is None else time
+        with self.lock:
+            for period in self.PERIODS:
+                key = (period, self.get_bucket_start(period, time), metric)
+                self.pending[key] = self.pending.get(key, 0) + value
+
+    def get(self, session, period, since):
+        """
+        Read counts of buckets starting at `since` or later
+
+        Arguments:
+            session: Session to query
+            period: `hour` or `day`
+            since: datetime, UTC
+
+        Returns:
+            dict: bucket start -> dict, metric -> count. Buckets without any event are missing.
+        """
+        rows = session.query(StatsRollup.bucket_start, StatsRollup.metric, StatsRollup.value).\
+            filter(StatsRollup.period == period).\
+            filter(StatsRollup.bucket_start >= since).all()
+
+        buckets = {}
+        for bucket_start, metric, value in rows:
+            buckets.setdefault(bucket_start, {})[metric] = value or 0
+
+        with self.lock:
+            pending = list(self.pending.items())
+        for (pending_period, bucket_start, metric), value in pending:
+            if pending_period == period and bucket_start >= since:
+                counts = buckets.setdefault(bucket_start, {})
+                counts[metric] = counts.get(metric, 0) + value
+        return buckets
+
+    def write(self, session, pending):
+        """
+        Add counts to their rows, rows which don't exist yet are inserted
+        """
+        for (period, bucket_start, metric), value in pending.items():
+            updated = session.query(StatsRollup).\
+                filter(StatsRollup.period == period).\
+                filter(StatsRollup.bucket_start == bucket_start).\
+                filter(StatsRollup.metric == metric).\
+                update({StatsRollup.value: StatsRollup.value + value}, synchronize_session=False)
+            if updated == 0:
+                session.add(StatsRollup(period=period, bucket_start=bucket_start, metric=metric, value=value))
+                # Flushed one by one, so a row inserted by another process fails here and not at commit
+                session.flush()
+
+    def flush(self):
+        """
+        Write all counts in one transaction
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if len(pending) == 0:
+            return
+
+        session = self.Session()
+        try:
+            for attempt in range(self.FLUSH_ATTEMPTS):
+                try:
+                    self.write(session, pending)
+                    session.commit()
+                    return
+                except IntegrityError:
+                    # Another process inserted the same row in the meantime, it will be updated on the next attempt
+                    session.rollback()
+            raise RuntimeError('rows kept being inserted concurrently')
+        except Exception as e:
+            logger.error('Writing stats rollups failed: {}'.format(e))
+            session.rollback()
+            with self.lock:
+                for key, value in pending.items():
+                    self.pending[key] = self.pending.get(key, 0) + value
+        finally:
+            session.close()
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='stats_rollups', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop background thread and write remaining counts
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
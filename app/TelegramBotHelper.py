@@ -1,8 +1,14 @@
 import logging
-from sqlalchemy import create_engine
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy import and_, distinct, func, select, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
 
-from app.models import Joke, User
+from app.Metrics import Metrics
+from app.database import create_database_engine
+from app.models import Joke, User, association_table
 from app.exceptions import *
 
 logger = logging.getLogger(__name__)
@@ -12,13 +18,24 @@ class HahOrNahBotHelper():
     Class to provide helper methods for HahOrNahBot.
     """
 
-    def __init__(self, database_url, joke_limits, user_limits, user_allowed_characters):
+    # Lag of a PostgreSQL standby in seconds. 0 when everything received was replayed, NULL when it isn't a standby.
+    REPLICA_LAG_QUERY = text(
+        'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+        'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END')
+
+    def __init__(self, database_url, joke_limits, user_limits, user_allowed_characters,
+                 replica_url=None, replica_limits=None):
         """
         Arguments:
             database_url: string
             joke_limits: dict, with `min` and `max` keys. Used to restrict length of new jokes
             user_limits: dict, with `min` and `max` keys. Used to restrict length of new usernames
             user_allowed_characters: string. Characters which can be used in a username
+            replica_url: string, url of a read replica of the database. Read-only handlers query it if it's set.
+            replica_limits: dict, with keys
+                `sticky` - seconds after a user's write during which his reads go to the primary,
+                `lag_max` - reads go to the primary while the replica lags more seconds than this,
+                `lag_check_interval` - seconds between measurements of the replica lag
         """
         self.JOKE_LENGTH_MIN = joke_limits['min']
         self.JOKE_LENGTH_MAX = joke_limits['max']
@@ -26,37 +43,162 @@ class HahOrNahBotHelper():
         self.USERNAME_LENGTH_MAX = user_limits['max']
         self.USERNAME_ALLOWED_CHARACTERS = user_allowed_characters
 
-        engine = create_engine(database_url)
-        Session = sessionmaker(bind=engine)
-        self.session = Session()
+        # Engine is created on first use, see `init_database`
+        self.database_url = database_url
+        self.engine = None
+        self.engine_lock = threading.Lock()
+        # Sessions for work done outside of the dispatcher thread, `self.session` isn't thread-safe
+        self.Session = sessionmaker()
+        self.session = self.Session()
+
+        self.metrics = Metrics()
+        # Objects loaded from the replica session are only displayed, never modified or kept between updates
+        self.replica_url = replica_url
+        self.replica_engine = None
+        self.replica_session = sessionmaker()() if replica_url is not None else None
+        if replica_limits is None:
+            replica_limits = {'sticky': 10, 'lag_max': 30, 'lag_check_interval': 5}
+        self.REPLICA_STICKY_SECONDS = replica_limits['sticky']
+        self.REPLICA_LAG_MAX = replica_limits['lag_max']
+        self.REPLICA_LAG_CHECK_INTERVAL = replica_limits['lag_check_interval']
+        self.replica_lag = None  # seconds, None if unknown
+        self.replica_available = True
+        self.replica_lag_checked = None  # time.monotonic() of the last measurement
+        self.last_write_times = OrderedDict()  # user id -> time.monotonic() of his last write, oldest first
+
+    def init_database(self):
+        """
+        Create database engine and bind sessions to it, if it wasn't done yet.
+
+        Returns:
+            Engine
+        """
+        if self.engine is not None:
+            return self.engine
+
+        with self.engine_lock:
+            if self.engine is None:
+                if self.replica_url is not None:
+                    self.replica_engine = create_database_engine(self.replica_url)
+                    self.replica_session.bind = self.replica_engine
+                engine = create_database_engine(self.database_url)
+                self.Session.configure(bind=engine)
+                self.session.bind = engine
+                self.engine = engine
+        return self.engine
+
+    def warm_up_database(self):
+        """
+        Create engine and open the first pooled connection, so the first update doesn't have to
+        """
+        engine = self.init_database()
+        with engine.connect() as connection:
+            connection.execute('SELECT 1')
+        if self.replica_engine is not None:
+            self.check_replica_lag()
+
+    def register_write(self, user_id):
+        """
+        Remember that user has just changed data, so his reads go to the primary until the replica catches up
+        """
+        now = time.monotonic()
+        self.last_write_times.pop(user_id, None)
+        self.last_write_times[user_id] = now
+
+        # Forget writes the replica has surely caught up with, entries are ordered by time
+        oldest_kept = now - max(self.REPLICA_STICKY_SECONDS, self.REPLICA_LAG_MAX)
+        while len(self.last_write_times) > 0:
+            oldest_user_id, write_time = next(iter(self.last_write_times.items()))
+            if write_time >= oldest_kept:
+                break
+            del self.last_write_times[oldest_user_id]
+
+    def check_replica_lag(self):
+        """
+        Measure replica lag, at most once per `REPLICA_LAG_CHECK_INTERVAL` seconds.
+
+        Lag can be measured only on a PostgreSQL standby, it's unknown for other replicas.
+        If the replica can't be queried, reads go to the primary until the next successful check.
 
-    def get_user(self, message, user_data):
+        Returns:
+            float, seconds. None if unknown.
+        """
+        now = time.monotonic()
+        if self.replica_lag_checked is not None and now - self.replica_lag_checked < self.REPLICA_LAG_CHECK_INTERVAL:
+            return self.replica_lag
+        self.replica_lag_checked = now
+
+        try:
+            if self.replica_engine.dialect.name == 'postgresql':
+                lag = self.replica_engine.execute(self.REPLICA_LAG_QUERY).scalar()
+                self.replica_lag = float(lag) if lag is not None else None
+            else:
+                self.replica_engine.execute('SELECT 1')
+                self.replica_lag = None
+            self.replica_available = True
+        except SQLAlchemyError as e:
+            logger.error('Replica lag check failed: {}'.format(e))
+            self.metrics.increment('replica.check_errors')
+            self.replica_lag = None
+            self.replica_available = False
+
+        self.metrics.set('replica.lag_seconds', self.replica_lag)
+        self.metrics.set('replica.available', int(self.replica_available))
+        return self.replica_lag
+
+    def get_read_session(self, user_id):
+        """
+        Choose session for a read-only query done on behalf of user.
+
+        Replica is used unless the user wrote something recently (so he reads his own writes), the replica lags
+        too much or is unavailable. Every decision is counted in `self.metrics`.
+
+        Returns:
+            Session
+        """
+        if self.replica_session is None:
+            return self.session
+
+        self.init_database()
+        lag = self.check_replica_lag()
+        if not self.replica_available:
+            self.metrics.increment('reads.primary.replica_unavailable')
+            return self.session
+        if lag is not None and lag > self.REPLICA_LAG_MAX:
+            self.metrics.increment('reads.primary.replica_lag')
+            return self.session
+
+        write_time = self.last_write_times.get(user_id)
+        if write_time is not None and time.monotonic() - write_time < max(self.REPLICA_STICKY_SECONDS, lag or 0):
+            self.metrics.increment('reads.primary.recent_write')
+            return self.session
+
+        self.metrics.increment('reads.replica')
+        return self.replica_session
+
+    def close_read_session(self):
+        """
+        End transaction of replica session, so the next read sees fresh data. Called after every update.
+        """
+        if self.replica_session is not None:
+            self.replica_session.close()
+
+    def get_user(self, message):
         """
         Get user by id if the user is in database, raise exception if user is not found.
 
+        The User isn't kept in `user_data`, the session's identity map returns it without a query while it's in use.
+
         Returns:
             instance of User class if user exists
 
         Raises:
             UserDoesNotExist
         """
-
-        # Check user in cache
-        try:
-            user = user_data['current_user']
-            return user
-        except KeyError:
-            pass
-
-        # Check if user is in database
-        user_id = message.chat.id
-        user = self.session.query(User).filter(User.id == user_id).first()
+        user = self.session.query(User).get(message.chat.id)
         if user is None:
             raise UserDoesNotExist
-
-        else:
-            user_data['current_user'] = user
-            return user
+        return user
 
     def add_user(self, user_id, username):
         """
@@ -112,19 +254,135 @@ class HahOrNahBotHelper():
             raise TooLong
 
         # Calculate id by adding one to last joke's id
-        all_jokes = self.session.query(Joke).order_by(Joke.id).all()
-        try:
-            last_joke = all_jokes[-1]
-            last_joke_id = last_joke.get_id()
-            joke_id = last_joke_id + 1
-        except IndexError:  # no jokes in database
+        last_joke_id = self.session.query(func.max(Joke.id)).scalar()
+        if last_joke_id is None:  # no jokes in database
             joke_id = 0
+        else:
+            joke_id = last_joke_id + 1
 
         new_joke = Joke(id=joke_id, body=joke_body, vote_count=0, author=author)
         self.session.add(new_joke)
+        author.jokes_submitted_count = User.jokes_submitted_count + 1
         self.session.commit()
         return
 
+    def get_joke(self, joke_id):
+        """
+        Returns:
+            Joke, or None if there is no joke with this id
+        """
+        return self.session.query(Joke).filter(Joke.id == joke_id).first()
+
+    def get_user_jokes(self, user, session=None, offset=0, limit=None):
+        """
+        Get jokes submitted by user, sorted by vote count
+
+        Arguments:
+            user: User
+            session: Session to query, `self.session` by default
+            offset: int, number of jokes skipped
+            limit: int, maximum number of jokes returned, all by default
+
+        Returns:
+            list of Joke
+        """
+        session = session if session is not None else self.session
+        # Ties are ordered by id, so pages don't overlap
+        return session.query(Joke).filter(Joke.user_id == user.get_id()).order_by(Joke.vote_count, Joke.id).\
+            offset(offset).limit(limit).all()
+
+    def get_next_unapproved_joke(self):
+        """
+        Returns:
+            Joke waiting for approval with the lowest id, or None
+        """
+        return self.session.query(Joke).filter(Joke.approved == False).order_by(Joke.id).first()
+
+    def get_stats(self, session=None):
+        """
+        Arguments:
+            session: Session to query, `self.session` by default
+
+        Returns:
+            tuple: int: number of approved jokes
+                   int: number of users
+        """
+        session = session if session is not None else self.session
+        approved_jokes_count = session.query(func.count(Joke.id)).filter(Joke.approved == True).scalar()
+        users_count = session.query(func.count(User.id)).scalar()
+        return approved_jokes_count, users_count
+
+    def can_vote(self, user, joke_id, session=None):
+        """
+        Check whether user can vote for joke - it exists and is approved, he hasn't voted for it yet and isn't its
+        author.
+
+        Only ids are queried, relationships of `user` aren't loaded.
+
+        Arguments:
+            session: Session to query, `self.session` by default
+
+        Returns:
+            bool
+        """
+        session = session if session is not None else self.session
+        joke = session.query(Joke.user_id, Joke.approved).filter(Joke.id == joke_id).first()
+        if joke is None or not joke.approved or joke.user_id == user.get_id():
+            return False
+
+        vote = session.query(association_table.c.users_id).\
+            filter(association_table.c.users_id == user.get_id()).\
+            filter(association_table.c.jokes_id == joke_id).first()
+        return vote is None
+
+    def get_favorite_joke_ids(self, user, user_data, session=None):
+        """
+        Get ids of jokes user voted for positively. Ids are cached in `favorite_joke_ids` key in `user_data`.
+
+        A positive vote adds two rows to association table (see User.vote_for_joke), so favorite jokes are the ones
+        with more than one row for the user. The query uses only association table, jokes aren't loaded.
+
+        Arguments:
+            session: Session to query, `self.session` by default
+
+        Returns:
+            list of int
+        """
+        try:
+            return user_data['favorite_joke_ids']
+        except KeyError:
+            pass
+
+        session = session if session is not None else self.session
+        rows = session.query(association_table.c.jokes_id).\
+            filter(association_table.c.users_id == user.get_id()).\
+            group_by(association_table.c.jokes_id).\
+            having(func.count() > 1).\
+            order_by(association_table.c.jokes_id).all()
+
+        user_data['favorite_joke_ids'] = [joke_id for joke_id, in rows]
+        return user_data['favorite_joke_ids']
+
+    def get_random_unvoted_joke(self, user, session=None):
+        """
+        Get random approved joke user can vote for, using a single query.
+
+        Arguments:
+            session: Session to query, `self.session` by default
+
+        Returns:
+            Joke, or None if user has voted for all jokes
+        """
+        session = session if session is not None else self.session
+        voted_joke_ids = session.query(association_table.c.jokes_id).\
+            filter(association_table.c.users_id == user.get_id())
+
+        return session.query(Joke).\
+            filter(Joke.approved == True).\
+            filter(Joke.user_id != user.get_id()).\
+            filter(~Joke.id.in_(voted_joke_ids)).\
+            order_by(func.random()).first()
+
     def get_message(self, update):
         """
         Depending on the type of response, message object can be located in update.message or update.message.callback_query.
@@ -169,4 +427,182 @@ class HahOrNahBotHelper():
         reply_message = '\n\n'.join(jokes_string)
         return reply_message, all_jokes_shown
 
+    def format_rollups(self, buckets, bucket_starts, columns, label_format):
+        """
+        Return monospace table with one row per bucket and a total row
 
+        Arguments:
+            buckets: dict, bucket start -> dict, metric -> count (see StatsRollups.get)
+            bucket_starts: list of datetime, rows of the table
+            columns: list of (header, function(counts) returning int)
+            label_format: string, strftime format of bucket start
+
+        Returns:
+            string
+        """
+        label_width = len(bucket_starts[0].strftime(label_format))
+        column_width = max(len(header) for header, _ in columns) + 1
+
+        lines = [' ' * label_width + ''.join(header.rjust(column_width) for header, _ in columns)]
+        totals = {}
+        for bucket_start in bucket_starts:
+            counts = buckets.get(bucket_start, {})
+            for metric, value in counts.items():
+                totals[metric] = totals.get(metric, 0) + value
+            values = ''.join(str(function(counts)).rjust(column_width) for _, function in columns)
+            lines.append(bucket_start.strftime(label_format) + values)
+        lines.append('total'.ljust(label_width) + ''.join(str(function(totals)).rjust(column_width)
+                                                          for _, function in columns))
+        return '```\n' + '\n'.join(lines) + '\n```'
+
+    def delete_joke(self, joke):
+        """
+        Delete joke and adjust aggregates of its author and of users who voted for it. Doesn't commit.
+
+        Arguments:
+            joke: Joke, removed from the session
+        """
+        self.delete_jokes(Joke.id == joke.get_id())
+
+    def delete_jokes(self, condition):
+        """
+        Delete jokes matching condition and their votes, and adjust aggregates of their authors and of users who
+        voted for them. Doesn't commit.
+
+        Everything is done by set-based statements, neither the jokes nor their votes are loaded into the session,
+        so the time depends on the number of voters only through indexed lookups. Aggregates of voters are
+        adjusted by two updates per joke (positive and negative voters), those of authors by one update per author.
+
+        Arguments:
+            condition: SQL expression on Joke columns which the session can evaluate, e.g. `Joke.id == 5` or
+                `Joke.user_id == 7`. Matching jokes loaded in the session are removed from it.
+
+        Returns:
+            list of ids of deleted jokes
+        """
+        votes = association_table.c
+
+        # Positive vote adds two rows to association table, negative one
+        rows_count = func.count(votes.users_id)
+        voters_count = func.count(distinct(votes.users_id))
+        jokes = self.session.query(Joke.id, Joke.user_id, rows_count, voters_count).\
+            outerjoin(association_table, votes.jokes_id == Joke.id).\
+            filter(condition).\
+            group_by(Joke.id, Joke.user_id).all()
+        if len(jokes) == 0:
+            return []
+
+        authors = {}  # author id -> [jokes submitted, positive votes received]
+        for _, author_id, rows, voters in jokes:
+            counts = authors.setdefault(author_id, [0, 0])
+            counts[0] += 1
+            counts[1] += rows - voters
+        for author_id, (jokes_submitted, positive_votes) in authors.items():
+            self.session.query(User).filter(User.id == author_id).\
+                update({User.jokes_submitted_count: User.jokes_submitted_count - jokes_submitted,
+                        User.positive_votes_received: User.positive_votes_received - positive_votes},
+                       synchronize_session=False)
+
+        # A user votes once per joke, so per joke his aggregates change by a constant: votes cast -1, score -1 for a
+        # positive vote and +1 for a negative one (see User.vote_for_joke). Statements filter by a single joke id,
+        # so they use the association table's index on jokes_id.
+        for joke_id, _, _, _ in jokes:
+            voter_rows = select([votes.users_id]).where(votes.jokes_id == joke_id).group_by(votes.users_id)
+            for having, score_delta in ((func.count() > 1, 1), (func.count() == 1, -1)):
+                self.session.query(User).filter(User.id.in_(voter_rows.having(having))).\
+                    update({User.votes_cast_count: User.votes_cast_count - 1,
+                            User.score: User.score - score_delta},
+                           synchronize_session=False)
+            self.session.execute(association_table.delete().where(votes.jokes_id == joke_id))
+
+        self.session.query(Joke).filter(condition).delete(synchronize_session='evaluate')
+        return [joke_id for joke_id, _, _, _ in jokes]
+
+    def purge_user(self, user_id):
+        """
+        Delete user with his jokes and votes, and adjust vote counts and aggregates of everybody else. Doesn't
+        commit.
+
+        Like `delete_jokes`, everything is done by set-based statements.
+
+        Returns:
+            tuple: list of ids of deleted jokes of the user
+                   list of (joke id, vote count after the purge, bool: True if the user's vote was positive) of
+                   jokes he voted for
+        """
+        votes = association_table.c
+        deleted_joke_ids = self.delete_jokes(Joke.user_id == user_id)
+
+        voted_joke_ids = select([votes.jokes_id]).where(votes.users_id == user_id)
+        # Correlated with the updated joke: 2 rows of a positive vote count +1, 1 row of a negative one -1
+        vote_value = select([2 * func.count() - 3]).\
+            where(and_(votes.users_id == user_id, votes.jokes_id == Joke.id)).as_scalar()
+        self.session.query(Joke).filter(Joke.id.in_(voted_joke_ids)).\
+            update({Joke.vote_count: Joke.vote_count - vote_value}, synchronize_session=False)
+
+        # Correlated with the updated author: positive votes are rows minus jokes the user voted for
+        author_votes = select([func.count() - func.count(distinct(votes.jokes_id))]).\
+            select_from(association_table.join(Joke.__table__, Joke.id == votes.jokes_id)).\
+            where(and_(votes.users_id == user_id, Joke.user_id == User.id)).as_scalar()
+        authors = select([Joke.user_id]).where(Joke.id.in_(voted_joke_ids))
+        self.session.query(User).filter(User.id.in_(authors)).\
+            update({User.positive_votes_received: User.positive_votes_received - author_votes},
+                   synchronize_session=False)
+
+        rows_count = func.count()
+        voted_jokes = self.session.query(Joke.id, Joke.vote_count, rows_count).\
+            join(association_table, votes.jokes_id == Joke.id).\
+            filter(votes.users_id == user_id).\
+            group_by(Joke.id, Joke.vote_count).all()
+
+        self.session.execute(association_table.delete().where(votes.users_id == user_id))
+        self.session.query(User).filter(User.id == user_id).delete(synchronize_session='evaluate')
+        return deleted_joke_ids, [(joke_id, vote_count, rows > 1) for joke_id, vote_count, rows in voted_jokes]
+
+    def get_user_rank(self, user, session=None):
+        """
+        Rank of user by score, 1 is the best. Only users with higher score are counted.
+
+        Arguments:
+            session: Session to query, `self.session` by default
+
+        Returns:
+            int
+        """
+        session = session if session is not None else self.session
+        return session.query(User).filter(User.score > user.get_score()).count() + 1
+
+    def get_jokes_by_ids(self, joke_ids):
+        """
+        Load jokes with given ids, keeping the order of `joke_ids`. Ids of jokes which no longer exist are skipped.
+
+        Arguments:
+            joke_ids: list of int
+
+        Returns:
+            list of Joke
+        """
+        if len(joke_ids) == 0:
+            return []
+
+        jokes = self.session.query(Joke).filter(Joke.id.in_(joke_ids)).all()
+        jokes_by_id = {joke.get_id(): joke for joke in jokes}
+        return [jokes_by_id[joke_id] for joke_id in joke_ids if joke_id in jokes_by_id]
+
+    def format_joke_ids(self, joke_ids, start_index, end_index):
+        """
+        Same as `format_jokes`, but only jokes on the requested page are loaded from database
+
+        Arguments:
+              joke_ids: list of int
+              start_index: int
+              end_index: int
+
+        Returns:
+              tuple:  string: reply message
+                      bool: True if all jokes were shown
+        """
+        page_jokes = self.get_jokes_by_ids(joke_ids[start_index:end_index])
+        reply_message, _ = self.format_jokes(page_jokes, 0, len(page_jokes))
+        all_jokes_shown = len(joke_ids) <= end_index
+        return reply_message, all_jokes_shown
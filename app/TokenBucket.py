@@ -0,0 +1,38 @@
+import time
+
+
+class TokenBucket:
+    """
+    Rate limiter: `rate` tokens are added per second up to `capacity`, every action takes some of them.
+
+    Not thread-safe, a bucket is used by one thread.
+    """
+    def __init__(self, rate, capacity, now=None):
+        """
+        Arguments:
+            rate: float, tokens added per second
+            capacity: float, tokens the bucket holds at most, i.e. the largest burst
+            now: float, `time.monotonic()` by default
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now if now is not None else time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, cost=1, now=None):
+        """
+        Take `cost` tokens if there are enough
+
+        Returns:
+            float: 0 if the tokens were taken, otherwise seconds until there will be enough of them
+        """
+        now = now if now is not None else time.monotonic()
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate
@@ -0,0 +1,95 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app.models import SeenUpdate
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """
+    Class to recognize updates Telegram delivered again, e.g. because the webhook answered too slowly.
+
+    Ids of updates seen in the last `window` seconds are kept in memory, at most `size_max` of them, so a check is a
+    dict lookup. With `get_engine` the ids are also inserted into the `seen_updates` table, so an update delivered
+    to another process (e.g. the old one during a restart) is recognized too; rows older than `window` are deleted
+    from time to time. If the table can't be reached, updates are let through.
+
+    Safe to use from multiple threads.
+    """
+    PRUNE_INTERVAL = 60  # seconds between deletions of old rows of `seen_updates`
+
+    def __init__(self, window, size_max, metrics, get_engine=None):
+        """
+        Arguments:
+            window: float, seconds an update id is remembered for
+            size_max: int, update ids kept in memory at most
+            metrics: Metrics, suppressed duplicates are counted in it
+            get_engine: function returning the sqlalchemy Engine of the shared table. Optional, memory only without it.
+        """
+        self.window = window
+        self.size_max = size_max
+        self.metrics = metrics
+        self.get_engine = get_engine
+
+        self.seen = OrderedDict()  # update id -> time.monotonic() it was seen, oldest first
+        self.lock = threading.Lock()
+        self.next_prune = 0
+
+    def is_duplicate(self, update_id, now=None):
+        """
+        Remember update and check whether it was seen before
+
+        Returns:
+            bool: True if an update with the same id was seen in the last `window` seconds
+        """
+        now = now if now is not None else time.monotonic()
+        with self.lock:
+            while len(self.seen) > 0:
+                oldest_id, seen_at = next(iter(self.seen.items()))
+                if len(self.seen) < self.size_max and now - seen_at <= self.window:
+                    break
+                del self.seen[oldest_id]
+
+            if update_id in self.seen:
+                self.metrics.increment('updates.duplicates')
+                return True
+            self.seen[update_id] = now
+
+        if self.get_engine is not None and self.is_shared_duplicate(update_id):
+            self.metrics.increment('updates.duplicates')
+            self.metrics.increment('updates.duplicates_shared')
+            return True
+        return False
+
+    def is_shared_duplicate(self, update_id):
+        """
+        Insert update id into `seen_updates`
+
+        Returns:
+            bool: True if another process inserted it already
+        """
+        now = datetime.utcnow()
+        try:
+            with self.get_engine().begin() as connection:
+                connection.execute(SeenUpdate.__table__.insert(), {'update_id': update_id, 'seen_at': now})
+        except IntegrityError:
+            return True
+        except Exception as e:
+            logger.error('Checking update {} in seen_updates failed: {}'.format(update_id, e))
+            return False
+
+        if time.monotonic() >= self.next_prune:
+            self.next_prune = time.monotonic() + self.PRUNE_INTERVAL
+            try:
+                with self.get_engine().begin() as connection:
+                    connection.execute(SeenUpdate.__table__.delete().
+                                       where(SeenUpdate.seen_at < now - timedelta(seconds=self.window)))
+            except Exception as e:
+                logger.error('Deleting old rows of seen_updates failed: {}'.format(e))
+        return False
@@ -0,0 +1,386 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Queue
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram import Update
+from telegram.utils.request import Request
+
+from app.CommandRouter import CommandRouter
+
+logger = logging.getLogger(__name__)
+
+# Kinds of updates without a command, the first one the update has is its label
+UPDATE_KINDS = ('message', 'edited_message', 'callback_query', 'inline_query', 'chosen_inline_result',
+                'channel_post', 'edited_channel_post', 'shipping_query', 'pre_checkout_query')
+
+# Phases of an update, in the order they are written. Time spent in a nested phase (e.g. `db` in `get_user`) is
+# counted only in the nested one, so phases of a trace add up to its total.
+PHASES = (
+    # Front process reading the webhook request until it's routed to a worker. Measured with WORKERS > 1 only: in a
+    # single process the webhook request is read by telegram.ext.Updater, which doesn't tell when it started.
+    'receive',
+    'queue',  # waiting in the queue until the dispatcher takes it
+    'route',  # groups before the handler (duplicates, flood control, eviction) and picking the handler
+    'get_user',  # loading the user, see HahOrNahBot.get_user
+    'db',  # executing SQL statements
+    'select',  # choosing the response, e.g. the joke of /random_joke
+    'telegram',  # Bot API requests, one per round trip
+    'handler',  # rest of the handler
+    'after',  # groups after the handler, persisting chat state and releasing the session
+)
+
+
+def get_trace_files(directory):
+    """
+    Returns:
+        list of paths of trace files in directory, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.startswith('traces-') and name.endswith('.log'))
+    return [os.path.join(directory, name) for name in names]
+
+
+def get_label(update):
+    """
+    Returns:
+        string: command of the update, e.g. `/random_joke`, or its kind, e.g. `message`, `callback_query`
+    """
+    command = CommandRouter.get_command(update)
+    if command is not None:
+        return command
+    for kind in UPDATE_KINDS:
+        if getattr(update, kind) is not None:
+            return kind
+    return 'other'
+
+
+def parse_trace(line):
+    """
+    Arguments:
+        line: string, written by `Trace.format`
+
+    Returns:
+        tuple: float: timestamp the update was received
+               int: update id
+               string: label, see `get_label`
+               dict: phase -> (milliseconds, count), including `total`
+
+    Raises:
+        ValueError: line isn't a trace
+    """
+    fields = line.split()
+    if len(fields) < 4:
+        raise ValueError('Not a trace: {!r}'.format(line))
+    phases = {}
+    for field in fields[3:]:
+        name, value = field.split('=', 1)
+        milliseconds, _, count = value.partition('/')
+        phases[name] = (float(milliseconds), int(count) if count else 1)
+    return float(fields[0]), int(fields[1]), fields[2], phases
+
+
+class Trace:
+    """
+    Timings of one update, recorded by the dispatcher thread
+    """
+    def __init__(self, update_id, label, received, wait_seconds, receive_seconds):
+        self.update_id = update_id
+        self.label = label
+        self.received = received  # time.time()
+        self.wait_seconds = wait_seconds
+        self.receive_seconds = receive_seconds
+        self.phases = {}  # phase -> [seconds, count]
+        # [phase, time.perf_counter() it was entered or resumed], innermost last
+        self.stack = [['route', time.perf_counter()]]
+
+    def add(self, phase, seconds, count):
+        times = self.phases.setdefault(phase, [0, 0])
+        times[0] += seconds
+        times[1] += count
+
+    def enter(self, phase, now):
+        outer = self.stack[-1]
+        self.add(outer[0], now - outer[1], 0)
+        self.stack.append([phase, now])
+
+    def pop(self, now):
+        inner, entered = self.stack.pop()
+        self.add(inner, now - entered, 1)
+        self.stack[-1][1] = now
+        return inner
+
+    def exit(self, phase, now):
+        # A statement which failed doesn't exit its phase, the next exit of an outer phase closes it
+        while len(self.stack) > 1 and self.pop(now) != phase:
+            pass
+
+    def switch(self, phase, now):
+        """
+        Replace the outermost phase, e.g. `route` by `handler`
+        """
+        while len(self.stack) > 1:
+            self.pop(now)
+        outer, entered = self.stack[0]
+        self.add(outer, now - entered, 1)
+        self.stack[0] = [phase, now]
+
+    def format(self):
+        """
+        Returns:
+            string: `received update_id label total=ms phase=ms[/count] ...`, e.g.
+                `1760000000.123 5123 /random_joke total=48.10 queue=0.21 route=0.40 get_user=0.11 db=3.02/4 ...`
+        """
+        phases = dict(self.phases)
+        if self.wait_seconds is not None:
+            phases['queue'] = [self.wait_seconds, 1]
+        if self.receive_seconds is not None:
+            phases['receive'] = [self.receive_seconds, 1]
+        total = sum(seconds for seconds, _ in phases.values())
+
+        fields = ['{:.3f}'.format(self.received), str(self.update_id), self.label, 'total={:.2f}'.format(total * 1000)]
+        for phase in PHASES:
+            if phase not in phases:
+                continue
+            seconds, count = phases[phase]
+            if count > 1:
+                fields.append('{}={:.2f}/{}'.format(phase, seconds * 1000, count))
+            else:
+                fields.append('{}={:.2f}'.format(phase, seconds * 1000))
+        return ' '.join(fields)
+
+
+class UpdateTracer:
+    """
+    Class to record where the time of a sample of updates goes, from the webhook to the last Bot API response.
+
+    `begin` decides whether the update is traced, with probability `sample_rate`. The dispatcher thread then marks
+    the phases (see PHASES) with `phase` and `switch`; SQL statements and Bot API requests are timed by hooks
+    (SQLAlchemy engine events and TracedRequest). Work done by other threads is never counted, traces are kept in
+    thread-local storage. `end` queues one line per trace.
+
+    Lines are appended to the current file by a background thread every `flush_interval` seconds. A new file is
+    started when it reaches `max_file_size` bytes, and only the `files_max` newest files of the directory are kept.
+    File names contain the process id, so sharded workers can share the directory.
+
+    With `sample_rate` 0 nothing is hooked and every method returns right away.
+    Use tools/summarize_traces.py to get percentiles of every phase.
+    """
+    RECEIVED_MAX = 10000  # receive times of updates still queued kept at most
+
+    def __init__(self, directory, sample_rate, flush_interval, max_file_size, files_max, metrics):
+        """
+        Arguments:
+            directory: string, created if it doesn't exist
+            sample_rate: float, share of updates traced, from 0 to 1
+            flush_interval: float, seconds between writes
+            max_file_size: int, bytes
+            files_max: int, older files are deleted
+            metrics: Metrics, written traces are counted in it
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.max_file_size = max_file_size
+        self.files_max = files_max
+        self.metrics = metrics
+
+        self.enabled = sample_rate > 0
+        self.local = threading.local()
+        self.received = OrderedDict()  # update id -> (time.time() received, seconds receiving took or None)
+        self.buffer = []  # lines
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.path = None
+        self.files_started = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+        if self.enabled:
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def note_received(self, update_id, received, receive_seconds=None):
+        """
+        Remember when an update was received, called before it's put into the queue
+
+        Arguments:
+            received: float, time.time()
+            receive_seconds: float, time it took to receive and route it, None if it was put into the queue right away
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.received[update_id] = (received, receive_seconds)
+            while len(self.received) > self.RECEIVED_MAX:
+                self.received.popitem(last=False)
+
+    def begin(self, update):
+        """
+        Start tracing update, if it's sampled
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            received, receive_seconds = self.received.pop(update.update_id, (None, None))
+        if random.random() >= self.sample_rate:
+            self.local.trace = None
+            return
+
+        now = time.time()
+        wait_seconds = None
+        if received is not None:
+            wait_seconds = max(now - received - (receive_seconds or 0), 0)
+        else:
+            received = now
+        self.local.trace = Trace(update.update_id, get_label(update), received, wait_seconds, receive_seconds)
+
+    def get_trace(self):
+        return getattr(self.local, 'trace', None) if self.enabled else None
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Count time spent in the block in phase `name` of the current trace
+        """
+        trace = self.get_trace()
+        if trace is None:
+            yield
+            return
+        trace.enter(name, time.perf_counter())
+        try:
+            yield
+        finally:
+            trace.exit(name, time.perf_counter())
+
+    def switch(self, name):
+        """
+        Count the rest of the update in phase `name`
+        """
+        trace = self.get_trace()
+        if trace is not None:
+            trace.switch(name, time.perf_counter())
+
+    def end(self):
+        """
+        Finish trace of the current update and queue it to be written
+        """
+        trace = self.get_trace()
+        if trace is None:
+            return
+        self.local.trace = None
+        trace.switch(None, time.perf_counter())
+        line = trace.format()
+        with self.lock:
+            self.buffer.append(line)
+        self.metrics.increment('traces.recorded')
+
+    def discard(self):
+        """
+        Drop trace of the current update, e.g. because it was throttled
+        """
+        if self.enabled:
+            self.local.trace = None
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = self.get_trace()
+        if trace is not None:
+            trace.enter('db', time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        trace = self.get_trace()
+        if trace is not None:
+            trace.exit('db', time.perf_counter())
+
+    def new_file_path(self):
+        self.files_started += 1
+        name = 'traces-{}-{}-{}.log'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(),
+                                            self.files_started)
+        return os.path.join(self.directory, name)
+
+    def delete_old_files(self):
+        for path in get_trace_files(self.directory)[:-self.files_max]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # deleted by another worker
+                pass
+
+    def flush(self):
+        """
+        Append queued traces to the current file
+        """
+        with self.lock:
+            lines = self.buffer
+            self.buffer = []
+        if len(lines) == 0:
+            return
+
+        with self.write_lock:
+            try:
+                if self.path is None or os.path.getsize(self.path) >= self.max_file_size:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self.path = self.new_file_path()
+                    self.delete_old_files()
+                with open(self.path, 'a') as trace_file:
+                    trace_file.write('\n'.join(lines) + '\n')
+            except OSError as e:
+                # Traces are only samples, they aren't written again
+                logger.error('Writing traces failed: {}'.format(e))
+                self.path = None
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.thread = threading.Thread(target=self.run, name='update_tracer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop background thread and write remaining traces
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        if self.enabled:
+            event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+            self.enabled = False
+
+
+class TracedRequest(Request):
+    """
+    Request counting every Bot API round trip of the dispatcher thread in the `telegram` phase of its trace
+    """
+    def __init__(self, tracer, **kwargs):
+        super().__init__(**kwargs)
+        self.tracer = tracer
+
+    def post(self, url, data, timeout=None):
+        with self.tracer.phase('telegram'):
+            return super().post(url, data, timeout=timeout)
+
+
+class TracedQueue(Queue):
+    """
+    Update queue of Updater remembering when updates were put into it, for the `queue` phase of their traces
+    """
+    def __init__(self, tracer):
+        super().__init__()
+        self.tracer = tracer
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, Update):
+            self.tracer.note_received(item.update_id, time.time())
+        super().put(item, block, timeout)
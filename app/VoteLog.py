@@ -0,0 +1,149 @@
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Every file starts with the header, followed by fixed-size records
+FILE_HEADER = b'HNVOTES1'
+# timestamp (seconds since epoch), user id, joke id, positive
+RECORD = struct.Struct('<dqq?')
+RECORD_FIELDS = ('timestamp', 'user_id', 'joke_id', 'positive')
+
+
+def get_log_files(directory):
+    """
+    Returns:
+        list of paths of vote log files in directory, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.startswith('votes-') and name.endswith('.bin'))
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_records(path, chunk_records=10000):
+    """
+    Read records of a vote log file in chunks, so memory use doesn't depend on file size.
+
+    A record cut off at the end of the file (file still being written, or process killed while writing) is skipped.
+
+    Arguments:
+        path: string
+        chunk_records: int, maximum number of records in one chunk
+
+    Yields:
+        list of (timestamp, user id, joke id, positive) tuples
+
+    Raises:
+        ValueError: file isn't a vote log
+    """
+    with open(path, 'rb') as log_file:
+        if log_file.read(len(FILE_HEADER)) != FILE_HEADER:
+            raise ValueError('{} is not a vote log file'.format(path))
+
+        while True:
+            data = log_file.read(RECORD.size * chunk_records)
+            complete_size = len(data) - len(data) % RECORD.size
+            if complete_size == 0:
+                return
+            yield list(RECORD.iter_unpack(data[:complete_size]))
+
+
+class VoteLog:
+    """
+    Class to append every vote to a timestamped, append-only log on disk, for offline analysis.
+
+    `record` only adds the vote to a buffer, a background thread appends buffered votes to the current file every
+    `flush_interval` seconds. Files are never modified once written, a new file is started when the current one
+    reaches `max_file_size` bytes. File names contain the process id, so sharded workers can share the directory.
+
+    Use tools/export_votes.py to convert the log into a columnar format.
+    """
+    def __init__(self, directory, flush_interval, max_file_size):
+        """
+        Arguments:
+            directory: string, created if it doesn't exist
+            flush_interval: float, seconds between writes
+            max_file_size: int, bytes
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.max_file_size = max_file_size
+
+        self.buffer = []  # packed records
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.path = None  # file records are appended to
+        self.files_started = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, user_id, joke_id, positive, timestamp=None):
+        """
+        Queue vote to be written
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        record = RECORD.pack(timestamp, user_id, joke_id, positive)
+        with self.lock:
+            self.buffer.append(record)
+
+    def new_file_path(self):
+        # Counter makes the name unique even when two files are started within a second
+        self.files_started += 1
+        name = 'votes-{}-{}-{}.bin'.format(time.strftime('%Y%m%dT%H%M%S', time.gmtime()), os.getpid(),
+                                           self.files_started)
+        return os.path.join(self.directory, name)
+
+    def flush(self):
+        """
+        Append buffered records to the current file
+        """
+        with self.lock:
+            records = self.buffer
+            self.buffer = []
+        if len(records) == 0:
+            return
+
+        with self.write_lock:
+            data = b''.join(records)
+            written = 0  # bytes of data in the file
+            try:
+                if self.path is None or os.path.getsize(self.path) >= self.max_file_size:
+                    os.makedirs(self.directory, exist_ok=True)
+                    path = self.new_file_path()
+                    with open(path, 'xb') as log_file:
+                        log_file.write(FILE_HEADER)
+                    self.path = path
+
+                # Unbuffered, so `written` counts what reached the file even if a later write fails
+                with open(self.path, 'ab', buffering=0) as log_file:
+                    while written < len(data):
+                        written += log_file.write(data[written:])
+                    os.fsync(log_file.fileno())
+            except OSError as e:
+                logger.error('Writing vote log failed: {}'.format(e))
+                # Records already in the file aren't written again, they would be exported twice. A record cut off
+                # at its end is skipped by readers, it's written again to a new file with the rest.
+                self.path = None
+                with self.lock:
+                    self.buffer = records[written // RECORD.size:] + self.buffer
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='vote_log', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop background thread and write remaining records
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
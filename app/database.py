@@ -0,0 +1,48 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+# Applied to every new SQLite connection
+SQLITE_PRAGMAS = (
+    'journal_mode=WAL',  # readers don't block the writer and vice versa, persisted in the database file
+    'synchronous=NORMAL',  # in WAL mode a crash can lose the last transactions, but never corrupts the database
+    'mmap_size=268435456',  # 256 MB of the database file read through memory map
+    'cache_size=-65536',  # 64 MB page cache per connection
+    'temp_store=MEMORY',
+)
+SQLITE_BUSY_TIMEOUT = 30  # seconds a connection waits for a lock held by another connection or process
+SQLITE_POOL_SIZE = 5
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
+
+
+def create_database_engine(database_url):
+    """
+    Create engine for database url, configured for the database it points to.
+
+    SQLite connections are tuned with SQLITE_PRAGMAS and kept in a pool, so the page cache and memory map survive
+    between sessions. They are shared by the dispatcher and background threads, each connection is used by one
+    thread at a time. In-memory databases use a single connection, each new connection would be a new database.
+
+    Arguments:
+        database_url: string
+
+    Returns:
+        Engine
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url)
+
+    connect_args = {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT}
+    if url.database in (None, '', ':memory:'):
+        return create_engine(url, connect_args=connect_args, poolclass=StaticPool)
+
+    engine = create_engine(url, connect_args=connect_args, poolclass=QueuePool, pool_size=SQLITE_POOL_SIZE)
+    event.listen(engine, 'connect', set_sqlite_pragmas)
+    return engine
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, Table, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, String, Text, Boolean, DateTime, Table, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -12,6 +12,8 @@ Base = declarative_base()
 association_table = Table('association', Base.metadata,
                           Column('users_id', Integer, ForeignKey('users.id')),
                           Column('jokes_id', Integer, ForeignKey('jokes.id')),
+                          Index('ix_association_users_id_jokes_id', 'users_id', 'jokes_id'),
+                          Index('ix_association_jokes_id', 'jokes_id'),
                           )
 
 logger = logging.getLogger(__name__)
@@ -24,13 +26,17 @@ class User(Base):
     jokes_voted_for = relationship('Joke',
                                    secondary=association_table,
                                    back_populates='users_voted')
+    # Jokes aren't owned by their voters, so nothing cascades from this side. Deleting jokes and users is done
+    # with set-based statements, see HahOrNahBotHelper.delete_jokes and purge_user.
     jokes_voted_positive = relationship('Joke',
                                         secondary=association_table,
-                                        back_populates='users_voted_positive',
-                                        cascade='all, delete, delete-orphan',
-                                        single_parent=True)
+                                        back_populates='users_voted_positive')
     jokes_submitted = relationship('Joke', backref='author',cascade='all, delete, delete-orphan', single_parent=True)
-    score = Column('score', Integer, default=0)
+    score = Column('score', Integer, default=0, index=True)
+    # Aggregates maintained with atomic `column = column + 1` updates, so /profile doesn't load relationships
+    jokes_submitted_count = Column('jokes_submitted_count', Integer, default=0)
+    votes_cast_count = Column('votes_cast_count', Integer, default=0)
+    positive_votes_received = Column('positive_votes_received', Integer, default=0)
 
     def get_id(self):
         return self.id
@@ -51,13 +57,25 @@ class User(Base):
     def get_jokes_voted_positive(self):
         return self.jokes_voted_positive
 
+    def get_jokes_submitted_count(self):
+        return self.jokes_submitted_count or 0
+
+    def get_votes_cast_count(self):
+        return self.votes_cast_count or 0
+
+    def get_positive_votes_received(self):
+        return self.positive_votes_received or 0
+
     def get_average_score(self):
-        jokes_submitted_count = len(self.get_jokes_submitted())
-        score = self.get_score()
+        """
+        Positive votes received per submitted joke
+        """
+        jokes_submitted_count = self.get_jokes_submitted_count()
+        positive_votes_received = self.get_positive_votes_received()
 
         try:
-            average_score = jokes_submitted_count / score
-            return average_score
+            average_score = positive_votes_received / jokes_submitted_count
+            return round(average_score, 2)
         except ZeroDivisionError:
             return 0
 
@@ -92,17 +110,22 @@ class User(Base):
             raise InvalidVote(error_string)
 
         else:
+            # SQL expressions, evaluated by database when flushed, so concurrent changes aren't overwritten
             if positive:
-                self.score += 1
+                self.score = User.score + 1
                 self.jokes_voted_positive.append(joke)
             else:
-                self.score -= 1
+                self.score = User.score - 1
 
             self.jokes_voted_for.append(joke)
             joke.register_vote(user=self, positive=positive)
 
+            self.votes_cast_count = User.votes_cast_count + 1
+            if positive:
+                joke.author.positive_votes_received = User.positive_votes_received + 1
+
     def __repr__(self):
-        return 'username: {username} \nid: {id}\nscore: {score}\njokes submitted: {jokes_submitted}'.format(username=self.get_username(), id=self.get_id(), score=self.get_score(), jokes_submitted=len(self.jokes_submitted))
+        return 'username: {username} \nid: {id}\nscore: {score}\njokes submitted: {jokes_submitted}'.format(username=self.get_username(), id=self.get_id(), score=self.get_score(), jokes_submitted=self.get_jokes_submitted_count())
 
 
 class Joke(Base):
@@ -110,15 +133,15 @@ class Joke(Base):
 
     id = Column('id', Integer, primary_key=True, unique=True)
     body = Column('body', String(1000))
-    vote_count = Column(Integer)
-    approved = Column(Boolean, unique=False, default=False)
+    vote_count = Column(Integer, index=True)
+    approved = Column(Boolean, unique=False, default=False, index=True)
     users_voted = relationship('User',
                                secondary=association_table,
                                back_populates='jokes_voted_for')
     users_voted_positive = relationship('User',
                                         secondary=association_table,
                                         back_populates='jokes_voted_positive')
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True)
 
     def get_id(self):
         return self.id
@@ -154,11 +177,12 @@ class Joke(Base):
         Returns:
             None
         """
+        # SQL expression, evaluated by database when flushed
         if positive:
-            self.vote_count += 1
+            self.vote_count = Joke.vote_count + 1
             self.users_voted_positive.append(user)
         else:
-            self.vote_count -= 1
+            self.vote_count = Joke.vote_count - 1
 
         self.users_voted.append(user)
 
@@ -167,6 +191,55 @@ class Joke(Base):
         # For some reason the formatting is off when using multiline string
         return joke_info
 
+class ChatState(Base):
+    """
+    Conversation state of one user, serialized by ChatStateStore
+    """
+    __tablename__ = 'chat_states'
+
+    user_id = Column('user_id', BigInteger, primary_key=True, autoincrement=False)
+    data = Column('data', Text)
+
+
+class StatsRollup(Base):
+    """
+    Number of events of one kind (`metric`) in one hour or day, maintained by StatsRollups
+    """
+    __tablename__ = 'stats_rollups'
+
+    period = Column('period', String(8), primary_key=True)  # `hour` or `day`
+    bucket_start = Column('bucket_start', DateTime, primary_key=True)  # UTC
+    metric = Column('metric', String(32), primary_key=True)
+    value = Column('value', Integer, default=0)
+
+
+class Broadcast(Base):
+    """
+    Progress of one broadcast to all users, JokeOfTheDay resumes an interrupted broadcast from it
+    """
+    __tablename__ = 'broadcasts'
+
+    name = Column('name', String(64), primary_key=True)  # e.g. `joke_of_the_day 2026-10-19`
+    joke_id = Column('joke_id', Integer)
+    last_user_id = Column('last_user_id', BigInteger)  # users up to this id were handled, None before the first
+    sent = Column('sent', Integer, default=0)
+    failed = Column('failed', Integer, default=0)
+    started_at = Column('started_at', DateTime)
+    finished_at = Column('finished_at', DateTime)
+    claimed_until = Column('claimed_until', DateTime)  # renewed by the process sending, others wait until it passes
+    claimed_by = Column('claimed_by', String(32))  # token of the claim, progress is written only by its holder
+
+
+class SeenUpdate(Base):
+    """
+    Id of an update received recently, UpdateDeduplicator uses it to drop updates delivered to several processes
+    """
+    __tablename__ = 'seen_updates'
+
+    update_id = Column('update_id', BigInteger, primary_key=True, autoincrement=False)
+    seen_at = Column('seen_at', DateTime, index=True)
+
+
 if __name__ == '__main__':
     a = User(username='asdf', id=0)
     a.set_username('fasdljkfsadlfjda', 21039)
\ No newline at end of file
@@ -0,0 +1,113 @@
+"""
+Throughput of the joke of the day broadcast, and resuming it after a crash.
+
+Seeds a temporary SQLite database with `--users` users and sends the broadcast through the fake Bot API from
+benchmarks/fake_bot_api.py. After `--crash-after` messages the sending thread dies without saving progress, as if
+the process was killed, and a second JokeOfTheDay takes the broadcast over once the claim expired. Every user
+has to get the joke, users of the chunk in progress at the crash get it twice.
+
+Usage:
+    python -m benchmarks.broadcast --users 100000 --rate 2000 --crash-after 30100
+"""
+import argparse
+import os
+import tempfile
+import time
+from collections import Counter
+
+from sqlalchemy.orm import sessionmaker
+from telegram import Bot
+
+from app.JokeOfTheDay import JokeOfTheDay
+from app.Metrics import Metrics
+from app.database import create_database_engine
+from app.models import Broadcast
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.startup import TOKEN
+from tools.seed import seed_database
+
+
+class Crash(BaseException):
+    """
+    Raised in the sending thread, not caught by JokeOfTheDay, so no progress is saved
+    """
+
+
+class CrashingBot(Bot):
+    def __init__(self, token, base_url, crash_after):
+        super().__init__(token, base_url=base_url)
+        self.crash_after = crash_after
+        self.sent = 0
+
+    def send_message(self, *args, **kwargs):
+        if self.crash_after is not None and self.sent >= self.crash_after:
+            raise Crash()
+        self.sent += 1
+        return super().send_message(*args, **kwargs)
+
+
+def run_broadcast(api, Session, args, crash_after, name):
+    """
+    Returns:
+        tuple: float: seconds the broadcast ran for
+               Metrics
+    """
+    metrics = Metrics()
+    joke_of_the_day = JokeOfTheDay(CrashingBot(TOKEN, api.base_url, crash_after), Session, metrics, lambda: False,
+                                   'Joke of the day:', args.rate, args.chunk_size, 0)
+    joke_of_the_day.CLAIM_SECONDS = args.claim_seconds
+    joke_of_the_day.RENEW_SECONDS = args.claim_seconds / 3
+    start = time.perf_counter()
+    joke_of_the_day.start(name)
+    joke_of_the_day.thread.join()
+    return time.perf_counter() - start, metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--jokes', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=2000, help='messages per second at most')
+    parser.add_argument('--chunk-size', type=int, default=200)
+    parser.add_argument('--crash-after', type=int, default=30100, help='messages sent before the crash')
+    parser.add_argument('--claim-seconds', type=float, default=1, help='seconds until a crashed claim expires')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay of every Bot API response')
+    parser.add_argument('--error-share', type=float, default=0, help='share of 500 responses')
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency_ms / 1000, error_share=args.error_share)
+    api.start()
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_database_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        seed_database(engine, args.users, args.jokes, 0)
+        Session = sessionmaker(bind=engine)
+        name = JokeOfTheDay.get_name()
+
+        first_seconds, _ = run_broadcast(api, Session, args, args.crash_after, name)
+        time.sleep(args.claim_seconds)
+        second_seconds, metrics = run_broadcast(api, Session, args, None, name)
+
+        session = Session()
+        broadcast = session.query(Broadcast).get(name)
+        finished, recorded_sent = broadcast.finished_at is not None, broadcast.sent
+        session.close()
+        engine.dispose()
+    api.stop()
+
+    received = Counter(chat_id for _, method, chat_id in api.responses if method == 'sendMessage')
+    messages = sum(received.values())
+    seconds = first_seconds + second_seconds
+    print('{:<28} {:>10}'.format('users', args.users))
+    print('{:<28} {:>10}'.format('messages', messages))
+    print('{:<28} {:>10.1f}'.format('seconds', seconds))
+    print('{:<28} {:>10.1f}'.format('messages/s', messages / seconds))
+    print('{:<28} {:>10.1f}'.format('messages/s after resume', metrics.get('broadcast.messages_per_second')))
+    print('{:<28} {:>10}'.format('users missed', args.users - len(received)))
+    print('{:<28} {:>10}'.format('users sent twice', sum(count > 1 for count in received.values())))
+    print('{:<28} {:>10}'.format('sent (recorded)', recorded_sent))
+    print('{:<28} {:>10}'.format('finished', 'yes' if finished else 'no'))
+    print('ETA for {} users at 20 messages/s: {:.0f} min'.format(args.users, args.users / 20 / 60))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Throughput of the queries behind the most used commands, run through HahOrNahBotHelper like the handlers do.
+
+By default a temporary SQLite database is seeded and measured twice: with the tuned profile from app/database.py
+and with SQLite's default journal and sync settings, which gives a baseline without any database server.
+`--database-url` measures an empty database of any kind instead, e.g. PostgreSQL.
+
+Usage:
+    python -m benchmarks.database --operations 2000
+    python -m benchmarks.database --database-url postgresql://postgres@localhost/benchmark
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import func
+
+from app import database
+from app.TelegramBotHelper import HahOrNahBotHelper
+from app.models import Joke, User
+from tools.seed import seed_database
+
+
+def vote(helper, user):
+    # Joke is picked by id like JokeRanking does, so mostly the vote and its commit are measured
+    joke_id = random.randrange(helper.session.query(func.max(Joke.id)).scalar() + 1)
+    joke = helper.get_joke(joke_id)
+    if joke is not None and helper.can_vote(user, joke_id):
+        user.vote_for_joke(joke, positive=random.random() < 0.6)
+        helper.session.commit()
+
+
+OPERATIONS = [
+    ('/random_joke (unvoted joke)', lambda helper, user: helper.get_random_unvoted_joke(user)),
+    ('/hah (vote and commit)', vote),
+    ('/profile (rank)', lambda helper, user: helper.get_user_rank(user)),
+    ('/favorites (ids)', lambda helper, user: helper.get_favorite_joke_ids(user, {})),
+    ('/stats (counts)', lambda helper, user: helper.get_stats()),
+]
+
+
+def measure(database_url, users_count, jokes_count, votes_per_user, operations_count):
+    """
+    Returns:
+        list of (operation name, operations per second)
+    """
+    seed_database(database.create_database_engine(database_url), users_count, jokes_count, votes_per_user)
+    helper = HahOrNahBotHelper(database_url, {'min': 10, 'max': 1000}, {'min': 5, 'max': 20}, set())
+    helper.init_database()
+    # Only ids are kept, users are loaded per operation like `get_user` does, so the session stays small
+    user_ids = [user_id for user_id, in helper.session.query(User.id)]
+    generator = random.Random(0)
+
+    results = []
+    for name, operation in OPERATIONS:
+        start = time.perf_counter()
+        for _ in range(operations_count):
+            operation(helper, helper.session.query(User).get(generator.choice(user_ids)))
+        helper.session.commit()
+        results.append((name, operations_count / (time.perf_counter() - start)))
+    helper.engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='empty database to be seeded, temporary SQLite files by default')
+    parser.add_argument('--operations', type=int, default=500, help='operations of each kind')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--jokes', type=int, default=10000)
+    parser.add_argument('--votes-per-user', type=int, default=20)
+    args = parser.parse_args()
+    sizes = (args.users, args.jokes, args.votes_per_user, args.operations)
+
+    if args.database_url is not None:
+        profiles = [('ops/s', measure(args.database_url, *sizes))]
+    else:
+        tuned_pragmas = database.SQLITE_PRAGMAS
+        profiles = []
+        with tempfile.TemporaryDirectory() as directory:
+            profiles.append(('tuned ops/s', measure('sqlite:///' + os.path.join(directory, 'tuned.db'), *sizes)))
+            database.SQLITE_PRAGMAS = ('journal_mode=DELETE', 'synchronous=FULL')
+            try:
+                profiles.append(('default ops/s', measure('sqlite:///' + os.path.join(directory, 'default.db'),
+                                                          *sizes)))
+            finally:
+                database.SQLITE_PRAGMAS = tuned_pragmas
+
+    print('{:<30}'.format('operation') + ''.join('{:>15}'.format(title) for title, _ in profiles))
+    for index, (name, _) in enumerate(OPERATIONS):
+        print('{:<30}'.format(name) + ''.join('{:>15.0f}'.format(results[index][1]) for _, results in profiles))
+
+
+if __name__ == '__main__':
+    main()
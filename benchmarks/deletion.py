@@ -0,0 +1,102 @@
+"""
+Time to delete a joke with many votes and to purge a user who voted a lot, set-based vs. through the ORM.
+
+A temporary SQLite database is seeded with `--votes` users, all of them voting for the first joke and for
+`--votes-per-user` others. Measured are HahOrNahBotHelper.delete_jokes and purge_user, which adjust aggregates with
+aggregate updates and delete rows with set-based statements, and as a baseline `session.delete(joke)`, which loads
+every voter of the joke into the session twice (for both relationships over the association table) and deletes
+association rows one by one. Its flush fails once positive votes (two rows each) make the number of deleted rows
+differ from the expected one, the time until then is reported.
+Every measurement runs on a fresh copy of the database and includes the commit.
+
+Usage:
+    python -m benchmarks.deletion --votes 100000
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sqlalchemy.orm.exc import StaleDataError
+
+from app.TelegramBotHelper import HahOrNahBotHelper
+from app.models import Joke
+from tools.seed import seed_database
+from app.database import create_database_engine
+
+
+def delete_with_orm(helper, joke_id):
+    helper.session.delete(helper.session.query(Joke).get(joke_id))
+
+
+def delete_set_based(helper, joke_id):
+    helper.delete_jokes(Joke.id == joke_id)
+
+
+def purge_set_based(helper, user_id):
+    helper.purge_user(user_id)
+
+
+def measure(seeded_path, directory, operation, argument):
+    """
+    Returns:
+        tuple: float: seconds the operation and its commit took on a copy of the seeded database
+               string: error the commit failed with, None if it didn't
+    """
+    path = os.path.join(directory, 'copy.db')
+    shutil.copy(seeded_path, path)
+    helper = HahOrNahBotHelper('sqlite:///' + path, {'min': 10, 'max': 1000}, {'min': 5, 'max': 20}, set())
+    helper.init_database()
+    error = None
+    try:
+        start = time.perf_counter()
+        try:
+            operation(helper, argument)
+            helper.session.commit()
+        except StaleDataError:
+            error = 'StaleDataError'
+        return time.perf_counter() - start, error
+    finally:
+        helper.session.close()
+        helper.engine.dispose()
+        os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--votes', type=int, default=100000, help='votes of the deleted joke')
+    parser.add_argument('--jokes', type=int, default=1000)
+    parser.add_argument('--votes-per-user', type=int, default=50)
+    parser.add_argument('--skip-orm', action='store_true', help="don't measure session.delete, it takes long")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        seeded_path = os.path.join(directory, 'seeded.db')
+        engine = create_database_engine('sqlite:///' + seeded_path)
+        seed_database(engine, args.votes + 1, args.jokes, args.votes_per_user, approved_share=1)
+        # Every user except its author votes for joke 0, every other vote is positive
+        joke_id, author_id = engine.execute('SELECT id, user_id FROM jokes ORDER BY id LIMIT 1').first()
+        engine.execute('DELETE FROM association WHERE jokes_id = {}'.format(joke_id))
+        for parity, rows in ((0, 1), (1, 2)):
+            for _ in range(rows):
+                engine.execute('INSERT INTO association (users_id, jokes_id) SELECT id, {} FROM users '
+                               'WHERE id != {} AND id % 2 = {}'.format(joke_id, author_id, parity))
+        # Seeded counters don't matter, they are only adjusted
+        user_id = engine.execute('SELECT users_id FROM association GROUP BY users_id ORDER BY count(*) DESC '
+                                 'LIMIT 1').scalar()
+        engine.dispose()
+
+        results = [('delete joke, set-based', measure(seeded_path, directory, delete_set_based, joke_id)),
+                   ('purge user, set-based', measure(seeded_path, directory, purge_set_based, user_id))]
+        if not args.skip_orm:
+            results.append(('delete joke, session.delete', measure(seeded_path, directory, delete_with_orm,
+                                                                   joke_id)))
+
+    print('joke with {} votes, users voted for {} jokes'.format(args.votes, args.votes_per_user))
+    for name, (seconds, error) in results:
+        print('{:<30} {:10.1f} ms{}'.format(name, seconds * 1000, ' (failed: {})'.format(error) if error else ''))
+
+
+if __name__ == '__main__':
+    main()
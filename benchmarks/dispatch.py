@@ -0,0 +1,104 @@
+"""
+Per-update cost of picking the handler in the default group, before and after CommandRouter.
+
+Handler selection only: `check_update` of the dispatcher's handlers one after another as Dispatcher does, vs.
+`check_update` of CommandRouter. Handlers aren't run, so no database queries or Bot API requests are measured.
+A share of the chats is put in conversation states first, so conversation lookups and free text are included.
+
+Usage:
+    python -m benchmarks.dispatch --updates 20000 --conversation-share 0.3
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from telegram import Update
+
+from app.HahOrNahBot import HahOrNahBot, SJ_CHOOSING, JOKE_RECEIVED
+from app.database import create_database_engine
+from app.models import Base
+from benchmarks.fake_bot_api import FakeBotApi, command_update
+from benchmarks.startup import TOKEN
+
+TEXTS = ['/random_joke', '/hah', '/nah', '/menu', '/profile', '/favorites', '/next', '/cancel', '/stats',
+         '/my_jokes', '/unknown', 'Why did the chicken cross the road?']
+
+
+def linear_select(handlers, update):
+    for handler in handlers:
+        if handler.check_update(update):
+            return handler
+    return None
+
+
+def router_select(router, update):
+    if router.check_update(update):
+        return router.current_handler
+    return None
+
+
+def measure(select, updates):
+    """
+    Returns:
+        float: microseconds per update
+    """
+    start = time.perf_counter()
+    for update in updates:
+        select(update)
+    return (time.perf_counter() - start) / len(updates) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--chats', type=int, default=1000)
+    parser.add_argument('--conversation-share', type=float, default=0.3, help='share of chats in a conversation')
+    args = parser.parse_args()
+    generator = random.Random(0)
+
+    api = FakeBotApi()
+    api.start()
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        Base.metadata.create_all(create_database_engine(database_url))
+        bot = HahOrNahBot(TOKEN, database_url, base_url=api.base_url, vote_log_directory=directory)
+        bot.init_database()
+        router = bot.command_router
+
+        conversations = {'search': SJ_CHOOSING, 'new_joke': JOKE_RECEIVED}
+        for chat_id in range(1, args.chats + 1):
+            bot.chat_state_store.rehydrate(chat_id)  # state is loaded from database once per user
+            if generator.random() < args.conversation_share:
+                name = generator.choice(sorted(conversations))
+                handler = bot.chat_state_store.conversation_handlers[name]
+                dict.__setitem__(handler.conversations, (chat_id, chat_id), conversations[name])
+
+        updates = []
+        for update_id in range(args.updates):
+            text = generator.choice(TEXTS)
+            data = command_update(update_id, generator.randrange(1, args.chats + 1), text)
+            if not text.startswith('/'):
+                del data['message']['entities']
+            updates.append(Update.de_json(data, bot.updater.bot))
+
+        # Both have to pick the same handler
+        mismatches = sum(linear_select(router.handlers, update) is not router_select(router, update)
+                         for update in updates[:1000])
+
+        results = [('handler list', measure(lambda update: linear_select(router.handlers, update), updates)),
+                   ('CommandRouter', measure(lambda update: router_select(router, update), updates))]
+        bot.engine.dispose()
+    api.stop()
+
+    print('{:<15} {:>12}'.format('dispatch', 'us/update'))
+    for name, microseconds in results:
+        print('{:<15} {:12.1f}'.format(name, microseconds))
+    print('speedup         {:12.2f}'.format(results[0][1] / results[1][1]))
+    if mismatches > 0:
+        print('{} of 1000 updates were routed to a different handler'.format(mismatches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+End-to-end throughput and latency through Updater, the webhook and the Bot API calls of the bot.
+
+Starts the fake Bot API server from benchmarks/fake_bot_api.py, runs `python main.py` pointed to it, pushes
+`--rate` updates per second for `--duration` seconds to the webhook the bot registered, and waits until every
+update is answered. By default the bot uses a temporary SQLite database seeded with tools/seed.py, so the chats
+updates come from are registered users.
+
+Usage:
+    python -m benchmarks.end_to_end --rate 50 --duration 10 --command /random_joke
+    python -m benchmarks.end_to_end --latency-ms 100 --rate-limit-share 0.05 --workers 2
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.database import create_database_engine
+from benchmarks.fake_bot_api import FakeBotApi
+from benchmarks.startup import TOKEN, get_free_port
+from tools.seed import seed_database
+
+
+def run(api, database_url, args):
+    """
+    Returns:
+        tuple: float: seconds from the first update until the last response
+               bool: True if every update was answered in time
+    """
+    port = get_free_port()
+    env = dict(os.environ,
+               TELEGRAM_TOKEN=TOKEN,
+               DATABASE_URL=database_url,
+               PORT=str(port),
+               WORKERS=str(args.workers),
+               WEBHOOK_URL='http://127.0.0.1:{}/'.format(port),
+               TELEGRAM_API_URL=api.base_url)
+
+    process = subprocess.Popen([sys.executable, 'main.py'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+    try:
+        if not api.wait_for_webhook(args.timeout):
+            raise RuntimeError('Webhook was not set in {} s'.format(args.timeout))
+        # setWebhook is called before the webhook server is listening
+        time.sleep(args.warmup)
+        api.reset()
+
+        start = time.perf_counter()
+        api.push_updates(args.command, args.rate, args.duration, args.chats)
+        answered = api.wait_for_responses(args.timeout)
+        return time.perf_counter() - start, answered
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=50, help='updates per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds updates are sent for')
+    parser.add_argument('--command', default='/random_joke')
+    parser.add_argument('--chats', type=int, default=100, help='distinct chats updates come from')
+    parser.add_argument('--workers', type=int, default=1, help='WORKERS of the bot')
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay of every Bot API response')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='random delay added to latency')
+    parser.add_argument('--rate-limit-share', type=float, default=0, help='share of 429 responses')
+    parser.add_argument('--error-share', type=float, default=0, help='share of 500 responses')
+    parser.add_argument('--database-url', help='database the bot uses, seeded temporary SQLite file by default')
+    parser.add_argument('--warmup', type=float, default=1, help='seconds to wait after the webhook was set')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--verbose', action='store_true', help='show log of the bot')
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                     rate_limit_share=args.rate_limit_share, error_share=args.error_share)
+    api.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            database_url = args.database_url
+            if database_url is None:
+                database_url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+                engine = create_database_engine(database_url)
+                seed_database(engine, args.chats, 10000, 20)
+                engine.dispose()
+
+            elapsed, answered = run(api, database_url, args)
+    finally:
+        api.stop()
+
+    print('command            {:>8}'.format(args.command))
+    print('offered rate       {:8.1f} updates/s'.format(args.rate))
+    print('throughput         {:8.1f} updates/s'.format(len(api.latencies) / elapsed))
+    if not answered:
+        print('not every update was answered in {} s'.format(args.timeout))
+    print(api.report())
+
+
+if __name__ == '__main__':
+    main()
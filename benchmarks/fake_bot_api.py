@@ -0,0 +1,269 @@
+"""
+Local stand-in for api.telegram.org, used by benchmarks.
+
+The bot is pointed to it with `TELEGRAM_API_URL` (`base_url` of Updater). It answers the Bot API methods the bot
+uses, can simulate latency, 429 responses with `retry_after` and server errors, and pushes synthetic updates to
+the webhook the bot registered with setWebhook. Latency is measured from sending an update until the first
+sendMessage or editMessageText for its chat.
+"""
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+from app.ShardedBot import ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_METHODS = ('sendMessage', 'editMessageText')
+
+
+def command_update(update_id, chat_id, command):
+    """
+    Returns:
+        dict: update with a private message from user `chat_id`
+    """
+    return {'update_id': update_id,
+            'message': {'message_id': update_id,
+                        'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private'},
+                        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Benchmark'},
+                        'text': command,
+                        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}]}}
+
+
+def percentile(values, share):
+    """
+    Returns:
+        value below which `share` of sorted `values` are, None if there are no values
+    """
+    if len(values) == 0:
+        return None
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        api = self.server.api
+        method = self.path.rsplit('/', 1)[-1]
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+        if 'application/json' in self.headers.get('Content-Type', ''):
+            parameters = json.loads(body or '{}')
+        else:
+            parameters = {key: values[0] for key, values in parse_qs(body).items()}
+
+        status, response = api.handle(method, parameters)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeBotApi:
+    """
+    Fake Bot API server.
+
+    Simulated behaviour applies to sendMessage and editMessageText, other methods always succeed immediately.
+    """
+    def __init__(self, latency=0, jitter=0, rate_limit_share=0, retry_after=1, error_share=0, seed=0):
+        """
+        Arguments:
+            latency: float, seconds every response is delayed
+            jitter: float, up to this many seconds are added to latency at random
+            rate_limit_share: float, share of requests answered with 429 Too Many Requests
+            retry_after: int, seconds sent in `retry_after` of 429 responses
+            error_share: float, share of requests answered with 500 Internal Server Error
+            seed: int, seed of the random generator
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_share = rate_limit_share
+        self.retry_after = retry_after
+        self.error_share = error_share
+        self.random = random.Random(seed)
+
+        self.server = None
+        self.webhook_url = None
+        self.webhook_set = threading.Event()
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything recorded so far
+        """
+        with self.lock:
+            self.responses = []  # (time.perf_counter(), method, chat id) of successful response methods
+            self.counts = {}  # `method status` -> count
+            self.pending = {}  # chat id -> deque of perf_counter() of updates waiting for a response
+            self.latencies = []  # seconds
+            self.updates_sent = 0
+            self.updates_failed = 0
+            self.updates_rejected = 0  # first response to the update was answered with 429 or an error
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{}/bot'.format(self.server.server_address[1])
+
+    def start(self, port=0):
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeBotApiHandler)
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, name='fake_bot_api', daemon=True).start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method, status):
+        key = '{} {}'.format(method, status)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def handle(self, method, parameters):
+        """
+        Returns:
+            tuple: int: HTTP status
+                   dict: response body
+        """
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'HahOrNahBot',
+                                                'username': 'HahOrNahBot'}}
+        if method == 'setWebhook':
+            self.webhook_url = parameters.get('url') or None
+            if self.webhook_url is not None:
+                self.webhook_set.set()
+            return 200, {'ok': True, 'result': True}
+        if method not in RESPONSE_METHODS:
+            return 200, {'ok': True, 'result': True}
+
+        with self.lock:
+            delay = self.latency + self.random.random() * self.jitter
+            outcome = self.random.random()
+        if delay > 0:
+            time.sleep(delay)
+
+        chat_id = int(parameters.get('chat_id', 0))
+        with self.lock:
+            pending = self.pending.get(chat_id)
+            if outcome < self.rate_limit_share + self.error_share:
+                if pending:
+                    pending.popleft()
+                    self.updates_rejected += 1
+                if outcome < self.rate_limit_share:
+                    self.count(method, 429)
+                    return 429, {'ok': False, 'error_code': 429,
+                                 'description': 'Too Many Requests: retry after {}'.format(self.retry_after),
+                                 'parameters': {'retry_after': self.retry_after}}
+                self.count(method, 500)
+                return 500, {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}
+
+            self.count(method, 200)
+            now = time.perf_counter()
+            self.responses.append((now, method, chat_id))
+            if pending:
+                self.latencies.append(now - pending.popleft())
+
+        return 200, {'ok': True, 'result': {'message_id': 1, 'date': int(time.time()),
+                                            'chat': {'id': chat_id, 'type': 'private'},
+                                            'text': parameters.get('text', '')}}
+
+    def wait_for_webhook(self, timeout):
+        """
+        Returns:
+            bool: True if the bot registered a webhook in time
+        """
+        return self.webhook_set.wait(timeout)
+
+    def send_update(self, update):
+        """
+        POST update to the webhook, the time it was sent is remembered for its chat
+        """
+        chat_id = update['message']['chat']['id']
+        data = json.dumps(update).encode('utf-8')
+        request = urllib.request.Request(self.webhook_url, data=data, headers={'Content-Type': 'application/json'})
+        sent_at = time.perf_counter()
+        with self.lock:
+            self.pending.setdefault(chat_id, deque()).append(sent_at)
+        try:
+            urllib.request.urlopen(request, timeout=10).read()
+            with self.lock:
+                self.updates_sent += 1
+        except (urllib.error.URLError, ConnectionError) as e:
+            logger.error('Sending update failed: {}'.format(e))
+            with self.lock:
+                # Unless a response of another update of the chat consumed it already
+                if sent_at in self.pending[chat_id]:
+                    self.pending[chat_id].remove(sent_at)
+                self.updates_failed += 1
+
+    def push_updates(self, command, rate, duration, chats, first_chat_id=1, senders=8):
+        """
+        Send `command` from chats `first_chat_id`..`first_chat_id + chats - 1` in turn, `rate` updates per second
+        for `duration` seconds. Updates are sent on schedule by `senders` threads regardless of the responses
+        (open loop), so a slow webhook does not slow down the arrival rate.
+
+        The chat of an update is used again only after all other chats, so with enough chats each update gets its
+        response before the next update of the same chat is sent.
+
+        Returns:
+            int: number of updates scheduled
+        """
+        count = int(rate * duration)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(senders) as executor:
+            for index in range(count):
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send_update, command_update(index + 1, first_chat_id + index % chats, command))
+        return count
+
+    def wait_for_responses(self, timeout):
+        """
+        Wait until every update sent got a response
+
+        Returns:
+            bool: True if all responses arrived in time
+        """
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            with self.lock:
+                if all(len(pending) == 0 for pending in self.pending.values()):
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def report(self):
+        """
+        Returns:
+            string: latency percentiles and counts of responses by method and status
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = dict(self.counts)
+            sent, failed, rejected = self.updates_sent, self.updates_failed, self.updates_rejected
+
+        lines = ['updates sent       {:>8}'.format(sent),
+                 'updates failed     {:>8}'.format(failed),
+                 'updates answered   {:>8}'.format(len(latencies)),
+                 'updates rejected   {:>8}'.format(rejected)]
+        for name, share in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1)):
+            value = percentile(latencies, share)
+            lines.append('latency {:<10} {}'.format(name, '-' if value is None else '{:8.1f} ms'.format(value * 1000)))
+        for key in sorted(counts):
+            lines.append('{:<18} {:>8}'.format(key, counts[key]))
+        return '\n'.join(lines)
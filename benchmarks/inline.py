@@ -0,0 +1,105 @@
+"""
+Latency of answering inline queries, as they arrive while the user types.
+
+Every query is sent the way Telegram sends them while typing, e.g. `c`, `ca`, `cat`, `cat d`, `cat do`, ...
+Measured are searches of InlineJokes with an empty cache, the same queries from the cache, and as a baseline
+JokeSearch with its in-process index plus the query loading bodies of the results, which is what /search does.
+JokeSearch matches complete words only, so it finds nothing for most of the prefixes.
+
+Usage:
+    python -m benchmarks.inline --jokes 20000 --queries 500
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.orm import sessionmaker
+
+from app.InlineJokes import InlineJokes
+from app.JokeSearch import JokeSearch
+from app.Metrics import Metrics
+from app.database import create_database_engine
+from app.models import Joke
+from benchmarks.fake_bot_api import percentile
+from tools.seed import seed_database, WORDS
+
+
+def typed_queries(generator, count):
+    """
+    Returns:
+        list of strings, every prefix of `count` queries of one or two words
+    """
+    queries = []
+    for _ in range(count):
+        text = ' '.join(generator.sample(WORDS, generator.choice([1, 2])))
+        queries.extend(text[:length] for length in range(1, len(text) + 1) if not text[:length].endswith(' '))
+    return queries
+
+
+def measure(search, queries):
+    """
+    Returns:
+        list of sorted milliseconds per query
+    """
+    milliseconds = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        milliseconds.append((time.perf_counter() - start) * 1000)
+    return sorted(milliseconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jokes', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=500, help='queries typed, every prefix is sent')
+    parser.add_argument('--budget-ms', type=float, default=50)
+    parser.add_argument('--results', type=int, default=20)
+    args = parser.parse_args()
+    generator = random.Random(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_database_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        seed_database(engine, 1000, args.jokes, 0)
+        Session = sessionmaker(bind=engine)
+        session = Session()
+
+        metrics = Metrics()
+        inline_jokes = InlineJokes(Session, metrics, 3600, args.budget_ms / 1000, args.results)
+        start = time.perf_counter()
+        inline_jokes.start_loading()
+        while not inline_jokes.loaded:
+            time.sleep(0.01)
+        load_seconds = time.perf_counter() - start
+
+        joke_search = JokeSearch(session)
+        joke_search.build_index()
+
+        def search_and_load(query):
+            joke_ids = joke_search.search(query, args.results)
+            if len(joke_ids) > 0:
+                session.query(Joke.id, Joke.body).filter(Joke.id.in_(joke_ids)).all()
+
+        def search_uncached(query):
+            inline_jokes.cache.clear()
+            inline_jokes.search(query)
+
+        queries = typed_queries(generator, args.queries)
+        results = [('JokeSearch + bodies', measure(search_and_load, queries)),
+                   ('InlineJokes', measure(search_uncached, queries)),
+                   ('InlineJokes (cached)', measure(inline_jokes.search, queries))]
+        session.close()
+        engine.dispose()
+
+    print('{} queries, {} jokes loaded in {:.2f} s'.format(len(queries), args.jokes, load_seconds))
+    print('{:<22} {:>8} {:>8} {:>8}'.format('ms/query', 'p50', 'p99', 'max'))
+    for name, milliseconds in results:
+        print('{:<22} {:8.3f} {:8.3f} {:8.3f}'.format(name, percentile(milliseconds, 0.5),
+                                                      percentile(milliseconds, 0.99), milliseconds[-1]))
+    print('fallbacks to the best jokes: {}'.format(metrics.get('inline.fallbacks') or 0))
+
+
+if __name__ == '__main__':
+    main()
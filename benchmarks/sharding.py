@@ -0,0 +1,93 @@
+"""
+Throughput and latency of the bot with updates sharded by chat id across 1, 2 and 4 worker processes.
+
+For every number of workers `python main.py` runs with `WORKERS` set, against the fake Bot API from
+benchmarks/fake_bot_api.py and a copy of one seeded database, so every run starts from the same data. Updates are
+pushed at `--rate` per second, which should be more than a single process can handle, for `--duration` seconds,
+and the run ends when every update is answered (see benchmarks/end_to_end.py). Real handlers run, so the database
+queries and Bot API round trips of each update are what limits a process.
+
+Updates come from `--chats` registered users in turn; with enough of them no chat is throttled by flood control.
+With SQLite all workers share one file, `--database-url` points them to another (empty) database instead, which is
+seeded once and shared by all runs.
+
+Usage:
+    python -m benchmarks.sharding --workers 1 2 4 --rate 100 --duration 10
+    python -m benchmarks.sharding --latency-ms 50 --command /random_joke
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+from app.database import create_database_engine
+from benchmarks.end_to_end import run
+from benchmarks.fake_bot_api import FakeBotApi, percentile
+from tools.seed import seed_database
+
+
+def measure(api, database_url, worker_count, args):
+    """
+    Returns:
+        tuple: float: updates answered per second
+               list of latencies in seconds, sorted
+               bool: True if every update was answered in time
+    """
+    run_args = SimpleNamespace(workers=worker_count, command=args.command, rate=args.rate, duration=args.duration,
+                               chats=args.chats, warmup=args.warmup, timeout=args.timeout, verbose=args.verbose)
+    elapsed, answered = run(api, database_url, run_args)
+    latencies = sorted(api.latencies)
+    return len(latencies) / elapsed, latencies, answered
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--rate', type=float, default=100, help='updates per second offered')
+    parser.add_argument('--duration', type=float, default=10, help='seconds updates are sent for')
+    parser.add_argument('--command', default='/random_joke')
+    parser.add_argument('--chats', type=int, default=5000, help='distinct chats updates come from')
+    parser.add_argument('--jokes', type=int, default=10000)
+    parser.add_argument('--votes-per-user', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=20, help='delay of every Bot API response')
+    parser.add_argument('--database-url', help='empty database to be seeded, temporary SQLite file by default')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds to wait after the webhook was set')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--verbose', action='store_true', help='show log of the bot')
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency_ms / 1000)
+    api.start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            seeded_path = os.path.join(directory, 'seeded.db')
+            engine = create_database_engine(args.database_url or 'sqlite:///' + seeded_path)
+            seed_database(engine, args.chats, args.jokes, args.votes_per_user)
+            engine.dispose()
+
+            for worker_count in args.workers:
+                database_url = args.database_url
+                if database_url is None:
+                    path = os.path.join(directory, 'workers-{}.db'.format(worker_count))
+                    shutil.copy(seeded_path, path)
+                    database_url = 'sqlite:///' + path
+                results.append((worker_count,) + measure(api, database_url, worker_count, args))
+    finally:
+        api.stop()
+
+    print('{} at {:.0f} updates/s offered for {:.0f} s, Bot API latency {:.0f} ms'.format(
+        args.command, args.rate, args.duration, args.latency_ms))
+    print('workers  updates/s  speedup  p50 ms  p99 ms')
+    baseline = None
+    for worker_count, throughput, latencies, answered in results:
+        if baseline is None:
+            baseline = throughput
+        print('{:7d}  {:9.1f}  {:7.2f}  {:6.1f}  {:6.1f}{}'.format(
+            worker_count, throughput, throughput / baseline, percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, '' if answered else '  (not every update was answered)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Time to first response of a cold `python main.py`.
+
+Starts a fake Bot API server, then runs the bot with webhook and Bot API pointed to localhost and an SQLite
+database. As soon as the webhook accepts connections, a command is sent to it. Prints how long it took until
+the webhook was listening and until the bot answered, median of `--runs` runs.
+
+Usage:
+    python -m benchmarks.startup --runs 5 --command /stats
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from app.database import create_database_engine
+from app.models import Base
+from benchmarks.fake_bot_api import FakeBotApi, command_update
+
+TOKEN = '123456:benchmark'
+CHAT_ID = 1000
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def measure(api, database_url, command, timeout):
+    api.reset()
+    port = get_free_port()
+    env = dict(os.environ,
+               TELEGRAM_TOKEN=TOKEN,
+               DATABASE_URL=database_url,
+               PORT=str(port),
+               WORKERS='1',
+               WEBHOOK_URL='http://127.0.0.1:{}/'.format(port),
+               TELEGRAM_API_URL=api.base_url)
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'main.py'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        data = json.dumps(command_update(1, CHAT_ID, command)).encode('utf-8')
+        request = urllib.request.Request('http://127.0.0.1:{}/{}'.format(port, TOKEN), data=data,
+                                         headers={'Content-Type': 'application/json'})
+        while True:
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('Webhook did not start in {} s'.format(timeout))
+            try:
+                urllib.request.urlopen(request, timeout=timeout).read()
+                break
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.005)
+        listening = time.perf_counter()
+
+        while len(api.responses) == 0:
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError('No response in {} s'.format(timeout))
+            time.sleep(0.001)
+        return listening - start, api.responses[0][0] - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--command', default='/stats')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    api = FakeBotApi()
+    api.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        Base.metadata.create_all(create_database_engine(database_url))
+
+        results = [measure(api, database_url, args.command, args.timeout) for _ in range(args.runs)]
+
+    print('webhook listening  {:8.1f} ms'.format(statistics.median(r[0] for r in results) * 1000))
+    print('first response     {:8.1f} ms'.format(statistics.median(r[1] for r in results) * 1000))
+
+
+if __name__ == '__main__':
+    main()
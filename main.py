@@ -1,9 +1,18 @@
+import time
+START_TIME = time.perf_counter()
+
+import argparse
 import os
 import logging
 
-from app.HahOrNahBot import HahOrNahBot
+from app.StartupProfile import StartupProfile
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='log how long imports and each phase of initialization took')
+    args = parser.parse_args()
+
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                         handlers=[logging.StreamHandler()]
@@ -20,8 +29,40 @@ if __name__ == '__main__':
         print('Missing database url. You did not provide the DATABASE_URL environment variable.')
         exit()
 
+    # Read replica for read-only handlers, optional
+    replica_url = os.environ.get('DATABASE_REPLICA_URL')
+
+    # Directory every vote is appended to, see app/VoteLog.py
+    vote_log_directory = os.environ.get('VOTE_LOG_DIR')
+
     port = int(os.environ.get('PORT', 8443))
+    # Number of processes updates are sharded to by chat id. 1 runs everything in this process.
+    workers = int(os.environ.get('WORKERS', 1))
+    url = os.environ.get('WEBHOOK_URL', "https://hah-or-nah-bot.herokuapp.com/")
+    # Record ids of received updates in database, so an update delivered to several processes is processed once
+    shared_deduplication = os.environ.get('SHARED_DEDUPLICATION') == '1'
+    # Share of updates whose phases are traced to files in `traces`, see app/UpdateTracer.py. 0 disables tracing.
+    trace_sample_rate = float(os.environ.get('TRACE_SAMPLE_RATE', 0))
+    # Used to point the bot to a local Bot API server, e.g. in benchmarks
+    base_url = os.environ.get('TELEGRAM_API_URL')
+
+    # Imports are done here, so the profile can tell how long they take
+    profile = StartupProfile(START_TIME)
+    with profile.phase('import telegram'):
+        import telegram.ext
+    with profile.phase('import sqlalchemy'):
+        import sqlalchemy.orm
+    with profile.phase('import app'):
+        from app.HahOrNahBot import HahOrNahBot
+        from app.ShardedBot import start_sharded_webhook
 
-    bot = HahOrNahBot(token, database_url)
-    bot.start_webhook("https://hah-or-nah-bot.herokuapp.com/", port)
-    #bot.start_local()
+    if workers > 1:
+        start_sharded_webhook(token, database_url, url, port, workers, base_url=base_url,
+                              replica_url=replica_url, vote_log_directory=vote_log_directory,
+                              shared_deduplication=shared_deduplication, trace_sample_rate=trace_sample_rate)
+    else:
+        bot = HahOrNahBot(token, database_url, base_url=base_url, startup_profile=profile, replica_url=replica_url,
+                          vote_log_directory=vote_log_directory, shared_deduplication=shared_deduplication,
+                          trace_sample_rate=trace_sample_rate)
+        bot.start_webhook(url, port, print_startup_profile=args.profile_startup)
+        #bot.start_local()
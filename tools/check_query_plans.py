@@ -0,0 +1,183 @@
+"""
+Query plan regression check.
+
+Seeds a database, runs every query the bot issues through the same helper methods the handlers use, and runs
+EXPLAIN on each captured statement. Fails when a statement scans a whole table with at least `--threshold` rows,
+unless the scan is expected for that query (see CASES).
+
+Works with SQLite (default, temporary file) and PostgreSQL (`--database-url`, the database must be empty).
+
+Usage:
+    python -m tools.check_query_plans
+    python -m tools.check_query_plans --database-url postgresql://postgres@localhost/plans --threshold 1000
+"""
+import argparse
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+from sqlalchemy import event, func, select
+
+from app.TelegramBotHelper import HahOrNahBotHelper
+from app.database import create_database_engine
+from app.models import Joke, User, association_table
+from tools.seed import seed_database
+
+
+def vote(helper, user, joke):
+    user.vote_for_joke(joke, positive=True)
+    helper.session.flush()
+
+
+def delete_unvoted_joke(helper, user, joke):
+    helper.add_joke('Joke to be deleted', user)
+    helper.delete_joke(helper.get_joke(helper.session.query(func.max(Joke.id)).scalar()))
+    helper.session.flush()
+
+
+def delete_voted_joke(helper, user, joke):
+    # A joke the user voted for, with votes of other users too
+    voted_joke_id = helper.session.query(association_table.c.jokes_id).\
+        filter(association_table.c.users_id == user.id).limit(1).scalar()
+    helper.delete_jokes(Joke.id == voted_joke_id)
+    helper.session.flush()
+
+
+def purge_user(helper, user, joke):
+    helper.purge_user(user.id)
+    helper.session.flush()
+
+
+# name, function(helper, user, joke), tables which may be scanned with the reason
+CASES = [
+    ('get_user', lambda helper, user, joke: helper.get_user(SimpleNamespace(chat=SimpleNamespace(id=user.id))), {}),
+    ('add_joke', lambda helper, user, joke: helper.add_joke('A brand new joke', user), {}),
+    ('can_vote', lambda helper, user, joke: helper.can_vote(user, joke.id), {}),
+    ('vote_for_joke', vote, {}),
+    ('get_favorite_joke_ids', lambda helper, user, joke: helper.get_favorite_joke_ids(user, {}), {}),
+    ('get_random_unvoted_joke', lambda helper, user, joke: helper.get_random_unvoted_joke(user),
+     {'jokes': 'fallback, used only after JokeRanking samples failed'}),
+    ('get_joke', lambda helper, user, joke: helper.get_joke(joke.id), {}),
+    ('get_jokes_by_ids', lambda helper, user, joke: helper.get_jokes_by_ids([joke.id, joke.id + 1]), {}),
+    ('get_user_jokes', lambda helper, user, joke: helper.get_user_jokes(user), {}),
+    ('get_next_unapproved_joke', lambda helper, user, joke: helper.get_next_unapproved_joke(), {}),
+    ('get_user_rank', lambda helper, user, joke: helper.get_user_rank(user), {}),
+    ('get_stats', lambda helper, user, joke: helper.get_stats(),
+     {'jokes': 'counts all approved jokes', 'users': 'counts all users'}),
+    ('delete_joke', delete_unvoted_joke, {}),
+    ('delete_jokes', delete_voted_joke, {}),
+    ('purge_user', purge_user, {}),
+]
+
+
+def explain(engine, statement, parameters):
+    """
+    Returns:
+        list of (table name, plan line) for every full table scan in the plan, and the whole plan as string
+    """
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        if engine.dialect.name == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement, parameters)
+            plan = cursor.fetchone()[0][0]['Plan']
+            scans = []
+            nodes = [plan]
+            while len(nodes) > 0:
+                node = nodes.pop()
+                if node['Node Type'] == 'Seq Scan':
+                    scans.append((node['Relation Name'], 'Seq Scan on {}'.format(node['Relation Name'])))
+                nodes.extend(node.get('Plans', []))
+            return scans, str(plan)
+
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        details = [row[3] for row in cursor.fetchall()]
+        scans = [(detail.split()[1], detail) for detail in details if detail.startswith('SCAN ')]
+        return scans, '\n'.join(details)
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def check(database_url, threshold, verbose):
+    """
+    Returns:
+        int: number of failed cases
+    """
+    helper = HahOrNahBotHelper(database_url, {'min': 10, 'max': 1000}, {'min': 5, 'max': 20}, set())
+    engine = helper.init_database()
+
+    table_sizes = {}
+    for table in (User.__table__, Joke.__table__, association_table):
+        table_sizes[table.name] = engine.execute(select([func.count()]).select_from(table)).scalar()
+
+    statements = []
+
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if not executemany and not statement.lstrip().upper().startswith('INSERT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', capture)
+
+    # User with the most votes, and a joke he can still vote for
+    user_id = engine.execute('SELECT users_id FROM association GROUP BY users_id ORDER BY count(*) DESC LIMIT 1').scalar()
+    user = helper.session.query(User).get(user_id)
+    joke = helper.get_random_unvoted_joke(user)
+
+    failed = 0
+    for name, function, allowed_scans in CASES:
+        del statements[:]
+        try:
+            function(helper, user, joke)
+            cases_statements = list(statements)
+        finally:
+            helper.session.rollback()
+
+        problems = []
+        for statement, parameters in cases_statements:
+            scans, plan = explain(engine, statement, parameters)
+            for table, detail in scans:
+                if table_sizes.get(table, 0) >= threshold and table not in allowed_scans:
+                    problems.append('{} ({} rows)\n        {}'.format(detail, table_sizes[table], ' '.join(statement.split())))
+            if verbose:
+                print('    ' + ' '.join(statement.split()))
+                print('      ' + plan.replace('\n', '\n      '))
+
+        if len(problems) > 0:
+            failed += 1
+            print('FAIL  {}'.format(name))
+            for problem in problems:
+                print('      ' + problem)
+        else:
+            print('OK    {}'.format(name))
+
+    event.remove(engine, 'before_cursor_execute', capture)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', help='empty database to be seeded, temporary SQLite file by default')
+    parser.add_argument('--threshold', type=int, default=1000, help='smaller tables may be scanned')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--jokes', type=int, default=20000)
+    parser.add_argument('--votes-per-user', type=int, default=20)
+    parser.add_argument('--verbose', action='store_true', help='print every statement with its plan')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or 'sqlite:///' + os.path.join(directory, 'plans.db')
+        engine = create_database_engine(database_url)
+        seed_database(engine, args.users, args.jokes, args.votes_per_user)
+        if engine.dialect.name == 'postgresql':
+            engine.execute('ANALYZE')
+        engine.dispose()
+
+        failed = check(database_url, args.threshold, args.verbose)
+
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
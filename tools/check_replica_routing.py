@@ -0,0 +1,93 @@
+"""
+Read replica routing check.
+
+Seeds two databases with identical data, one acting as the primary and the other as its replica, and checks that
+reads are routed to the replica, except for users who have just written something. Writes are never copied to the
+second database, so a read routed to the wrong database shows up as a stale result.
+
+Works with two temporary SQLite files (default) or two empty databases given with `--primary-url` and
+`--replica-url`, e.g. two local PostgreSQL instances.
+
+Usage:
+    python -m tools.check_replica_routing
+    python -m tools.check_replica_routing --primary-url postgresql://localhost:5432/bot \
+        --replica-url postgresql://localhost:5433/bot
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from app.TelegramBotHelper import HahOrNahBotHelper
+from app.database import create_database_engine
+from app.models import User
+from tools.seed import seed_database
+
+
+def check(primary_url, replica_url, sticky):
+    """
+    Returns:
+        int: number of failed checks
+    """
+    replica_limits = {'sticky': sticky, 'lag_max': 30, 'lag_check_interval': 0}
+    helper = HahOrNahBotHelper(primary_url, {'min': 10, 'max': 1000}, {'min': 5, 'max': 20}, set(),
+                               replica_url=replica_url, replica_limits=replica_limits)
+    helper.init_database()
+
+    voter, other_user = helper.session.query(User).order_by(User.id).limit(2).all()
+    joke = helper.get_random_unvoted_joke(voter)
+    results = []
+
+    def expect(name, session, expected_session, can_vote=None):
+        passed = session is expected_session
+        if can_vote is not None:
+            passed = passed and helper.can_vote(voter, joke.get_id(), session) == can_vote
+        results.append(passed)
+        print('{}  {}'.format('OK  ' if passed else 'FAIL', name))
+
+    expect('read before any write goes to replica', helper.get_read_session(voter.get_id()), helper.replica_session,
+           can_vote=True)
+    helper.close_read_session()
+
+    voter.vote_for_joke(joke, positive=True)
+    helper.session.commit()
+    helper.register_write(voter.get_id())
+
+    expect('voter reads his vote from primary', helper.get_read_session(voter.get_id()), helper.session,
+           can_vote=False)
+    expect('other user still reads from replica', helper.get_read_session(other_user.get_id()),
+           helper.replica_session)
+    helper.close_read_session()
+
+    time.sleep(sticky)
+    expect('voter reads from replica after {}s'.format(sticky), helper.get_read_session(voter.get_id()),
+           helper.replica_session)
+    helper.close_read_session()
+
+    print('\nMetrics:\n' + helper.metrics.report())
+    return results.count(False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--primary-url', help='empty database to be seeded, temporary SQLite file by default')
+    parser.add_argument('--replica-url', help='second empty database to be seeded, temporary SQLite file by default')
+    parser.add_argument('--sticky', type=float, default=1, help='seconds reads stay on primary after a write')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        primary_url = args.primary_url or 'sqlite:///' + os.path.join(directory, 'primary.db')
+        replica_url = args.replica_url or 'sqlite:///' + os.path.join(directory, 'replica.db')
+        for database_url in (primary_url, replica_url):
+            engine = create_database_engine(database_url)
+            seed_database(engine, 100, 1000, 5)
+            engine.dispose()
+
+        failed = check(primary_url, replica_url, args.sticky)
+
+    sys.exit(1 if failed > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
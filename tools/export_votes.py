@@ -0,0 +1,140 @@
+"""
+Export the vote log written by the bot (see app/VoteLog.py) into a columnar format for offline analysis.
+
+Formats:
+    columns - directory with one little-endian array file per column and `schema.json` describing them,
+              e.g. `numpy.fromfile('votes/user_id.bin', dtype='<i8')`. No dependencies.
+    parquet - single Parquet file, one row group per chunk. Needs pyarrow.
+
+Records are streamed in chunks of `--chunk-records`, so memory use doesn't depend on the size of the log.
+
+Usage:
+    python -m tools.export_votes vote_log votes --format columns
+    python -m tools.export_votes vote_log votes.parquet --format parquet --since 2026-10-01
+"""
+import argparse
+import calendar
+import json
+import os
+import struct
+import sys
+import time
+
+from app.VoteLog import RECORD_FIELDS, get_log_files, read_records
+
+# Column name -> (struct format of one value, numpy dtype)
+COLUMNS = {
+    'timestamp': ('<d', '<f8'),
+    'user_id': ('<q', '<i8'),
+    'joke_id': ('<q', '<i8'),
+    'positive': ('<?', '|b1'),
+}
+
+
+def iter_chunks(directory, chunk_records, since=None):
+    """
+    Yield chunks of records from all log files in directory, oldest file first
+
+    Arguments:
+        since: float, timestamp. Older records are skipped.
+    """
+    for path in get_log_files(directory):
+        for records in read_records(path, chunk_records):
+            if since is not None:
+                records = [record for record in records if record[0] >= since]
+            if len(records) > 0:
+                yield records
+
+
+class ColumnsWriter:
+    def __init__(self, output):
+        os.makedirs(output, exist_ok=True)
+        self.output = output
+        self.count = 0
+        self.files = {name: open(os.path.join(output, name + '.bin'), 'wb') for name in RECORD_FIELDS}
+
+    def write(self, records):
+        for index, name in enumerate(RECORD_FIELDS):
+            value_format = COLUMNS[name][0]
+            column_format = value_format[0] + str(len(records)) + value_format[1:]
+            self.files[name].write(struct.pack(column_format, *(record[index] for record in records)))
+        self.count += len(records)
+
+    def close(self):
+        for column_file in self.files.values():
+            column_file.close()
+        schema = {'rows': self.count,
+                  'columns': [{'name': name, 'file': name + '.bin', 'dtype': COLUMNS[name][1]} for name in RECORD_FIELDS]}
+        with open(os.path.join(self.output, 'schema.json'), 'w') as schema_file:
+            json.dump(schema, schema_file, indent=2)
+
+
+class ParquetWriter:
+    def __init__(self, output):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Parquet export needs pyarrow: pip install pyarrow')
+
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([('timestamp', pyarrow.timestamp('us', tz='UTC')),
+                                      ('user_id', pyarrow.int64()),
+                                      ('joke_id', pyarrow.int64()),
+                                      ('positive', pyarrow.bool_())])
+        self.writer = pyarrow.parquet.ParquetWriter(output, self.schema)
+        self.count = 0
+
+    def write(self, records):
+        columns = list(zip(*records))
+        arrays = [self.pyarrow.array([int(timestamp * 1000000) for timestamp in columns[0]],
+                                     type=self.schema.field('timestamp').type)]
+        arrays.extend(self.pyarrow.array(column, type=self.schema.field(name).type)
+                      for name, column in zip(RECORD_FIELDS[1:], columns[1:]))
+        self.writer.write_table(self.pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        self.count += len(records)
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'columns': ColumnsWriter, 'parquet': ParquetWriter}
+
+
+def export(directory, output, output_format, chunk_records, since=None):
+    """
+    Returns:
+        int: number of exported records
+    """
+    writer = WRITERS[output_format](output)
+    try:
+        for records in iter_chunks(directory, chunk_records, since):
+            writer.write(records)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log_directory', help='VOTE_LOG_DIR of the bot')
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='columns')
+    parser.add_argument('--since', help='skip votes before this UTC date, YYYY-MM-DD')
+    parser.add_argument('--chunk-records', type=int, default=100000, help='records held in memory at once')
+    args = parser.parse_args()
+
+    if len(get_log_files(args.log_directory)) == 0:
+        print('No vote log files in {}'.format(args.log_directory))
+        sys.exit(1)
+
+    since = None
+    if args.since is not None:
+        since = calendar.timegm(time.strptime(args.since, '%Y-%m-%d'))
+
+    count = export(args.log_directory, args.output, args.format, args.chunk_records, since)
+    print('Exported {} votes to {}'.format(count, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Recompute vote counts of jokes and scores and aggregates of users from the votes, and fix the ones which drifted.
+
+Everything is computed by aggregate queries over the association table, no ORM objects are loaded. Rows are
+processed in chunks of `--chunk-size` ids, each in its own short transaction, with an optional pause between
+chunks, so the bot keeps working while it runs.
+
+Stored and recomputed values of a chunk are read by one statement. A row is updated only if its stored value
+is still the one which was read, rows changed by the bot in the meantime are skipped and reported, running
+the command again fixes them.
+
+Usage:
+    python -m tools.reconcile postgresql://localhost/bot --chunk-size 1000 --pause 0.1
+    python -m tools.reconcile --dry-run    # uses DATABASE_URL, only reports discrepancies
+"""
+import argparse
+import os
+import sys
+import time
+
+from sqlalchemy import and_, distinct, func, select
+
+from app.database import create_database_engine
+from app.models import Joke, User, association_table
+
+JOKES = Joke.__table__
+USERS = User.__table__
+VOTES = association_table
+
+
+def get_chunks(connection, id_column, chunk_size):
+    """
+    Yield lists of ids in ascending order, at most `chunk_size` long
+    """
+    last_id = None
+    while True:
+        query = select([id_column]).order_by(id_column).limit(chunk_size)
+        if last_id is not None:
+            query = query.where(id_column > last_id)
+        ids = [row[0] for row in connection.execute(query)]
+        if len(ids) == 0:
+            return
+        last_id = ids[-1]
+        yield ids
+
+
+def vote_value_sum(rows_count, voters_count):
+    # Positive vote adds two rows to association table and counts +1, negative vote adds one row and counts -1:
+    # positive = rows - voters, negative = voters - positive, so positive - negative = 2 * rows - 3 * voters
+    return 2 * rows_count - 3 * voters_count
+
+
+def joke_discrepancies_query(joke_ids):
+    """
+    Returns:
+        select of (id, stored vote count, recomputed vote count) of jokes with given ids
+    """
+    votes = select([VOTES.c.jokes_id,
+                    vote_value_sum(func.count(), func.count(distinct(VOTES.c.users_id))).label('vote_count')]).\
+        where(VOTES.c.jokes_id.in_(joke_ids)).\
+        group_by(VOTES.c.jokes_id).alias('votes')
+
+    return select([JOKES.c.id, JOKES.c.vote_count, func.coalesce(votes.c.vote_count, 0)]).\
+        select_from(JOKES.outerjoin(votes, votes.c.jokes_id == JOKES.c.id)).\
+        where(JOKES.c.id.in_(joke_ids))
+
+
+def user_discrepancies_query(user_ids):
+    """
+    Returns:
+        select of (id, stored score, recomputed score, stored votes cast, recomputed votes cast, stored jokes
+        submitted, recomputed jokes submitted, stored positive votes received, recomputed positive votes received)
+        of users with given ids
+    """
+    votes = select([VOTES.c.users_id,
+                    vote_value_sum(func.count(), func.count(distinct(VOTES.c.jokes_id))).label('score'),
+                    func.count(distinct(VOTES.c.jokes_id)).label('votes_cast')]).\
+        where(VOTES.c.users_id.in_(user_ids)).\
+        group_by(VOTES.c.users_id).alias('votes')
+
+    submitted = select([JOKES.c.user_id, func.count().label('jokes_submitted')]).\
+        where(JOKES.c.user_id.in_(user_ids)).\
+        group_by(JOKES.c.user_id).alias('submitted')
+
+    # One row per positive vote: (joke, voter) pairs with more than one row
+    positive_votes = select([JOKES.c.user_id.label('author_id')]).\
+        select_from(VOTES.join(JOKES, JOKES.c.id == VOTES.c.jokes_id)).\
+        where(JOKES.c.user_id.in_(user_ids)).\
+        group_by(JOKES.c.user_id, VOTES.c.jokes_id, VOTES.c.users_id).\
+        having(func.count() > 1).alias('positive_votes')
+    received = select([positive_votes.c.author_id, func.count().label('positive_received')]).\
+        group_by(positive_votes.c.author_id).alias('received')
+
+    return select([USERS.c.id,
+                   USERS.c.score, func.coalesce(votes.c.score, 0),
+                   USERS.c.votes_cast_count, func.coalesce(votes.c.votes_cast, 0),
+                   USERS.c.jokes_submitted_count, func.coalesce(submitted.c.jokes_submitted, 0),
+                   USERS.c.positive_votes_received, func.coalesce(received.c.positive_received, 0)]).\
+        select_from(USERS.
+                    outerjoin(votes, votes.c.users_id == USERS.c.id).
+                    outerjoin(submitted, submitted.c.user_id == USERS.c.id).
+                    outerjoin(received, received.c.author_id == USERS.c.id)).\
+        where(USERS.c.id.in_(user_ids))
+
+
+def fix_row(connection, table, row_id, changes):
+    """
+    Set recomputed values, unless some of the stored values changed since they were read
+
+    Arguments:
+        changes: dict, column -> (stored value, recomputed value)
+
+    Returns:
+        bool: True if the row was updated
+    """
+    conditions = [table.c.id == row_id]
+    for column, (stored, _) in changes.items():
+        conditions.append(column.is_(None) if stored is None else column == stored)
+
+    result = connection.execute(table.update().
+                                where(and_(*conditions)).
+                                values({column: recomputed for column, (_, recomputed) in changes.items()}))
+    return result.rowcount == 1
+
+
+def reconcile_table(engine, table, query_function, columns, chunk_size, pause, dry_run, verbose):
+    """
+    Compare stored and recomputed values of every row of table, chunk by chunk, and fix the different ones.
+
+    Arguments:
+        query_function: function(ids), returns select of id followed by (stored, recomputed) pair of every column
+        columns: list of Column, in the order of pairs in the select
+
+    Returns:
+        dict: counts of `checked`, `fixed` and `skipped` rows and of discrepancies per column name
+    """
+    report = {'checked': 0, 'fixed': 0, 'skipped': 0}
+    report.update({column.name: 0 for column in columns})
+
+    with engine.connect() as connection:
+        chunks = list(get_chunks(connection, table.c.id, chunk_size))
+
+    for ids in chunks:
+        with engine.begin() as connection:
+            for row in connection.execute(query_function(ids)):
+                report['checked'] += 1
+                changes = {}
+                for index, column in enumerate(columns):
+                    stored, recomputed = row[1 + 2 * index], row[2 + 2 * index]
+                    if stored != recomputed:
+                        changes[column] = (stored, recomputed)
+                        report[column.name] += 1
+                if len(changes) == 0:
+                    continue
+
+                if verbose:
+                    print('{} {}: {}'.format(table.name, row[0], ', '.join(
+                        '{} {} -> {}'.format(column.name, stored, recomputed)
+                        for column, (stored, recomputed) in changes.items())))
+                if dry_run:
+                    continue
+                if fix_row(connection, table, row[0], changes):
+                    report['fixed'] += 1
+                else:
+                    report['skipped'] += 1
+
+        if pause > 0:
+            time.sleep(pause)
+
+    return report
+
+
+def reconcile(engine, chunk_size=1000, pause=0, dry_run=False, verbose=False):
+    """
+    Reconcile jokes and users.
+
+    Returns:
+        dict: table name -> report of `reconcile_table`
+    """
+    return {
+        'jokes': reconcile_table(engine, JOKES, joke_discrepancies_query, [JOKES.c.vote_count],
+                                 chunk_size, pause, dry_run, verbose),
+        'users': reconcile_table(engine, USERS, user_discrepancies_query,
+                                 [USERS.c.score, USERS.c.votes_cast_count, USERS.c.jokes_submitted_count,
+                                  USERS.c.positive_votes_received],
+                                 chunk_size, pause, dry_run, verbose),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database_url', nargs='?', default=os.environ.get('DATABASE_URL'))
+    parser.add_argument('--chunk-size', type=int, default=1000, help='ids processed in one transaction')
+    parser.add_argument('--pause', type=float, default=0, help='seconds to sleep between chunks')
+    parser.add_argument('--dry-run', action='store_true', help='only report discrepancies')
+    parser.add_argument('--verbose', action='store_true', help='print every discrepancy')
+    args = parser.parse_args()
+    if args.database_url is None:
+        parser.error('database_url is required when DATABASE_URL environment variable is not set')
+
+    engine = create_database_engine(args.database_url)
+    report = reconcile(engine, args.chunk_size, args.pause, args.dry_run, args.verbose)
+
+    for table_name, table_report in report.items():
+        counts = ', '.join('{} {}'.format(name, count) for name, count in table_report.items()
+                           if name not in ('checked', 'fixed', 'skipped'))
+        print('{}: checked {}, fixed {}, skipped {} ({})'.format(
+            table_name, table_report['checked'], table_report['fixed'], table_report['skipped'], counts))
+
+    skipped = sum(table_report['skipped'] for table_report in report.values())
+    sys.exit(1 if skipped > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Fill a database with fake users, jokes and votes.
+
+Vote counts, scores and user aggregates are consistent with the votes, as if they were cast through the bot.
+
+Usage:
+    python -m tools.seed sqlite:///seed.db --users 5000 --jokes 20000 --votes-per-user 20
+"""
+import argparse
+import random
+
+from app.database import create_database_engine
+from app.models import Base, User, Joke, association_table
+
+WORDS = ['cat', 'dog', 'bar', 'programmer', 'doctor', 'chicken', 'road', 'knock', 'lawyer', 'penguin',
+         'coffee', 'python', 'bug', 'teacher', 'pirate', 'banana', 'robot', 'ghost', 'moon', 'pizza']
+CHUNK_SIZE = 10000
+
+
+def insert_chunks(connection, table, rows):
+    for start in range(0, len(rows), CHUNK_SIZE):
+        connection.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def seed_database(engine, users_count, jokes_count, votes_per_user, approved_share=0.9, positive_share=0.6, seed=0):
+    """
+    Create tables and insert fake data. User ids start at 1, joke ids at 0.
+
+    Arguments:
+        engine: sqlalchemy Engine
+        users_count: int
+        jokes_count: int
+        votes_per_user: int
+        approved_share: float, share of approved jokes
+        positive_share: float, share of positive votes
+        seed: int, seed of the random generator
+    """
+    generator = random.Random(seed)
+    Base.metadata.create_all(engine)
+
+    users = {user_id: {'id': user_id, 'username': 'user{}'.format(user_id), 'score': 0,
+                       'jokes_submitted_count': 0, 'votes_cast_count': 0, 'positive_votes_received': 0}
+             for user_id in range(1, users_count + 1)}
+    jokes = []
+    for joke_id in range(jokes_count):
+        author_id = generator.randint(1, users_count)
+        body = 'Joke {} about {}'.format(joke_id, ' '.join(generator.sample(WORDS, 4)))
+        jokes.append({'id': joke_id, 'body': body, 'vote_count': 0, 'user_id': author_id,
+                      'approved': generator.random() < approved_share})
+        users[author_id]['jokes_submitted_count'] += 1
+
+    approved_jokes = [joke for joke in jokes if joke['approved']]
+    votes = []
+    for user in users.values():
+        for joke in generator.sample(approved_jokes, min(votes_per_user, len(approved_jokes))):
+            if joke['user_id'] == user['id']:
+                continue
+            positive = generator.random() < positive_share
+            change = 1 if positive else -1
+            joke['vote_count'] += change
+            user['score'] += change
+            user['votes_cast_count'] += 1
+            vote = {'users_id': user['id'], 'jokes_id': joke['id']}
+            # Positive vote adds two rows, same as User.vote_for_joke
+            votes.extend([vote, vote] if positive else [vote])
+            if positive:
+                users[joke['user_id']]['positive_votes_received'] += 1
+
+    with engine.begin() as connection:
+        insert_chunks(connection, User.__table__, list(users.values()))
+        insert_chunks(connection, Joke.__table__, jokes)
+        insert_chunks(connection, association_table, votes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('database_url')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--jokes', type=int, default=20000)
+    parser.add_argument('--votes-per-user', type=int, default=20)
+    args = parser.parse_args()
+
+    seed_database(create_database_engine(args.database_url), args.users, args.jokes, args.votes_per_user)
+
+
+if __name__ == '__main__':
+    main()
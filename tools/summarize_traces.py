@@ -0,0 +1,104 @@
+"""
+Summarize update traces written by the bot (see app/UpdateTracer.py): percentiles of every phase, per command.
+
+For every command (or kind of update without one) prints the percentiles of the total time and of each phase in
+milliseconds, the share of the total time spent in the phase and, for `db` and `telegram`, the average number of
+statements or Bot API round trips per update. Traces without a phase count as 0 ms in it, phases no trace has are
+left out: `receive` is only measured when the bot runs with WORKERS > 1.
+
+Usage:
+    python -m tools.summarize_traces traces
+    python -m tools.summarize_traces traces --label /random_joke --since 2026-10-01
+"""
+import argparse
+import calendar
+import sys
+import time
+
+from app.UpdateTracer import PHASES, get_trace_files, parse_trace
+
+PERCENTILES = (0.5, 0.9, 0.99)
+COUNTED_PHASES = ('db', 'telegram')  # average count per update is printed for these
+
+
+def percentile(values, share):
+    """
+    Returns:
+        value below which `share` of sorted `values` are
+    """
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def read_traces(paths, label=None, since=None):
+    """
+    Returns:
+        dict: label -> list of dicts, phase -> (milliseconds, count)
+        int: number of lines which weren't traces, e.g. cut off when the bot was killed while writing
+    """
+    traces = {}
+    invalid = 0
+    for path in paths:
+        with open(path) as trace_file:
+            for line in trace_file:
+                try:
+                    received, _, trace_label, phases = parse_trace(line)
+                except ValueError:
+                    invalid += 1
+                    continue
+                if (label is not None and trace_label != label) or (since is not None and received < since):
+                    continue
+                traces.setdefault(trace_label, []).append(phases)
+    return traces, invalid
+
+
+def summarize(phases_list):
+    """
+    Returns:
+        list of lines of the table for traces of one label
+    """
+    total_milliseconds = sum(phases['total'][0] for phases in phases_list)
+    lines = ['{:<10} {:>6} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+        'phase', 'share', *['p{:g}'.format(share * 100) for share in PERCENTILES], 'max', 'count')]
+    for phase in ('total',) + PHASES:
+        if not any(phase in phases for phases in phases_list):
+            continue
+        milliseconds = sorted(phases.get(phase, (0, 0))[0] for phases in phases_list)
+        share = sum(milliseconds) / total_milliseconds if total_milliseconds > 0 else 0
+        count = ''
+        if phase in COUNTED_PHASES:
+            count = '{:.1f}'.format(sum(phases.get(phase, (0, 0))[1] for phases in phases_list) / len(phases_list))
+        lines.append('{:<10} {:>6.1%} {} {:>9.2f} {:>6}'.format(
+            phase, share, ' '.join('{:>9.2f}'.format(percentile(milliseconds, share)) for share in PERCENTILES),
+            milliseconds[-1], count))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('trace_directory', help='directory the bot writes traces to, `traces` by default')
+    parser.add_argument('--label', help='only traces of this command or kind of update, e.g. /random_joke')
+    parser.add_argument('--since', help='skip traces before this UTC date, YYYY-MM-DD')
+    args = parser.parse_args()
+
+    paths = get_trace_files(args.trace_directory)
+    if len(paths) == 0:
+        print('No trace files in {}'.format(args.trace_directory))
+        sys.exit(1)
+
+    since = None
+    if args.since is not None:
+        since = calendar.timegm(time.strptime(args.since, '%Y-%m-%d'))
+
+    traces, invalid = read_traces(paths, args.label, since)
+    if invalid > 0:
+        print('Skipped {} invalid lines'.format(invalid))
+    # Most frequent first
+    for label, phases_list in sorted(traces.items(), key=lambda item: -len(item[1])):
+        print('{} - {} traces, milliseconds'.format(label, len(phases_list)))
+        for line in summarize(phases_list):
+            print('  ' + line)
+        print()
+
+
+if __name__ == '__main__':
+    main()